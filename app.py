@@ -1,18 +1,43 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, g, session 
+from flask import Flask, render_template, request, jsonify, redirect, url_for, g, session, Response
 from functools import wraps
 import sqlite3
 import time
 import uuid
 import os
 import json 
-from datetime import datetime
+import re
+import io
+import csv
+import html
+import unicodedata
+import math
+import gzip
+import hashlib
+import hmac
+import secrets
+import base64
+import socket
+import threading
+import queue
+import concurrent.futures
+import atexit
+import click
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from html.parser import HTMLParser
+from urllib.parse import urlencode
+from datetime import datetime, timedelta, timezone
 from flask import session, has_request_context
+from flask.sessions import SecureCookieSession, SessionInterface
+from werkzeug.exceptions import RequestEntityTooLarge
+from itsdangerous import BadSignature, Signer
+from jinja2 import TemplateNotFound
 import dotenv
 dotenv.load_dotenv() # Load variables from .env file
 
 # --- FLASK-MAIL IMPORTS ---
 from flask_mail import Mail, Message
-import random # For OTP generation
+import random
 
 # --- GEMINI/LLM IMPORTS ---
 genai = None 
@@ -30,6 +55,19 @@ except Exception as e: # Modified to catch the import error
     print(f"*** DEBUG CHECK: Google genai IMPORT FAILED with error: {e}") 
     # -------------------------
 
+# --- OPTIONAL BROTLI (form pages fall back to gzip without it) ---
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# --- OPTIONAL PYARROW (Parquet export; CSV and NDJSON work without it) ---
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 # --- GLOBAL LLM CLIENT INITIALIZATION (Using .env) ---
 client = None 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -53,9 +91,13 @@ app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'default_strong_secret_key_change_me')
 
 # --- FLASK-MAIL CONFIGURATION (Using .env Variables) ---
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', '587'))
+app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', '1') == '1'
+# Point MAIL_SERVER/MAIL_PORT at a local stand-in for testing, e.g.
+#   python -m aiosmtpd -n -l localhost:1025   (with MAIL_USE_TLS=0)
+# or set MAIL_SUPPRESS_SEND=1 to skip SMTP entirely.
+app.config['MAIL_SUPPRESS_SEND'] = os.getenv('MAIL_SUPPRESS_SEND', '0') == '1'
 app.config['MAIL_USERNAME'] = os.getenv('GMAIL_SENDER_EMAIL')
 app.config['MAIL_PASSWORD'] = os.getenv('GMAIL_APP_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.getenv('GMAIL_SENDER_EMAIL')
@@ -69,89 +111,846 @@ HOI_MANAGEMENT_EMAILS = [
     # Add other HOI management emails here
 ]
 
+# --- OUTBOUND EMAIL QUEUE CONFIGURATION ---
+# EMAIL_WORKER_MODE: 'thread' runs EMAIL_WORKERS delivery threads in every worker process,
+# 'off' leaves delivery to `flask --app app email-worker`.
+EMAIL_WORKER_MODE = os.getenv('EMAIL_WORKER_MODE', 'thread')
+EMAIL_WORKERS = int(os.getenv('EMAIL_WORKERS', '2'))
+EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', '20'))
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '5'))
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv('EMAIL_RETRY_BASE_SECONDS', '30'))
+EMAIL_POLL_SECONDS = float(os.getenv('EMAIL_POLL_SECONDS', '5'))
+EMAIL_CLAIM_SECONDS = float(os.getenv('EMAIL_CLAIM_SECONDS', '300'))
+
+# --- OTP LOGIN ---
+# Codes are stored as keyed hashes and expire after OTP_TTL_SECONDS; a code is discarded
+# after OTP_MAX_ATTEMPTS wrong guesses. Sends are limited per email and per client IP with
+# token buckets (bursts of *_BURST, refilled at *_PER_HOUR; 0 disables a limit).
+OTP_TTL_SECONDS = int(os.getenv('OTP_TTL_SECONDS', '120'))
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', '5'))
+OTP_EMAIL_RATE_PER_HOUR = float(os.getenv('OTP_EMAIL_RATE_PER_HOUR', '10'))
+OTP_EMAIL_RATE_BURST = float(os.getenv('OTP_EMAIL_RATE_BURST', '3'))
+OTP_IP_RATE_PER_HOUR = float(os.getenv('OTP_IP_RATE_PER_HOUR', '60'))
+OTP_IP_RATE_BURST = float(os.getenv('OTP_IP_RATE_BURST', '10'))
+# Behind a reverse proxy (e.g. a platform router) every request comes from the proxy's
+# address; set this to the number of proxies in front of gunicorn to take the client IP
+# from X-Forwarded-For instead.
+OTP_PROXY_HOPS = int(os.getenv('OTP_PROXY_HOPS', '0'))
+# The sweeper deletes expired codes, idle rate-limit buckets and expired OTP mail in
+# batches of this many rows, one short write transaction per batch.
+OTP_PURGE_BATCH = int(os.getenv('OTP_PURGE_BATCH', '500'))
+
 # --- DATABASE CONFIGURATION ---
-DATABASE = 'executive_dashboard.db'
+DATABASE = os.getenv('DATABASE_PATH', 'executive_dashboard.db')
 ONE_DAY_SECONDS = 24 * 60 * 60
 REVIEWER_USER = "HOI Admin" 
 
+# --- SESSIONS & USER DIRECTORY ---
+# Session data lives in the sessions table; the cookie only carries a signed random id.
+# A session unused for SESSION_IDLE_SECONDS expires; last use is written back at most
+# every SESSION_TOUCH_SECONDS. Each worker keeps up to *_MAX_ENTRIES sessions and users in
+# memory, dropped as soon as the row changes in any process (see migration 14).
+SESSION_IDLE_SECONDS = int(os.getenv('SESSION_IDLE_SECONDS', str(7 * ONE_DAY_SECONDS)))
+SESSION_TOUCH_SECONDS = int(os.getenv('SESSION_TOUCH_SECONDS', '600'))
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv('SESSION_CACHE_MAX_ENTRIES', '10000'))
+USER_DIRECTORY_MAX_ENTRIES = int(os.getenv('USER_DIRECTORY_MAX_ENTRIES', '10000'))
+
+# --- SQLITE CONNECTION TUNING ---
+# Every connection runs in WAL mode, so dashboard reads keep going while a submission is
+# being written. Reads use a per-worker pool of read-only connections (get_read_db());
+# writes go through the worker's single writer connection (db_writer()).
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '16384'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_STATEMENT_CACHE_SIZE = int(os.getenv('SQLITE_STATEMENT_CACHE_SIZE', '256'))
+SQLITE_READ_POOL_SIZE = int(os.getenv('SQLITE_READ_POOL_SIZE', '16'))
+
+# --- SUBMISSION IDEMPOTENCY ---
+# A client may send an Idempotency-Key header with /api/submit_form: a repeat with the same
+# key from the same form user within IDEMPOTENCY_KEY_TTL_SECONDS gets the original response
+# back instead of a second submission. Without the header, the same payload for the same
+# form and user within SUBMISSION_DEDUP_WINDOW_SECONDS counts as a repeat (0 disables that).
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_KEY_TTL_SECONDS', str(ONE_DAY_SECONDS)))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+SUBMISSION_DEDUP_WINDOW_SECONDS = int(os.getenv('SUBMISSION_DEDUP_WINDOW_SECONDS', '120'))
+
+# --- BATCH SUBMISSIONS ---
+# /api/submit_forms_batch takes many entries (a JSON array or NDJSON) in one transaction.
+# The Idempotency-Key header and the dedup window apply to the batch as a whole. Bodies
+# over BATCH_SUBMIT_MAX_BYTES get a 413 before they are parsed.
+BATCH_SUBMIT_MAX_ITEMS = int(os.getenv('BATCH_SUBMIT_MAX_ITEMS', '5000'))
+BATCH_SUBMIT_MAX_BYTES = int(os.getenv('BATCH_SUBMIT_MAX_BYTES', str(16 * 1024 * 1024)))
+
+# --- SUBMISSION SCHEMAS ---
+# A payload for a form with a template under templates/forms/ is checked against the fields
+# that template defines, before any database work. 'enforce' rejects bad payloads, 'report'
+# only counts them, 'off' skips the check. Every payload is held to SUBMISSION_MAX_BYTES.
+SUBMISSION_SCHEMA_MODE = os.getenv('SUBMISSION_SCHEMA_MODE', 'enforce')
+SUBMISSION_MAX_BYTES = int(os.getenv('SUBMISSION_MAX_BYTES', str(64 * 1024)))
+SUBMISSION_TEXT_MAX_LENGTH = int(os.getenv('SUBMISSION_TEXT_MAX_LENGTH', '5000'))
+SUBMISSION_SCHEMA_LATENCY_SAMPLES = 1000 # recent validations per form kept for percentiles
+
+# --- SUBMISSION LIST PAGINATION ---
+SUBMISSIONS_PAGE_SIZE = 50
+SUBMISSIONS_MAX_PAGE_SIZE = 500
+
+# --- FORM FIELD PROJECTION (submission_fields) ---
+SUBMISSION_FIELDS_MAX_PER_SUBMISSION = int(os.getenv('SUBMISSION_FIELDS_MAX_PER_SUBMISSION', '500'))
+SUBMISSION_FIELD_TEXT_MAX = int(os.getenv('SUBMISSION_FIELD_TEXT_MAX', '2000'))
+SUBMISSION_FIELD_FILTERS_MAX = 10
+SUBMISSION_FIELDS_BACKFILL_BATCH = int(os.getenv('SUBMISSION_FIELDS_BACKFILL_BATCH', '2000'))
+SUBMISSION_AGGREGATE_MAX_GROUPS = 1000
+
+# --- ANALYTICS ROLLUPS ---
+# Day buckets start at local midnight for this UTC offset; run `flask rebuild-rollups` after changing it.
+ANALYTICS_UTC_OFFSET_SECONDS = int(os.getenv('ANALYTICS_UTC_OFFSET_MINUTES', '0')) * 60
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_HOURLY_MAX_DAYS = 31
+ANALYTICS_BACKLOG_STATUSES = ['activity', 'pending']
+
+# --- SUBMISSION EXPORT ---
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '2000'))
+EXPORT_PARQUET_ROW_GROUP_ROWS = int(os.getenv('EXPORT_PARQUET_ROW_GROUP_ROWS', '50000'))
+EXPORT_MAX_FIELD_COLUMNS = 500
+
+# --- FULL-TEXT SEARCH ---
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+# Above this many matches, results come newest first instead of by relevance (bm25 has to
+# score every match, ~2 us each).
+SEARCH_RANKED_MAX_MATCHES = int(os.getenv('SEARCH_RANKED_MAX_MATCHES', '5000'))
+# bm25 also reads the full posting list of every word to weigh it, so a query containing a
+# word this common is ordered newest first too (such a word adds almost nothing to a ranking).
+SEARCH_RANKED_MAX_TERM_DOCS = int(os.getenv('SEARCH_RANKED_MAX_TERM_DOCS', '20000'))
+SEARCH_SNIPPET_TOKENS = 16
+
+# --- DASHBOARD SUMMARY CACHE ---
+SUMMARY_CACHE_TTL_SECONDS = float(os.getenv('SUMMARY_CACHE_TTL_SECONDS', '5'))
+
+# --- RESPONSE CACHE (reviewer read APIs) ---
+# RESPONSE_CACHE_BACKEND: 'memory' keeps an LRU per worker; 'sqlite' also shares entries
+# between workers through a separate cache file (RESPONSE_CACHE_PATH, default next to the
+# database); 'off' disables caching (ETags and 304s still work).
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH')
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '2000'))
+RESPONSE_CACHE_SHARED_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_SHARED_MAX_ENTRIES', '20000'))
+RESPONSE_CACHE_MAX_BODY_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BODY_BYTES', str(1024 * 1024)))
+# Entries are invalidated by version counters; the TTL only bounds how long a change made
+# outside the app (e.g. by hand in sqlite3) can go unnoticed.
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '300'))
+
+# --- CHATBOT ---
+# Data answers (counts, lists, logs) are cached per intent and data version for this long;
+# the TTL only matters for periods such as 'today' that roll over without a write.
+CHATBOT_ANSWER_TTL_SECONDS = float(os.getenv('CHATBOT_ANSWER_TTL_SECONDS', '30'))
+CHATBOT_ANSWER_CACHE_MAX = 500
+CHATBOT_LIST_ITEMS = 5
+CHATBOT_BREAKDOWN_ROWS = 10
+
+# --- LLM FALLBACK ---
+# LLM_BACKEND: 'gemini' uses the google-genai client above; 'fake' answers locally after
+# LLM_FAKE_DELAY_SECONDS (for development and load tests); 'off' disables the fallback.
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'gemini')
+LLM_MODEL = os.getenv('LLM_MODEL', 'gemini-2.5-flash')
+LLM_FAKE_DELAY_SECONDS = float(os.getenv('LLM_FAKE_DELAY_SECONDS', '1.0'))
+# Replies are cached in chat_history per normalized prompt: kept LLM_CACHE_TTL_SECONDS and
+# at most LLM_CACHE_MAX_ENTRIES rows, least recently used evicted first.
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', str(ONE_DAY_SECONDS)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '2000'))
+# Model calls per user (cache hits are free): bursts of LLM_RATE_LIMIT_BURST, refilled at
+# LLM_RATE_LIMIT_PER_MINUTE. 0 disables the limit.
+LLM_RATE_LIMIT_PER_MINUTE = float(os.getenv('LLM_RATE_LIMIT_PER_MINUTE', '6'))
+LLM_RATE_LIMIT_BURST = float(os.getenv('LLM_RATE_LIMIT_BURST', '3'))
+# Model calls run on a per-worker executor of LLM_MAX_CONCURRENCY threads. At most
+# LLM_MAX_PENDING chat requests per worker wait on it (more get a 503 at once), so slow
+# replies can never take more than that many of the worker's request threads; keep it well
+# under GUNICORN_THREADS. A request gives up after LLM_TIMEOUT_SECONDS (the call still
+# finishes in the background and its reply is cached).
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+LLM_MAX_PENDING = int(os.getenv('LLM_MAX_PENDING', '16'))
+LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', '60'))
+
+# --- BACKGROUND SWEEPER CONFIGURATION ---
+# SWEEPER_MODE: 'thread' runs the sweeper inside every worker (one leader is elected),
+# 'off' disables it (use `flask --app app sweep --loop` as a separate process instead).
+SWEEPER_MODE = os.getenv('SWEEPER_MODE', 'thread')
+SWEEPER_INTERVAL_SECONDS = int(os.getenv('SWEEPER_INTERVAL_SECONDS', '60'))
+SWEEPER_LEASE_SECONDS = int(os.getenv('SWEEPER_LEASE_SECONDS', str(SWEEPER_INTERVAL_SECONDS * 2 + 5)))
+
+# --- ACTIVITY LOG BUFFERING ---
+# ACTIVITY_LOG_MODE: 'buffered' queues rows in memory and writes them in batches,
+# 'sync' inserts and commits every event immediately (use it in tests).
+ACTIVITY_LOG_MODE = os.getenv('ACTIVITY_LOG_MODE', 'buffered')
+ACTIVITY_LOG_BATCH_SIZE = int(os.getenv('ACTIVITY_LOG_BATCH_SIZE', '200'))
+ACTIVITY_LOG_FLUSH_SECONDS = float(os.getenv('ACTIVITY_LOG_FLUSH_SECONDS', '1.0'))
+ACTIVITY_LOG_MAX_BUFFER = int(os.getenv('ACTIVITY_LOG_MAX_BUFFER', '50000'))
+
+# --- LIVE EVENT STREAM (Server-Sent Events) ---
+# Each worker polls the events table every EVENT_POLL_SECONDS (or immediately after a local
+# write) and pushes new rows to its connected dashboards. Clients that reconnect send
+# Last-Event-ID and are replayed what they missed, up to EVENT_REPLAY_LIMIT events.
+EVENT_POLL_SECONDS = float(os.getenv('EVENT_POLL_SECONDS', '0.5'))
+EVENT_HEARTBEAT_SECONDS = float(os.getenv('EVENT_HEARTBEAT_SECONDS', '15'))
+EVENT_RETRY_MS = int(os.getenv('EVENT_RETRY_MS', '3000'))
+EVENT_REPLAY_LIMIT = int(os.getenv('EVENT_REPLAY_LIMIT', '1000'))
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '1000'))
+# Every open stream holds one of the worker's GUNICORN_THREADS request threads for as long as
+# it lives, so streams get what is left after EVENT_RESERVED_THREADS for ordinary requests
+# (which include up to LLM_MAX_PENDING waiting chat requests). Further streams get a 503.
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '128')) # keep in step with gunicorn.conf.py
+EVENT_RESERVED_THREADS = int(os.getenv('EVENT_RESERVED_THREADS', str(min(GUNICORN_THREADS // 2, LLM_MAX_PENDING + max(16, GUNICORN_THREADS // 4)))))
+EVENT_MAX_SUBSCRIBERS = min(int(os.getenv('EVENT_MAX_SUBSCRIBERS', str(GUNICORN_THREADS))),
+                            max(0, GUNICORN_THREADS - EVENT_RESERVED_THREADS))
+EVENT_RETENTION_SECONDS = int(os.getenv('EVENT_RETENTION_SECONDS', str(ONE_DAY_SECONDS)))
+
 # -------------------------------------------------------------------------------------
 # 1. DATABASE CONNECTION & LOGGING FUNCTIONS
 # -------------------------------------------------------------------------------------
 
+def connect_db(path=None, read_only=False):
+    """Opens a tuned connection. synchronous=NORMAL is safe in WAL mode: a crash never
+    corrupts the database, a power cut can only lose the last few commits."""
+    db = sqlite3.connect(path or DATABASE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                         cached_statements=SQLITE_STATEMENT_CACHE_SIZE, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    db.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    if read_only:
+        db.execute("PRAGMA query_only = ON")
+    return db
+
 def get_db():
+    """Read-write connection for this app context (migrations, CLI commands)."""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        db = g._database = connect_db()
     return db
 
+# Pooled connections keep their prepared statement cache between requests. Entries are
+# (path, connection) so a pool never hands out a connection to another database file.
+_read_pool = []
+_read_pool_lock = threading.Lock()
+
+def acquire_read_connection():
+    with _read_pool_lock:
+        while _read_pool:
+            path, db = _read_pool.pop()
+            if path == DATABASE:
+                return path, db
+            db.close()
+    return DATABASE, connect_db(read_only=True)
+
+def release_read_connection(path, db):
+    if db.in_transaction:
+        db.rollback()
+    with _read_pool_lock:
+        if path == DATABASE and len(_read_pool) < SQLITE_READ_POOL_SIZE:
+            _read_pool.append((path, db))
+            return
+    db.close()
+
+def get_read_db():
+    """Read-only connection for this request, borrowed from the worker's pool."""
+    entry = getattr(g, '_read_database', None)
+    if entry is None:
+        entry = g._read_database = acquire_read_connection()
+    return entry[1]
+
+_writer = {'path': None, 'db': None}
+_writer_lock = threading.RLock()
+
+@contextmanager
+def db_writer():
+    """Runs one write transaction on the worker's writer connection.
+
+    Threads of a worker queue on a lock here rather than contending for SQLite's write
+    lock; workers in other processes are arbitrated by busy_timeout. BEGIN IMMEDIATE
+    takes the write lock up front, so the transaction never fails halfway on a lock
+    upgrade. Nested use joins the outer transaction.
+    """
+    with _writer_lock:
+        if _writer['db'] is None or _writer['path'] != DATABASE:
+            if _writer['db'] is not None:
+                _writer['db'].close()
+            _writer.update(path=DATABASE, db=connect_db())
+        db = _writer['db']
+        if db.in_transaction:
+            yield db
+            return
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+
+def close_db_connections():
+    """Closes the pooled and writer connections of this process."""
+    with _read_pool_lock:
+        for _, db in _read_pool:
+            db.close()
+        _read_pool.clear()
+    with _writer_lock:
+        if _writer['db'] is not None:
+            _writer['db'].close()
+        _writer.update(path=None, db=None)
+
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, '_database', None)
     if db is not None:
         db.close()
+    entry = getattr(g, '_read_database', None)
+    if entry is not None:
+        release_read_connection(*entry)
+
+# --- ACTIVITY LOG ---
+# In buffered mode log_activity() only appends to an in-process list. A flusher thread
+# writes the list to `activities` with one executemany per batch, either every
+# ACTIVITY_LOG_FLUSH_SECONDS or as soon as ACTIVITY_LOG_BATCH_SIZE rows are waiting.
+# Whatever is left is flushed when the worker exits.
+
+ACTIVITY_INSERT_SQL = """
+    INSERT INTO activities (timestamp, user, event, description, type)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+ACTIVITY_LOG_STATS = {'logged': 0, 'flushed': 0, 'flushes': 0, 'dropped': 0, 'last_error': None}
+_activity_buffer = []
+_activity_buffer_lock = threading.Lock()
+_activity_flush_lock = threading.Lock()
+_activity_flush_wakeup = threading.Event()
+_activity_flush_stop = threading.Event()
+_activity_flush_thread = None
 
 def log_activity(event, description, type):
     try:
-        db = get_db()
         current_time = time.time()
         if has_request_context():
             user = session.get('user', 'UNAUTHENTICATED_USER') 
         else:
             user = 'SYSTEM_INIT' 
-        
-        db.execute("""
-            INSERT INTO activities (timestamp, user, event, description, type)
-            VALUES (?, ?, ?, ?, ?)
-        """, (current_time, user, event, description, type))
-        db.commit()
+        row = (current_time, user, event, description, type)
+
+        if ACTIVITY_LOG_MODE == 'sync':
+            with db_writer() as db:
+                db.execute(ACTIVITY_INSERT_SQL, row)
+                bump_cache_version(db, CACHE_SCOPE_ACTIVITY)
+            ACTIVITY_LOG_STATS['logged'] += 1
+            return
+
+        with _activity_buffer_lock:
+            _activity_buffer.append(row)
+            ACTIVITY_LOG_STATS['logged'] += 1
+            pending = len(_activity_buffer)
+        if pending >= ACTIVITY_LOG_BATCH_SIZE:
+            if _activity_flush_thread is not None and _activity_flush_thread.is_alive():
+                _activity_flush_wakeup.set()
+            else:
+                flush_activity_log()
     except Exception as e:
         print(f"Error logging activity (event: {event}): {e}")
 
+def flush_activity_log():
+    """Writes every buffered activity row in one transaction. Returns the number written."""
+    with _activity_flush_lock:
+        with _activity_buffer_lock:
+            rows = _activity_buffer[:]
+            del _activity_buffer[:]
+        if not rows:
+            return 0
+        try:
+            with db_writer() as db:
+                db.executemany(ACTIVITY_INSERT_SQL, rows)
+                bump_cache_version(db, CACHE_SCOPE_ACTIVITY)
+        except Exception as e:
+            # Put the rows back (oldest first) so the next flush retries them, but never
+            # let a broken database grow the buffer without bound.
+            with _activity_buffer_lock:
+                _activity_buffer[:0] = rows
+                overflow = len(_activity_buffer) - ACTIVITY_LOG_MAX_BUFFER
+                if overflow > 0:
+                    del _activity_buffer[:overflow]
+                    ACTIVITY_LOG_STATS['dropped'] += overflow
+            ACTIVITY_LOG_STATS['last_error'] = str(e)
+            print(f"Error flushing {len(rows)} activity rows: {e}")
+            return 0
+        ACTIVITY_LOG_STATS['flushed'] += len(rows)
+        ACTIVITY_LOG_STATS['flushes'] += 1
+        return len(rows)
+
+def _activity_flush_loop():
+    while not _activity_flush_stop.is_set():
+        _activity_flush_wakeup.wait(ACTIVITY_LOG_FLUSH_SECONDS)
+        _activity_flush_wakeup.clear()
+        flush_activity_log()
+
+def start_activity_flusher():
+    global _activity_flush_thread
+    if ACTIVITY_LOG_MODE != 'buffered':
+        return
+    if _activity_flush_thread is not None and _activity_flush_thread.is_alive():
+        return
+    _activity_flush_stop.clear()
+    _activity_flush_thread = threading.Thread(target=_activity_flush_loop, name='activity-log-flusher', daemon=True)
+    _activity_flush_thread.start()
+
+def stop_activity_flusher():
+    _activity_flush_stop.set()
+    _activity_flush_wakeup.set()
+    if _activity_flush_thread is not None:
+        _activity_flush_thread.join(timeout=5)
+    flush_activity_log()
+
+# Covers the dev server and CLI commands; gunicorn workers also flush in worker_exit.
+atexit.register(flush_activity_log)
+
+# -------------------------------------------------------------------------------------
+# 1b. SCHEMA MIGRATIONS
+# -------------------------------------------------------------------------------------
+# Every schema change is an entry in MIGRATIONS: (version, name, steps). A step is either
+# a SQL string or a callable taking the connection. Applied versions are recorded in
+# schema_version, so the runner only applies what is missing. Never edit a migration that
+# has shipped; append a new one instead.
+
+MIGRATE_ON_STARTUP = os.getenv('MIGRATE_ON_STARTUP', '1') == '1'
+
+# Full-text search (migration 9). Diacritics are folded, so 'cafe' finds 'café'.
+SEARCH_TOKENIZER = 'unicode61 remove_diacritics 2'
+
+def search_body_sql(data):
+    """SQL for the searchable text of a payload: its text and integer values, without the
+    envelope keys that already are columns. Malformed JSON indexes as empty."""
+    return f"""(SELECT group_concat(value, ' ') FROM json_tree(CASE WHEN json_valid({data}) THEN {data} ELSE '{{}}' END)
+               WHERE type IN ('text', 'integer') AND key NOT IN ('form_type', 'form_user', 'subject'))"""
+
+MIGRATIONS = [
+    (1, 'baseline tables', [
+        """
+        CREATE TABLE IF NOT EXISTS submissions (
+            id TEXT PRIMARY KEY, form TEXT NOT NULL, user TEXT NOT NULL, subject TEXT NOT NULL,
+            data TEXT, status TEXT NOT NULL, submittedAt REAL NOT NULL, approvedAt REAL,
+            reviewedBy TEXT, remarks TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            username TEXT NOT NULL UNIQUE,
+            password_hash TEXT, -- Retained for compatibility but not used for login
+            role TEXT NOT NULL, 
+            form_access TEXT 
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS activities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL NOT NULL, user TEXT NOT NULL,
+            event TEXT NOT NULL, description TEXT, type TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL NOT NULL, user_message TEXT NOT NULL,
+            assistant_reply TEXT, session_id TEXT 
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS otp_store (
+            email TEXT PRIMARY KEY, otp TEXT NOT NULL, timestamp REAL NOT NULL
+        )
+        """,
+        # Leader election for background jobs across gunicorn workers
+        """
+        CREATE TABLE IF NOT EXISTS service_leases (
+            name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL
+        )
+        """,
+    ]),
+    (2, 'dashboard indexes', [
+        # Summary counts, the overdue sweeper and the pending/alert lists
+        "CREATE INDEX IF NOT EXISTS idx_submissions_status_submitted ON submissions (status, submittedAt)",
+        # 'Approved today' (status = 'approved' AND approvedAt > ?)
+        "CREATE INDEX IF NOT EXISTS idx_submissions_status_approved ON submissions (status, approvedAt)",
+        # Submitter-scoped lists
+        "CREATE INDEX IF NOT EXISTS idx_submissions_user_submitted ON submissions (user, submittedAt)",
+        # Reviewer list (ORDER BY submittedAt DESC)
+        "CREATE INDEX IF NOT EXISTS idx_submissions_submitted ON submissions (submittedAt)",
+        # Recent activity (ORDER BY timestamp DESC)
+        "CREATE INDEX IF NOT EXISTS idx_activities_timestamp ON activities (timestamp)",
+    ]),
+    (3, 'materialized submission counters', [
+        """
+        CREATE TABLE IF NOT EXISTS submission_stats (
+            status TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "DELETE FROM submission_stats",
+        "INSERT INTO submission_stats (status, count) SELECT status, COUNT(*) FROM submissions GROUP BY status",
+    ]),
+    (4, 'keyset pagination indexes', [
+        # Lists are ordered by (submittedAt, id) so that pages have a total order; the
+        # trailing id lets SQLite walk the index without a sort step.
+        "DROP INDEX IF EXISTS idx_submissions_submitted",
+        "DROP INDEX IF EXISTS idx_submissions_status_submitted",
+        "DROP INDEX IF EXISTS idx_submissions_user_submitted",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_submitted_id ON submissions (submittedAt, id)",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_status_submitted_id ON submissions (status, submittedAt, id)",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_user_submitted_id ON submissions (user, submittedAt, id)",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_form_submitted_id ON submissions (form, submittedAt, id)",
+    ]),
+    (5, 'email outbox', [
+        """
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, subject TEXT NOT NULL,
+            body TEXT NOT NULL, ref TEXT, -- e.g. the submission the message is about
+            status TEXT NOT NULL DEFAULT 'queued', -- queued | sending | sent | failed
+            attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, created_at REAL NOT NULL,
+            sent_at REAL, last_error TEXT, claimed_by TEXT, claim_expires_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_status_next ON email_outbox (status, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_ref ON email_outbox (ref)",
+    ]),
+    (6, 'live event stream', [
+        # AUTOINCREMENT so ids are never reused after pruning; clients resume by id.
+        """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT NOT NULL,
+            user TEXT, -- submitter the event is about; NULL means reviewers only
+            payload TEXT NOT NULL, created_at REAL NOT NULL
+        )
+        """,
+        # Submitter replays (WHERE user = ? AND id > ?) and retention pruning
+        "CREATE INDEX IF NOT EXISTS idx_events_user_id ON events (user, id)",
+        "CREATE INDEX IF NOT EXISTS idx_events_created ON events (created_at)",
+    ]),
+    (7, 'submission field projection', [
+        # One row per payload field, written in the same transaction as the submission.
+        # Existing rows are projected by `flask backfill-fields`.
+        """
+        CREATE TABLE IF NOT EXISTS submission_fields (
+            submission_id TEXT NOT NULL, field TEXT NOT NULL,
+            value_num REAL, -- numbers, numeric strings and booleans (1/0); NULL otherwise
+            value_text TEXT NOT NULL, -- the value as submitted
+            PRIMARY KEY (submission_id, field)
+        ) WITHOUT ROWID
+        """,
+        # Field catalogue and value lookups across all submissions
+        "CREATE INDEX IF NOT EXISTS idx_submission_fields_field_num ON submission_fields (field, value_num)",
+        "CREATE INDEX IF NOT EXISTS idx_submission_fields_field_text ON submission_fields (field, value_text COLLATE NOCASE)",
+    ]),
+    (8, 'analytics rollups', [
+        "ALTER TABLE submissions ADD COLUMN institute TEXT",
+        """
+        UPDATE submissions SET institute = NULLIF(TRIM(COALESCE(
+            json_extract(data, '$.institute_id'), json_extract(data, '$.institute'), '')), '')
+        WHERE json_valid(data)
+        """,
+        # Counters per (grain, bucket, form): submissions by submittedAt, reviews by approvedAt
+        """
+        CREATE TABLE IF NOT EXISTS submission_rollups (
+            grain TEXT NOT NULL, -- 'hour' | 'day'
+            bucket_start REAL NOT NULL, form TEXT NOT NULL,
+            submitted INTEGER NOT NULL DEFAULT 0,
+            approved INTEGER NOT NULL DEFAULT 0, disapproved INTEGER NOT NULL DEFAULT 0,
+            alert INTEGER NOT NULL DEFAULT 0,
+            latency_sum REAL NOT NULL DEFAULT 0, -- seconds from submit to review, summed
+            PRIMARY KEY (grain, bucket_start, form)
+        ) WITHOUT ROWID
+        """,
+        # Review latency histogram per day and form (log-scale bins, see latency_bin)
+        """
+        CREATE TABLE IF NOT EXISTS submission_latency_histogram (
+            day_start REAL NOT NULL, form TEXT NOT NULL, bin INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day_start, form, bin)
+        ) WITHOUT ROWID
+        """,
+        # Current status counts per form and institute ('' when the payload has none)
+        """
+        CREATE TABLE IF NOT EXISTS submission_status_rollup (
+            form TEXT NOT NULL, institute TEXT NOT NULL, status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (form, institute, status)
+        ) WITHOUT ROWID
+        """,
+        lambda db: populate_rollups(db),
+    ]),
+    (9, 'full-text search', [
+        # Submissions keep their own FTS content: body is derived from the JSON payload
+        # (its text and integer values), so it cannot point at a submissions column.
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS submissions_fts USING fts5(
+            subject, remarks, body, tokenize = '{SEARCH_TOKENIZER}', prefix = '2 3 4'
+        )
+        """,
+        "INSERT INTO submissions_fts (submissions_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS submissions_fts_insert AFTER INSERT ON submissions BEGIN
+            INSERT INTO submissions_fts (rowid, subject, remarks, body)
+            VALUES (NEW.rowid, NEW.subject, NEW.remarks, {search_body_sql('NEW.data')});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS submissions_fts_update AFTER UPDATE OF subject, remarks, data ON submissions BEGIN
+            UPDATE submissions_fts SET subject = NEW.subject, remarks = NEW.remarks, body = {search_body_sql('NEW.data')}
+            WHERE rowid = NEW.rowid;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS submissions_fts_delete AFTER DELETE ON submissions BEGIN
+            DELETE FROM submissions_fts WHERE rowid = OLD.rowid;
+        END
+        """,
+        f"""
+        INSERT INTO submissions_fts (rowid, subject, remarks, body)
+        SELECT rowid, subject, remarks, {search_body_sql('data')} FROM submissions
+        """,
+        # Activities index their own columns, so the index reads content from the table.
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS activities_fts USING fts5(
+            event, description, content = 'activities', content_rowid = 'id', tokenize = '{SEARCH_TOKENIZER}', prefix = '2 3 4'
+        )
+        """,
+        "INSERT INTO activities_fts (activities_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')",
+        """
+        CREATE TRIGGER IF NOT EXISTS activities_fts_insert AFTER INSERT ON activities BEGIN
+            INSERT INTO activities_fts (rowid, event, description) VALUES (NEW.id, NEW.event, NEW.description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS activities_fts_delete AFTER DELETE ON activities BEGIN
+            INSERT INTO activities_fts (activities_fts, rowid, event, description)
+            VALUES ('delete', OLD.id, OLD.event, OLD.description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS activities_fts_update AFTER UPDATE OF event, description ON activities BEGIN
+            INSERT INTO activities_fts (activities_fts, rowid, event, description)
+            VALUES ('delete', OLD.id, OLD.event, OLD.description);
+            INSERT INTO activities_fts (rowid, event, description) VALUES (NEW.id, NEW.event, NEW.description);
+        END
+        """,
+        "INSERT INTO activities_fts (activities_fts) VALUES ('rebuild')",
+    ]),
+    (10, 'response cache versions', [
+        # One counter per cached data set, bumped in the same transaction as the write.
+        """
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (11, 'reviewer index', [
+        # Chatbot questions such as "approvals by X this week"; covers the status/form breakdown.
+        "CREATE INDEX IF NOT EXISTS idx_submissions_reviewer_approved ON submissions (reviewedBy COLLATE NOCASE, approvedAt, status, form)",
+    ]),
+    (12, 'llm reply cache', [
+        # chat_history keeps one row per normalized prompt; timestamp is when it was answered.
+        "ALTER TABLE chat_history ADD COLUMN prompt_key TEXT",
+        "ALTER TABLE chat_history ADD COLUMN model TEXT",
+        "ALTER TABLE chat_history ADD COLUMN last_used_at REAL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_history_prompt_key ON chat_history (prompt_key)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_last_used ON chat_history (last_used_at)",
+        """
+        CREATE TABLE IF NOT EXISTS llm_rate_limits (
+            user TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (13, 'hashed otp store', [
+        # Outstanding plaintext codes are dropped; they expire within two minutes anyway.
+        "DROP TABLE IF EXISTS otp_store",
+        """
+        CREATE TABLE IF NOT EXISTS otp_store (
+            email TEXT PRIMARY KEY,
+            code_hash TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_otp_store_expires ON otp_store (expires_at)",
+        # One bucket per 'email:<address>' and 'ip:<address>'
+        """
+        CREATE TABLE IF NOT EXISTS otp_rate_limits (
+            bucket TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_otp_rate_limits_updated ON otp_rate_limits (updated_at)",
+        # Purging OTP mail by age; also serves lookups by ref, so it replaces idx_email_outbox_ref.
+        "DROP INDEX IF EXISTS idx_email_outbox_ref",
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_ref_created ON email_outbox (ref, created_at)",
+    ]),
+    (14, 'server-side sessions', [
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            sid TEXT PRIMARY KEY,
+            user TEXT,
+            data TEXT NOT NULL, -- JSON; role and form access come from users, not from here
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            last_seen_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)",
+        # Workers cache users and sessions in memory and drop the cache when these versions
+        # move. Triggers bump them, so edits made outside the app (sqlite3, scripts) count.
+        "INSERT OR IGNORE INTO cache_versions (scope, version) VALUES ('users', 1), ('sessions', 1)",
+        """
+        CREATE TRIGGER IF NOT EXISTS users_version_insert AFTER INSERT ON users BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE scope = 'users';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE ON users BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE scope = 'users';
+        END
+        """,
+        # Deleting a user ends their sessions.
+        """
+        CREATE TRIGGER IF NOT EXISTS users_version_delete AFTER DELETE ON users BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE scope = 'users';
+            DELETE FROM sessions WHERE user = OLD.username;
+        END
+        """,
+        # New sessions cannot be cached anywhere yet, and touches only move expires_at.
+        """
+        CREATE TRIGGER IF NOT EXISTS sessions_version_update AFTER UPDATE OF user, data ON sessions BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE scope = 'sessions';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS sessions_version_delete AFTER DELETE ON sessions BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE scope = 'sessions';
+        END
+        """,
+    ]),
+    (15, 'multi-form access', [
+        # Replaces users.form_access (one filename per account; the column is no longer read).
+        """
+        CREATE TABLE IF NOT EXISTS user_form_access (
+            username TEXT NOT NULL,
+            form TEXT NOT NULL,
+            PRIMARY KEY (username, form)
+        ) WITHOUT ROWID
+        """,
+        # Who can open a form (the primary key serves "which forms does a user have")
+        "CREATE INDEX IF NOT EXISTS idx_user_form_access_form ON user_form_access (form, username)",
+        """
+        INSERT OR IGNORE INTO user_form_access (username, form)
+        SELECT username, form_access FROM users WHERE form_access IS NOT NULL AND form_access != ''
+        """,
+        # Form grants are part of the cached user directory.
+        """
+        CREATE TRIGGER IF NOT EXISTS user_form_access_version_insert AFTER INSERT ON user_form_access BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE scope = 'users';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_form_access_version_delete AFTER DELETE ON user_form_access BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE scope = 'users';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_form_access_version_update AFTER UPDATE ON user_form_access BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE scope = 'users';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_form_access_delete AFTER DELETE ON users BEGIN
+            DELETE FROM user_form_access WHERE username = OLD.username;
+        END
+        """,
+    ]),
+    (16, 'submission idempotency keys', [
+        # key is 'key:<hash of form user + client key>' or 'content:<hash of form, user and payload>'.
+        """
+        CREATE TABLE IF NOT EXISTS submission_idempotency (
+            key TEXT PRIMARY KEY,
+            request_hash TEXT NOT NULL, -- a client key reused with another payload is refused
+            submission_id TEXT NOT NULL,
+            response TEXT NOT NULL,     -- JSON body replayed to repeats
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_submission_idempotency_expires ON submission_idempotency (expires_at)",
+    ]),
+]
+
+def get_schema_version(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at REAL NOT NULL
+        )
+    """)
+    row = db.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def run_migrations(db, target=None):
+    """Applies pending migrations in order. Safe to call from several workers at once."""
+    applied = []
+    latest = MIGRATIONS[-1][0] if target is None else target
+    if get_schema_version(db) >= latest:
+        db.commit()
+        return applied
+    db.commit()
+    for version, name, steps in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        # BEGIN IMMEDIATE takes the write lock, so a second worker waits here and then
+        # sees the version the first one recorded.
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= get_schema_version(db):
+                db.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                       (version, name, time.time()))
+            db.commit()
+            applied.append(version)
+            print(f"✅ Applied migration {version}: {name}")
+        except Exception:
+            db.rollback()
+            raise
+    return applied
+
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help='Only show the current and latest schema versions.')
+def migrate_command(status):
+    """Apply pending schema migrations to DATABASE."""
+    with app.app_context():
+        db = get_db()
+        current = get_schema_version(db)
+        db.commit()
+        latest = MIGRATIONS[-1][0]
+        if status:
+            click.echo(f"Schema version {current} (latest {latest}).")
+            return
+        applied = run_migrations(db)
+        click.echo(f"Applied {len(applied)} migration(s); schema version is now {get_schema_version(db)}.")
+
 def init_db():
     with app.app_context():
         db = get_db()
-        cursor = db.cursor()
-        
-        # 1. Submissions Table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS submissions (
-                id TEXT PRIMARY KEY, form TEXT NOT NULL, user TEXT NOT NULL, subject TEXT NOT NULL,
-                data TEXT, status TEXT NOT NULL, submittedAt REAL NOT NULL, approvedAt REAL,
-                reviewedBy TEXT, remarks TEXT
-            )
-        """)
-        
-        # 2. Users Table 
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                username TEXT NOT NULL UNIQUE,
-                password_hash TEXT, -- Retained for compatibility but not used for login
-                role TEXT NOT NULL, 
-                form_access TEXT 
-            )
-        """)
-        
-        # 3-5. Activities, Chat History, OTP Store Tables
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS activities (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL NOT NULL, user TEXT NOT NULL,
-                event TEXT NOT NULL, description TEXT, type TEXT
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL NOT NULL, user_message TEXT NOT NULL,
-                assistant_reply TEXT, session_id TEXT 
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS otp_store (
-                email TEXT PRIMARY KEY, otp TEXT NOT NULL, timestamp REAL NOT NULL
-            )
-        """)
-        db.commit() 
+        run_migrations(db)
         
         # --- INITIAL HOI ADMIN SEEDING (Reviewers) ---
         for email in HOI_MANAGEMENT_EMAILS:
@@ -194,11 +993,14 @@ def init_db():
         
         for email, form_name in submitters_list:
             try:
-                # Inserting into the 'form_access' column
-                db.execute("""
-                    INSERT OR IGNORE INTO users (username, role, form_access) 
-                    VALUES (?, ?, ?)
-                """, (email, 'submitter', form_name))
+                cursor = db.execute("""
+                    INSERT OR IGNORE INTO users (username, role) 
+                    VALUES (?, ?)
+                """, (email, 'submitter'))
+                # Only a new account gets its seed form: existing accounts keep the grants that
+                # `flask grant-forms` (or migration 15, from users.form_access) gave them.
+                if cursor.rowcount == 1:
+                    grant_forms(db, email, [form_name])
             except sqlite3.IntegrityError:
                 pass 
             
@@ -210,402 +1012,3059 @@ def init_db():
 # -------------------------------------------------------------------------------------
 
 def check_and_move_to_pending():
-    db = get_db()
-    cursor = db.cursor()
     now = time.time()
-    cursor.execute("""
-        UPDATE submissions SET status = 'pending' 
-        WHERE status = 'activity' AND submittedAt < ?
-    """, (now - ONE_DAY_SECONDS,))
-    if cursor.rowcount > 0:
-        db.commit()
-        log_activity("System Check", f"Moved {cursor.rowcount} submissions to PENDING (Overdue).", "AUTOMATION")
-    return cursor.rowcount
+    with db_writer() as db:
+        promoted = db.execute(f"""
+            UPDATE submissions SET status = 'pending' 
+            WHERE status = 'activity' AND submittedAt < ?
+            RETURNING {SUBMISSION_LIST_COLUMNS}, institute
+        """, (now - ONE_DAY_SECONDS,)).fetchall()
+        if promoted:
+            deltas = {'activity': -len(promoted), 'pending': len(promoted)}
+            apply_status_deltas(db, deltas)
+            apply_rollup_transitions(db, [(dict(row, status='activity'), row) for row in promoted])
+            bump_cache_version(db, CACHE_SCOPE_SUBMISSIONS)
+            record_events(db, [status_changed_event(row, 'activity') for row in promoted] + [summary_delta_event(deltas)])
+    if promoted:
+        invalidate_summary_cache()
+        notify_event_dispatcher()
+        log_activity("System Check", f"Moved {len(promoted)} submissions to PENDING (Overdue).", "AUTOMATION")
+    return len(promoted)
 
-def send_notification_email(recipient, subject, body):
-    try:
-        msg = Message(subject, recipients=[recipient], body=body)
-        with app.app_context(): 
-            mail.send(msg)
-        print(f"✅ EMAIL SENT TO: {recipient} (Subject: {subject})")
-        return True
-    except Exception as e:
-        print(f"❌ ERROR: Failed to send email to {recipient}. SMTP Error: {e}")
-        return False
+# -------------------------------------------------------------------------------------
+# 2b. BACKGROUND SWEEPER (Overdue 'activity' -> 'pending')
+# -------------------------------------------------------------------------------------
+# The sweeper used to run from a before_request hook, which turned every dashboard read
+# into a write. It now runs on an interval; when every gunicorn worker starts one, a lease
+# row in service_leases makes sure only a single worker actually sweeps.
 
-def get_submission_summary():
-    db = get_db()
-    cursor = db.cursor()
-    now_ts = time.time()
+SWEEPER_LEASE_NAME = 'overdue_sweeper'
+
+SWEEPER_STATS = {
+    'runs': 0,                # sweeps executed while holding the lease
+    'skipped_not_leader': 0,  # ticks where another worker held the lease
+    'promoted_total': 0,      # submissions moved to 'pending' by this process
+    'last_promoted': 0,
+    'last_run_at': None,
+    'last_duration_ms': None,
+    'last_error': None,
+    'is_leader': False,
+}
+_sweeper_stats_lock = threading.Lock()
+_sweeper_stop = threading.Event()
+_sweeper_thread = None
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire_lease(name, owner, ttl_seconds):
+    """Takes or renews the named lease. Returns True if `owner` holds it afterwards."""
+    now = time.time()
+    with db_writer() as db:
+        db.execute("INSERT OR IGNORE INTO service_leases (name, owner, expires_at) VALUES (?, ?, 0)", (name, owner))
+        cursor = db.execute("""
+            UPDATE service_leases SET owner = ?, expires_at = ?
+            WHERE name = ? AND (owner = ? OR expires_at < ?)
+        """, (owner, now + ttl_seconds, name, owner, now))
+    return cursor.rowcount == 1
+
+def release_lease(name, owner):
+    with db_writer() as db:
+        db.execute("UPDATE service_leases SET expires_at = 0 WHERE name = ? AND owner = ?", (name, owner))
+
+def run_sweeper_once(force=False):
+    """Runs one sweep if this process holds (or wins) the sweeper lease. Returns rows promoted."""
+    with app.app_context():
+        started = time.time()
+        try:
+            is_leader = force or acquire_lease(SWEEPER_LEASE_NAME, get_worker_id(), SWEEPER_LEASE_SECONDS)
+            with _sweeper_stats_lock:
+                SWEEPER_STATS['is_leader'] = is_leader
+                if not is_leader:
+                    SWEEPER_STATS['skipped_not_leader'] += 1
+            if not is_leader:
+                return 0
+
+            promoted = check_and_move_to_pending()
+            prune_events()
+            purge_expired_otps()
+            purge_expired_sessions()
+            purge_expired_idempotency_keys()
+            with _sweeper_stats_lock:
+                SWEEPER_STATS['runs'] += 1
+                SWEEPER_STATS['promoted_total'] += promoted
+                SWEEPER_STATS['last_promoted'] = promoted
+                SWEEPER_STATS['last_run_at'] = started
+                SWEEPER_STATS['last_duration_ms'] = round((time.time() - started) * 1000, 2)
+                SWEEPER_STATS['last_error'] = None
+            return promoted
+        except Exception as e:
+            with _sweeper_stats_lock:
+                SWEEPER_STATS['last_error'] = str(e)
+            print(f"❌ Sweeper error: {e}")
+            return 0
+
+def _sweeper_loop(interval):
+    while not _sweeper_stop.is_set():
+        run_sweeper_once()
+        _sweeper_stop.wait(interval)
+
+def start_sweeper(interval=None):
+    global _sweeper_thread
+    if _sweeper_thread is not None and _sweeper_thread.is_alive():
+        return _sweeper_thread
+    _sweeper_stop.clear()
+    _sweeper_thread = threading.Thread(
+        target=_sweeper_loop, args=(interval or SWEEPER_INTERVAL_SECONDS,),
+        name='overdue-sweeper', daemon=True
+    )
+    _sweeper_thread.start()
+    return _sweeper_thread
+
+def stop_sweeper():
+    _sweeper_stop.set()
+    if _sweeper_thread is not None:
+        _sweeper_thread.join(timeout=5)
     try:
-        cursor.execute("SELECT COUNT(id) FROM submissions")
-        total_submissions = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(id) FROM submissions WHERE status = 'pending'")
-        pending_approvals = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(id) FROM submissions WHERE status = 'alert'")
-        active_alerts = cursor.fetchone()[0]
-        yesterday_ts = now_ts - ONE_DAY_SECONDS
-        cursor.execute("SELECT COUNT(id) FROM submissions WHERE status = 'approved' AND approvedAt > ?", (yesterday_ts,))
-        approved_today = cursor.fetchone()[0]
-        return {
-            'total_submissions': total_submissions,
-            'pending_approvals': pending_approvals,
-            'active_alerts': active_alerts,
-            'approved_today': approved_today
-        }
+        release_lease(SWEEPER_LEASE_NAME, get_worker_id())
     except Exception as e:
-        print(f"Error calculating summary: {e}")
-        return None
+        print(f"Error releasing sweeper lease: {e}")
 
-def get_recent_activity(count=5):
-    db = get_db()
-    cursor = db.cursor()
+def get_sweeper_status():
+    with _sweeper_stats_lock:
+        stats = dict(SWEEPER_STATS)
+    stats['mode'] = SWEEPER_MODE
+    stats['interval_seconds'] = SWEEPER_INTERVAL_SECONDS
+    stats['worker_id'] = get_worker_id()
+    db = get_read_db()
+    lease = db.execute("SELECT owner, expires_at FROM service_leases WHERE name = ?", (SWEEPER_LEASE_NAME,)).fetchone()
+    stats['lease'] = dict(lease) if lease else None
+    return stats
+
+def start_background_services():
+    """Called once per worker process (see gunicorn.conf.py and the __main__ block)."""
+    if MIGRATE_ON_STARTUP:
+        with app.app_context():
+            run_migrations(get_db())
+    load_form_registry()
+    start_activity_flusher()
+    start_event_dispatcher()
+    if SWEEPER_MODE == 'thread':
+        start_sweeper()
+    if EMAIL_WORKER_MODE == 'thread':
+        start_email_workers()
+
+def stop_background_services():
+    if SWEEPER_MODE == 'thread':
+        stop_sweeper()
+    if EMAIL_WORKER_MODE == 'thread':
+        stop_email_workers()
+    stop_event_dispatcher()
+    stop_llm_executor()
+    stop_activity_flusher()
+    close_db_connections()
+
+@app.cli.command('sweep')
+@click.option('--loop', is_flag=True, help='Keep sweeping on an interval instead of running once.')
+@click.option('--interval', default=SWEEPER_INTERVAL_SECONDS, show_default=True, help='Seconds between sweeps with --loop.')
+@click.option('--force', is_flag=True, help='Sweep even if another process holds the lease.')
+def sweep_command(loop, interval, force):
+    """Promote overdue 'activity' submissions to 'pending'."""
+    with app.app_context():
+        run_migrations(get_db())
+    if not loop:
+        promoted = run_sweeper_once(force=force)
+        click.echo(f"Promoted {promoted} submission(s) to pending. Leader: {SWEEPER_STATS['is_leader']}")
+        return
+    click.echo(f"Sweeper running every {interval}s as {get_worker_id()} (Ctrl+C to stop).")
     try:
-        cursor.execute("SELECT timestamp, event, description FROM activities ORDER BY timestamp DESC LIMIT ?", (count,))
-        activities = []
-        for row in cursor.fetchall():
-            timestamp_dt = datetime.fromtimestamp(row['timestamp'])
-            activities.append({
-                'timestamp': timestamp_dt.isoformat(), 
-                'action': row['event'],
-                'details': row['description']
-            })
-        return activities
-    except Exception as e:
-        print(f"Error fetching activities: {e}")
-        return None
+        while True:
+            promoted = run_sweeper_once(force=force)
+            if promoted:
+                click.echo(f"Promoted {promoted} submission(s) to pending.")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        stop_sweeper()
 
 # -------------------------------------------------------------------------------------
-# 3. FLASK ROUTES (Unified OTP Login)
+# 2c. OUTBOUND EMAIL QUEUE (Outbox + Worker Pool)
 # -------------------------------------------------------------------------------------
+# Request handlers call enqueue_email() inside their own transaction, so a notification
+# exists exactly when the change it describes was committed, and the request returns
+# without touching SMTP. Delivery threads claim queued rows in batches, send each batch
+# over one SMTP connection (kept open while there is more work), and retry failures with
+# exponential backoff. Claims expire, so rows held by a crashed worker are picked up again.
 
-@app.before_request
-def check_pending_forms_on_request():
-    if request.path.startswith('/api/') or request.path == '/dashboard' or request.path == '/':
-        check_and_move_to_pending()
-        
-def generate_otp():
-    """Generates a random 6-digit numeric OTP."""
-    return str(random.randint(100000, 999999))
+EMAIL_STATS = {'sent': 0, 'retried': 0, 'failed': 0, 'batches': 0, 'connections': 0, 'last_error': None}
+_email_stats_lock = threading.Lock()
+_email_wakeup = threading.Event()
+_email_stop = threading.Event()
+_email_threads = []
 
-@app.route('/api/send_otp', methods=['POST'])
-def send_otp():
-    import time
-    data = request.get_json()
-    email = data.get('email', '').strip()
+def enqueue_email(db, recipient, subject, body, ref=None):
+    """Queues a message in the caller's transaction. Returns the outbox id."""
+    now = time.time()
+    cursor = db.execute("""
+        INSERT INTO email_outbox (recipient, subject, body, ref, status, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, 'queued', ?, ?)
+    """, (recipient, subject, body, ref, now, now))
+    return cursor.lastrowid
 
-    if not email:
-        return jsonify({'success': False, 'message': 'Email is required.'}), 400
+def enqueue_emails(db, messages):
+    """Queues many (recipient, subject, body, ref) messages in one executemany."""
+    now = time.time()
+    db.executemany("""
+        INSERT INTO email_outbox (recipient, subject, body, ref, status, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, 'queued', ?, ?)
+    """, [(recipient, subject, body, ref, now, now) for recipient, subject, body, ref in messages])
 
-    db = get_db()
-    cursor = db.cursor()
-    # Check if the email is a registered user (either reviewer or submitter)
-    cursor.execute("SELECT role FROM users WHERE username = ?", (email,))
-    user_record = cursor.fetchone()
-    cursor.close()
+def notify_email_workers():
+    """Call after committing enqueued mail so local workers skip their poll delay."""
+    _email_wakeup.set()
 
-    if not user_record:
-        log_activity(f"OTP Attempt Failed: {email}", "Email not registered in the system.", "AUTH_FAIL")
-        return jsonify({'success': False, 'message': 'Access denied. Email not recognized.'}), 403
+def _bump_email_stats(**deltas):
+    with _email_stats_lock:
+        for key, value in deltas.items():
+            EMAIL_STATS[key] = EMAIL_STATS[key] + value if isinstance(value, int) else value
 
-    otp_code = generate_otp()
-    current_time = time.time()
-    
-    try:
+def claim_email_batch(limit=EMAIL_BATCH_SIZE):
+    """Atomically marks up to `limit` due messages as 'sending' for this worker and returns them."""
+    now = time.time()
+    claim_token = f"{get_worker_id()}:{uuid.uuid4().hex[:8]}"
+    with db_writer() as db:
         db.execute("""
-            INSERT OR REPLACE INTO otp_store (email, otp, timestamp) 
-            VALUES (?, ?, ?)
-        """, (email, otp_code, current_time))
-        db.commit()
-    except Exception as e:
-        log_activity(f"OTP DB Error for {email}", f"Failed to store OTP: {e}", "ERROR")
-        return jsonify({'success': False, 'message': 'Server database error.'}), 500
+            UPDATE email_outbox SET status = 'sending', claimed_by = ?, claim_expires_at = ?, attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM email_outbox WHERE status = 'queued' AND next_attempt_at <= ?
+                UNION ALL
+                SELECT id FROM email_outbox WHERE status = 'sending' AND claim_expires_at < ?
+                LIMIT ?
+            )
+        """, (claim_token, now + EMAIL_CLAIM_SECONDS, now, now, limit))
+        return db.execute("""
+            SELECT id, recipient, subject, body, attempts FROM email_outbox
+            WHERE claimed_by = ? AND status = 'sending' ORDER BY id
+        """, (claim_token,)).fetchall()
 
-    role_name = "HOI Dashboard Admin" if user_record['role'] == 'reviewer' else "Form Submitter"
-    
-    email_subject = f"Your {role_name} Login OTP"
-    email_body = (
-        f"Dear User,\n\n"
-        f"Your One-Time Password (OTP) for {role_name} login is: {otp_code}\n"
-        f"This code is valid for 120 seconds.\n\n"
-        f"Do not share this OTP with anyone."
-    )
-    
-    if not send_notification_email(recipient=email, subject=email_subject, body=email_body):
-        return jsonify({'success': False, 'message': 'Failed to send OTP email. Check server logs.'}), 500
+def mark_email_sent(db, outbox_id):
+    db.execute("UPDATE email_outbox SET status = 'sent', sent_at = ?, last_error = NULL, claimed_by = NULL WHERE id = ?",
+               (time.time(), outbox_id))
 
-    log_activity(f"OTP Sent to {email}", f"OTP stored successfully for {role_name}.", "AUTH")
-    return jsonify({'success': True, 'message': 'OTP sent successfully.'})
+def mark_email_failed(db, outbox_id, attempts, error):
+    """Schedules a retry with exponential backoff, or gives up after EMAIL_MAX_ATTEMPTS."""
+    if attempts >= EMAIL_MAX_ATTEMPTS:
+        db.execute("UPDATE email_outbox SET status = 'failed', last_error = ?, claimed_by = NULL WHERE id = ?",
+                   (str(error), outbox_id))
+        _bump_email_stats(failed=1, last_error=str(error))
+        return
+    delay = EMAIL_RETRY_BASE_SECONDS * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+    db.execute("""
+        UPDATE email_outbox SET status = 'queued', next_attempt_at = ?, last_error = ?, claimed_by = NULL
+        WHERE id = ?
+    """, (time.time() + delay, str(error), outbox_id))
+    _bump_email_stats(retried=1, last_error=str(error))
 
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    import time 
-    error = request.args.get('error')
-    
-    if 'user' in session:
-        # Already logged in: Redirect based on existing session role
-        if session.get('role') == 'reviewer':
-            return redirect(url_for('dashboard'))
-        elif session.get('role') == 'submitter':
-            return redirect(url_for('submitter_dashboard'))
+def record_email_outcomes(outcomes):
+    """Marks [(row, error or None)] as sent or failed in one write transaction."""
+    with db_writer() as db:
+        for row, error in outcomes:
+            if error is None:
+                mark_email_sent(db, row['id'])
+            else:
+                mark_email_failed(db, row['id'], row['attempts'], error)
 
-    if request.method == 'POST':
-        # Unified Login form submission
-        submitted_otp = request.form.get('otp', '').strip()
-        submitted_email = request.form.get('email', '').strip() # Assuming the input is named 'email'
-        
-        if not submitted_otp or not submitted_email:
-            return render_template('login.html', error="Invalid login attempt or missing data.")
+def deliver_email_batch(connection, batch):
+    # SMTP round trips happen outside the write transaction; the results are recorded together.
+    outcomes = []
+    for row in batch:
+        try:
+            connection.send(Message(row['subject'], recipients=[row['recipient']], body=row['body']))
+            outcomes.append((row, None))
+            _bump_email_stats(sent=1)
+            print(f"✅ EMAIL SENT TO: {row['recipient']} (Subject: {row['subject']})")
+        except Exception as e:
+            outcomes.append((row, e))
+            print(f"❌ ERROR: Failed to send email to {row['recipient']}. SMTP Error: {e}")
+    record_email_outcomes(outcomes)
+    _bump_email_stats(batches=1)
 
-        db = get_db()
-        cursor = db.cursor()
-        
-        # 1. Check OTP validity
-        cursor.execute("SELECT otp, timestamp FROM otp_store WHERE email = ?", (submitted_email,))
-        otp_record = cursor.fetchone()
-        
-        if otp_record:
-            stored_otp = otp_record['otp']
-            stored_timestamp = otp_record['timestamp']
-            
-            if time.time() - stored_timestamp > 120:
-                log_activity(f"OTP Failed for {submitted_email}", "Expired OTP.", "AUTH_FAIL")
-                return render_template('login.html', error='OTP expired. Please request a new one.')
-            
-            elif submitted_otp == stored_otp:
-                
-                # 2. OTP SUCCESS: Fetch user role and form access
-                cursor.execute("SELECT role, form_access FROM users WHERE username = ?", (submitted_email,))
-                user_record = cursor.fetchone()
-                
-                if not user_record:
-                    log_activity(f"OTP Success but user missing: {submitted_email}", "OTP verified but user not found in 'users' table.", "AUTH_ERROR")
-                    return render_template('login.html', error='Authentication failed. User role not defined.')
-
-                # 3. Setup Session
-                session['user'] = submitted_email 
-                session['role'] = user_record['role'] 
-                session['form_access'] = user_record['form_access'] # Store the single assigned form
-                
-                db.execute("DELETE FROM otp_store WHERE email = ?", (submitted_email,))
-                db.commit()
-                log_activity(f"Login Success: {submitted_email}", f"Logged in as {session['role']} using OTP.", "AUTH")
-                
-                # 4. Redirect based on role
-                if session['role'] == 'reviewer':
-                    return redirect(url_for('dashboard')) # HOI Admin Dashboard
-                elif session['role'] == 'submitter':
-                    return redirect(url_for('submitter_dashboard')) # Submitter Dashboard
-                else:
-                    return render_template('login.html', error='Unknown user role.')
+def drain_email_outbox(max_batches=None):
+    """Delivers due messages until the queue is empty. Returns the number of batches sent."""
+    batches = 0
+    with app.app_context():
+        batch = claim_email_batch()
+        if not batch:
+            return 0
+        try:
+            with mail.connect() as connection:
+                _bump_email_stats(connections=1)
+                while batch:
+                    deliver_email_batch(connection, batch)
+                    batches += 1
+                    batch = None
+                    if _email_stop.is_set() or (max_batches and batches >= max_batches):
+                        break
+                    batch = claim_email_batch()
+        except Exception as e:
+            # Connecting failed: put the claimed rows back for a retry.
+            if batch:
+                record_email_outcomes([(row, e) for row in batch])
+            print(f"❌ ERROR: SMTP connection failed: {e}")
+    return batches
 
-            else:
-                log_activity(f"OTP Failed for {submitted_email}", "Incorrect OTP submitted.", "AUTH_FAIL")
-                return render_template('login.html', error='Incorrect OTP.')
-            
-        else:
-            return render_template('login.html', error='Invalid email or OTP request missing. Please send OTP first.')
+def _email_worker_loop():
+    while not _email_stop.is_set():
+        try:
+            if drain_email_outbox():
+                continue
+        except Exception as e:
+            _bump_email_stats(last_error=str(e))
+            print(f"❌ Email worker error: {e}")
+        _email_wakeup.wait(EMAIL_POLL_SECONDS)
+        _email_wakeup.clear()
 
-    # Default GET request
-    return render_template('login.html', error=error)
+def start_email_workers(count=None):
+    if any(thread.is_alive() for thread in _email_threads):
+        return
+    _email_stop.clear()
+    _email_threads.clear()
+    for index in range(count or EMAIL_WORKERS):
+        thread = threading.Thread(target=_email_worker_loop, name=f'email-worker-{index}', daemon=True)
+        thread.start()
+        _email_threads.append(thread)
 
-# -------------------------------------------------------------------------------------------------
+def stop_email_workers():
+    _email_stop.set()
+    _email_wakeup.set()
+    for thread in _email_threads:
+        thread.join(timeout=10)
 
-@app.route('/dashboard')
-def dashboard():
-    # Only reviewers can access the main dashboard
-    if 'user' not in session or session.get('role') != 'reviewer':
-        return redirect(url_for('index', error="HOI Admin Authentication Required"))
-    
-    return render_template('dashboard.html')
+def get_outbox_status(ref=None):
+    db = get_read_db()
+    with _email_stats_lock:
+        status = {'worker_stats': dict(EMAIL_STATS), 'workers': len([t for t in _email_threads if t.is_alive()])}
+    status['queue'] = {row['status']: row['count'] for row in
+                       db.execute("SELECT status, COUNT(*) AS count FROM email_outbox GROUP BY status")}
+    if ref:
+        status['messages'] = [dict(row) for row in db.execute("""
+            SELECT id, recipient, subject, status, attempts, created_at, sent_at, last_error
+            FROM email_outbox WHERE ref = ? ORDER BY id
+        """, (ref,))]
+    return status
 
-@app.route('/submitter_dashboard')
-def submitter_dashboard():
-    # Only submitters can access this dashboard
-    if 'user' not in session or session.get('role') != 'submitter':
-        return redirect(url_for('index', error="Form Submitter Authentication Required"))
+@app.cli.command('email-worker')
+@click.option('--once', is_flag=True, help='Deliver what is due and exit.')
+@click.option('--workers', default=EMAIL_WORKERS, show_default=True, help='Delivery threads.')
+def email_worker_command(once, workers):
+    """Deliver queued outbox email (use with EMAIL_WORKER_MODE=off on the web workers)."""
+    with app.app_context():
+        run_migrations(get_db())
+    if once:
+        click.echo(f"Delivered {drain_email_outbox()} batch(es). Stats: {EMAIL_STATS}")
+        return
+    start_email_workers(workers)
+    click.echo(f"{workers} email worker(s) running (Ctrl+C to stop).")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_email_workers()
 
-    # The key is to pass the SINGLE assigned form for the current user 
-    assigned_form_filename = session.get('form_access') 
-    
-    if not assigned_form_filename:
-        # Fallback if somehow the session variable is empty 
-        return render_template('submitter_dashboard.html', 
-                                user_email=session['user'],
-                                assigned_form='')
-    
-    # Render the template and pass the single form filename 
-    return render_template('submitter_dashboard.html', 
-                            user_email=session['user'],
-                            # ✅ CRITICAL: Pass the single form filename for the HTML to use
-                            assigned_form=assigned_form_filename) 
-    
+# --- SUMMARY ENGINE ---
+# Per-status counts live in submission_stats and are adjusted in the same transaction as
+# the write that changes a status, so a summary read never scans submissions. The only
+# time-windowed figure ('approved today') is an index range count on (status, approvedAt).
 
+_summary_cache = {'value': None, 'expires_at': 0.0}
+_summary_cache_lock = threading.Lock()
 
-@app.route('/logout')
-def logout():
-    log_activity("User Logout", f"User {session.get('user', 'Unknown')} ({session.get('role', 'Unknown')}) logged out.", "LOGOUT")
-    session.clear()
-    return redirect(url_for('index', error="You have been logged out."))
+def apply_status_deltas(db, deltas):
+    """Adjusts submission_stats by {status: delta}. Caller commits with its own write."""
+    db.executemany("""
+        INSERT INTO submission_stats (status, count) VALUES (?, ?)
+        ON CONFLICT(status) DO UPDATE SET count = count + excluded.count
+    """, [(status, delta) for status, delta in deltas.items() if delta])
 
-# --- API ROUTES (Data and Form Submissions) ---
-@app.route('/api/summary', methods=['GET'])
-def api_summary():
-    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
-    summary = get_submission_summary()
-    if summary is None:
-        return jsonify({'error': 'Could not fetch summary data.'}), 500
-    return jsonify(summary)
+def invalidate_summary_cache():
+    with _summary_cache_lock:
+        _summary_cache['expires_at'] = 0.0
 
-@app.route('/api/activity', methods=['GET'])
-def api_activity():
-    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
-    activities = get_recent_activity(count=10)
-    if activities is None:
-        return jsonify({'error': 'Could not fetch activity data.'}), 500
-    return jsonify({'activities': activities})
+def rebuild_submission_stats(db):
+    """Recounts submission_stats from submissions. Returns {status: (old, new)} for drifted rows."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        old = {row['status']: row['count'] for row in db.execute("SELECT status, count FROM submission_stats")}
+        new = {row['status']: row['count'] for row in db.execute("SELECT status, COUNT(*) AS count FROM submissions GROUP BY status")}
+        db.execute("DELETE FROM submission_stats")
+        db.executemany("INSERT INTO submission_stats (status, count) VALUES (?, ?)", new.items())
+        bump_cache_version(db, CACHE_SCOPE_SUBMISSIONS)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    invalidate_summary_cache()
+    return {status: (old.get(status, 0), new.get(status, 0))
+            for status in set(old) | set(new) if old.get(status, 0) != new.get(status, 0)}
 
-@app.route('/api/submissions', methods=['GET'])
-def get_submissions():
-    # Only HOI Admin gets all submissions
-    if session.get('role') == 'reviewer':
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute("SELECT id, form, user, subject, status, submittedAt, approvedAt FROM submissions ORDER BY submittedAt DESC") 
-        submissions_list = [dict(row) for row in cursor.fetchall()]
-        return jsonify(submissions_list)
-    
-    # Submitter gets only their submissions (security note from the original code)
-    # We return error 403 for submitter attempting to access all, forcing client-side logic to handle filtering.
-    return jsonify({'error': 'Unauthorized'}), 403 
-    
-@app.route('/api/submission/<submission_id>', methods=['GET'])
-def get_submission_details(submission_id):
-    # Both reviewers and submitters (for their own) need access to this endpoint
-    db = get_db()
+def get_submission_summary(use_cache=True):
+    now_ts = time.time()
+    if use_cache:
+        with _summary_cache_lock:
+            if _summary_cache['value'] is not None and now_ts < _summary_cache['expires_at']:
+                return dict(_summary_cache['value'])
+
+    db = get_read_db()
     cursor = db.cursor()
-    cursor.execute("SELECT * FROM submissions WHERE id = ?", (submission_id,)) 
-    submission = cursor.fetchone()
-    
-    if submission:
-        # Check authorization (Reviewer can see all, Submitter can see only their own)
-        if session.get('role') == 'submitter' and submission['user'] != session.get('user'):
-             return jsonify({'success': False, 'message': 'Unauthorized access to submission details.'}), 403
-             
-        submission_details = dict(submission)
-        return jsonify({'success': True, 'submission': submission_details})
-    else:
-        return jsonify({'success': False, 'message': 'Submission ID not found.'}), 404
+    try:
+        cursor.execute("SELECT status, count FROM submission_stats")
+        counts = {row['status']: row['count'] for row in cursor.fetchall()}
+        yesterday_ts = now_ts - ONE_DAY_SECONDS
+        cursor.execute("SELECT COUNT(*) FROM submissions WHERE status = 'approved' AND approvedAt > ?", (yesterday_ts,))
+        approved_today = cursor.fetchone()[0]
+        summary = {
+            'total_submissions': sum(counts.values()),
+            'pending_approvals': counts.get('pending', 0),
+            'active_alerts': counts.get('alert', 0),
+            'approved_today': approved_today,
+            'today_activity': counts.get('activity', 0),
+            'status_counts': counts,
+        }
+    except Exception as e:
+        print(f"Error calculating summary: {e}")
+        return None
 
-@app.route('/api/submit_form', methods=['POST'])
-def submit_form():
-    data = request.get_json()
-    db = get_db()
-    new_id = 'S' + str(uuid.uuid4())[:8].upper()
-    current_time = time.time()
-    
+    with _summary_cache_lock:
+        _summary_cache['value'] = summary
+        _summary_cache['expires_at'] = now_ts + SUMMARY_CACHE_TTL_SECONDS
+    return dict(summary)
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recount submission_stats from the submissions table."""
+    with app.app_context():
+        drift = rebuild_submission_stats(get_db())
+    if not drift:
+        click.echo("submission_stats already matched submissions.")
+    for status, (old, new) in sorted(drift.items()):
+        click.echo(f"{status}: {old} -> {new}")
+
+# --- RESPONSE CACHE ---
+# Reviewer tabs poll the same lists, so read APIs cache their JSON bodies keyed by path,
+# role (plus the user for submitters) and query string. Every entry records the version of
+# the data it was built from: writes bump cache_versions in their own transaction, and an
+# entry built from an older version is rebuilt on the next read, in every worker. Bodies
+# carry an ETag (a hash of the body), so a client whose copy is still current gets a 304.
+
+CACHE_SCOPE_SUBMISSIONS = 'submissions'
+CACHE_SCOPE_ACTIVITY = 'activity'
+CACHE_SCOPE_USERS = 'users'        # bumped by triggers on users (migration 14)
+CACHE_SCOPE_SESSIONS = 'sessions'  # bumped by triggers on sessions
+
+RESPONSE_CACHE_STATS = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'stale': 0, 'not_modified': 0,
+                        'uncacheable': 0, 'shared_errors': 0}
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+_shared_cache = threading.local()
+_shared_cache_writes = [0]
+
+def bump_cache_version(db, scope):
+    """Marks every cached response built from `scope` stale. Caller commits with its own write."""
+    db.execute("""
+        INSERT INTO cache_versions (scope, version) VALUES (?, 1)
+        ON CONFLICT(scope) DO UPDATE SET version = version + 1
+    """, (scope,))
+
+def get_cache_version(scope):
+    row = get_read_db().execute("SELECT version FROM cache_versions WHERE scope = ?", (scope,)).fetchone()
+    return row[0] if row else 0
+
+def response_cache_key():
+    role = session.get('role', '')
+    owner = '' if role == 'reviewer' else session.get('user', '')
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return f"{request.path}|{role}|{owner}|{query}"
+
+def shared_cache_db():
+    """This thread's connection to the shared cache file (reopened after a fork)."""
+    path = RESPONSE_CACHE_PATH or os.path.splitext(DATABASE)[0] + '_response_cache.db'
+    if getattr(_shared_cache, 'key', None) != (path, os.getpid()):
+        db = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        # Losing the cache file loses nothing, so it never waits on fsync.
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                etag TEXT NOT NULL,
+                body BLOB NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at)")
+        _shared_cache.key, _shared_cache.db = (path, os.getpid()), db
+    return _shared_cache.db
+
+def shared_cache_get(key):
+    try:
+        row = shared_cache_db().execute(
+            "SELECT version, etag, body, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        RESPONSE_CACHE_STATS['shared_errors'] += 1
+        print(f"Response cache read failed: {e}")
+        return None
+    if row is None:
+        return None
+    return {'version': row[0], 'etag': row[1], 'body': row[2], 'expires_at': row[3]}
+
+def shared_cache_put(key, entry):
+    try:
+        db = shared_cache_db()
+        db.execute("""
+            INSERT OR REPLACE INTO response_cache (key, version, etag, body, expires_at) VALUES (?, ?, ?, ?, ?)
+        """, (key, entry['version'], entry['etag'], entry['body'], entry['expires_at']))
+        _shared_cache_writes[0] += 1
+        if _shared_cache_writes[0] % 200 == 0:
+            db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+            db.execute("""
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (RESPONSE_CACHE_SHARED_MAX_ENTRIES,))
+    except sqlite3.Error as e:
+        RESPONSE_CACHE_STATS['shared_errors'] += 1
+        print(f"Response cache write failed: {e}")
+
+def response_cache_get(key, version):
+    """The cached entry for `key` if it was built from `version` and has not expired."""
+    now_ts = time.time()
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is not None:
+            _response_cache.move_to_end(key)
+    if entry is not None and entry['version'] == version and entry['expires_at'] > now_ts:
+        RESPONSE_CACHE_STATS['hits'] += 1
+        return entry
+    if RESPONSE_CACHE_BACKEND == 'sqlite':
+        shared = shared_cache_get(key)
+        if shared is not None and shared['version'] == version and shared['expires_at'] > now_ts:
+            RESPONSE_CACHE_STATS['shared_hits'] += 1
+            response_cache_put(key, shared, shared=False)
+            return shared
+    RESPONSE_CACHE_STATS['stale' if entry is not None else 'misses'] += 1
+    return None
+
+def response_cache_put(key, entry, shared=True):
+    with _response_cache_lock:
+        _response_cache[key] = entry
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last=False)
+    if shared and RESPONSE_CACHE_BACKEND == 'sqlite':
+        shared_cache_put(key, entry)
+
+def clear_response_cache():
+    with _response_cache_lock:
+        _response_cache.clear()
+
+def cached_json_response(scope, build, ttl=None):
+    """Serves build()'s JSON through the response cache, answering If-None-Match with 304.
+
+    build() returns the payload dict to serve (and cache), or a finished Flask response
+    (e.g. an error tuple), which is passed through uncached.
+    """
+    if RESPONSE_CACHE_BACKEND == 'off':
+        key, version, entry = None, None, None
+    else:
+        key, version = response_cache_key(), get_cache_version(scope)
+        entry = response_cache_get(key, version)
+    if entry is None:
+        payload = build()
+        if not isinstance(payload, dict):
+            return payload
+        body = jsonify(payload).get_data()
+        entry = {'version': version, 'etag': hashlib.sha256(body).hexdigest()[:20], 'body': body,
+                 'expires_at': time.time() + (RESPONSE_CACHE_TTL_SECONDS if ttl is None else ttl)}
+        if key is not None and len(body) <= RESPONSE_CACHE_MAX_BODY_BYTES:
+            response_cache_put(key, entry)
+        elif key is not None:
+            RESPONSE_CACHE_STATS['uncacheable'] += 1
+
+    if request.if_none_match and request.if_none_match.contains(entry['etag']):
+        response = app.response_class(status=304)
+        RESPONSE_CACHE_STATS['not_modified'] += 1
+    else:
+        response = app.response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    # Bodies depend on the session, so shared caches must not store them; browsers revalidate.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Cookie'
+    return response
+
+def get_response_cache_status():
+    with _response_cache_lock:
+        entries = len(_response_cache)
+    versions = {row['scope']: row['version'] for row in get_read_db().execute("SELECT scope, version FROM cache_versions")}
+    return {'backend': RESPONSE_CACHE_BACKEND, 'entries': entries, 'versions': versions,
+            'stats': dict(RESPONSE_CACHE_STATS)}
+
+# --- USER DIRECTORY & SERVER-SIDE SESSIONS ---
+# The session cookie holds a signed random id; the data is a row in sessions. Each worker
+# caches session rows and users (role, form access) in LRUs that are dropped when the
+# 'sessions' / 'users' cache version moves, so a request's auth costs one two-row version
+# read plus dict lookups. Role and forms are not stored in the session: they are
+# filled in from the directory when the session is opened, so a role change, a new form
+# grant, a deleted user or a deleted session row applies on the next request.
+
+SESSION_DERIVED_KEYS = ('role', 'forms')
+SESSION_STATS = {'session_hits': 0, 'session_misses': 0, 'session_touches': 0, 'directory_hits': 0,
+                 'directory_misses': 0, 'revoked_on_open': 0}
+_session_cache = OrderedDict()
+_user_directory = OrderedDict()
+_auth_cache_lock = threading.Lock()
+_auth_cache_versions = {CACHE_SCOPE_SESSIONS: None, CACHE_SCOPE_USERS: None}
+_DIRECTORY_MISSING = object()
+
+def _bump_session_stats(key):
+    with _auth_cache_lock:
+        SESSION_STATS[key] += 1
+
+def get_auth_versions():
+    """The users and sessions versions, read once per request."""
+    if has_request_context() and '_auth_versions' in g:
+        return g._auth_versions
+    versions = {CACHE_SCOPE_USERS: 0, CACHE_SCOPE_SESSIONS: 0}
+    for row in get_read_db().execute("SELECT scope, version FROM cache_versions WHERE scope IN (?, ?)",
+                                     (CACHE_SCOPE_USERS, CACHE_SCOPE_SESSIONS)):
+        versions[row['scope']] = row['version']
+    if has_request_context():
+        g._auth_versions = versions
+    return versions
+
+def _auth_cache_lookup(cache, scope, version, key):
+    """Returns the cached value for key (or None), first dropping the cache if `version` is new."""
+    with _auth_cache_lock:
+        if _auth_cache_versions[scope] != version:
+            cache.clear()
+            _auth_cache_versions[scope] = version
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+def _auth_cache_store(cache, scope, version, key, value, max_entries):
+    # A row read under an older version may already be stale; only cache it if nothing moved.
+    with _auth_cache_lock:
+        if _auth_cache_versions[scope] == version:
+            cache[key] = value
+            while len(cache) > max_entries:
+                cache.popitem(last=False)
+
+def get_directory_user(username):
+    """{'role', 'forms'} for a registered user, or None. forms is a frozenset of the form
+    templates the user may open (user_form_access)."""
+    if not username:
+        return None
+    version = get_auth_versions()[CACHE_SCOPE_USERS]
+    entry = _auth_cache_lookup(_user_directory, CACHE_SCOPE_USERS, version, username)
+    if entry is None:
+        _bump_session_stats('directory_misses')
+        db = get_read_db()
+        row = db.execute("SELECT role FROM users WHERE username = ?", (username,)).fetchone()
+        if row:
+            forms = frozenset(form for (form,) in db.execute("SELECT form FROM user_form_access WHERE username = ?", (username,)))
+            entry = {'role': row['role'], 'forms': forms}
+        else:
+            entry = _DIRECTORY_MISSING
+        _auth_cache_store(_user_directory, CACHE_SCOPE_USERS, version, username, entry, USER_DIRECTORY_MAX_ENTRIES)
+    else:
+        _bump_session_stats('directory_hits')
+    return None if entry is _DIRECTORY_MISSING else entry
+
+def can_open_form(username, form_name):
+    """True if `form_name` is one of the user's granted forms (a set lookup after the first call)."""
+    user = get_directory_user(username)
+    return user is not None and form_name in user['forms']
+
+def grant_forms(db, username, forms):
+    """Adds form grants in the caller's transaction."""
+    db.executemany("INSERT OR IGNORE INTO user_form_access (username, form) VALUES (?, ?)",
+                   [(username, form) for form in forms])
+
+def load_server_session(sid):
+    """The stored data of a live session, or None. Extends its expiry when due."""
+    now_ts = time.time()
+    version = get_auth_versions()[CACHE_SCOPE_SESSIONS]
+    entry = _auth_cache_lookup(_session_cache, CACHE_SCOPE_SESSIONS, version, sid)
+    # Another worker may have extended a session this one holds as expired.
+    if entry is None or entry['expires_at'] < now_ts:
+        _bump_session_stats('session_misses')
+        row = get_read_db().execute("SELECT data, expires_at, last_seen_at FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        if row is None or row['expires_at'] < now_ts:
+            return None
+        entry = {'data': json.loads(row['data']), 'expires_at': row['expires_at'], 'last_seen_at': row['last_seen_at']}
+        _auth_cache_store(_session_cache, CACHE_SCOPE_SESSIONS, version, sid, entry, SESSION_CACHE_MAX_ENTRIES)
+    else:
+        _bump_session_stats('session_hits')
+    if now_ts - entry['last_seen_at'] > SESSION_TOUCH_SECONDS:
+        with db_writer() as db:
+            db.execute("UPDATE sessions SET expires_at = ?, last_seen_at = ? WHERE sid = ?",
+                       (now_ts + SESSION_IDLE_SECONDS, now_ts, sid))
+        entry['expires_at'], entry['last_seen_at'] = now_ts + SESSION_IDLE_SECONDS, now_ts
+        _bump_session_stats('session_touches')
+    return dict(entry['data'])
+
+def store_server_session(db, sid, data):
+    """Inserts or replaces a session row in the caller's transaction. sid=None creates one;
+    returns the sid."""
+    now_ts = time.time()
+    stored = {key: value for key, value in data.items() if key not in SESSION_DERIVED_KEYS}
+    if sid is None:
+        sid = secrets.token_urlsafe(32)
+        db.execute("""
+            INSERT INTO sessions (sid, user, data, created_at, expires_at, last_seen_at) VALUES (?, ?, ?, ?, ?, ?)
+        """, (sid, stored.get('user'), json.dumps(stored), now_ts, now_ts + SESSION_IDLE_SECONDS, now_ts))
+    else:
+        db.execute("UPDATE sessions SET user = ?, data = ?, expires_at = ?, last_seen_at = ? WHERE sid = ?",
+                   (stored.get('user'), json.dumps(stored), now_ts + SESSION_IDLE_SECONDS, now_ts, sid))
+    return sid
+
+def revoke_user_sessions(username):
+    """Ends every session of `username` in every worker. Returns how many there were."""
+    with db_writer() as db:
+        return db.execute("DELETE FROM sessions WHERE user = ?", (username,)).rowcount
+
+def purge_expired_sessions():
+    """Sweeper job: deletes expired session rows in batches. Returns rows deleted."""
+    return _purge_in_batches("""
+        DELETE FROM sessions WHERE sid IN (SELECT sid FROM sessions WHERE expires_at < ? LIMIT ?)
+    """, time.time())
+
+@app.cli.command('revoke-sessions')
+@click.argument('username')
+def revoke_sessions_command(username):
+    """Log USERNAME out everywhere, effective on their next request."""
+    with app.app_context():
+        click.echo(f"Ended {revoke_user_sessions(username)} session(s) of {username}.")
+
+@app.cli.command('grant-forms')
+@click.argument('username')
+@click.argument('forms', nargs=-1, required=True)
+@click.option('--revoke', is_flag=True, help='Remove these grants instead.')
+def grant_forms_command(username, forms, revoke):
+    """Let USERNAME submit FORMS (e.g. budget.html purchase.html), effective on their next request."""
+    unknown = sorted(set(forms) - set(list_form_templates()))
+    if unknown and not revoke:
+        click.echo(f"Warning: no template for {', '.join(unknown)} in templates/forms/.")
+    with app.app_context():
+        with db_writer() as db:
+            if db.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is None:
+                raise click.ClickException(f"{username} is not a registered user.")
+            if revoke:
+                db.executemany("DELETE FROM user_form_access WHERE username = ? AND form = ?", [(username, form) for form in forms])
+            else:
+                grant_forms(db, username, forms)
+            granted = [form for (form,) in db.execute("SELECT form FROM user_form_access WHERE username = ? ORDER BY form", (username,))]
+    click.echo(f"{username} can submit: {', '.join(granted) or 'no forms'}")
+
+class ServerSession(SecureCookieSession):
+    """A session whose data lives in the sessions table under `sid`."""
+
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Moves the data to a new id on the next save and deletes the old row, so an id
+        planted in a browser before login is worthless afterwards."""
+        if self.sid is not None:
+            self.replaced_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+class ServerSessionInterface(SessionInterface):
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt='server-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return ServerSession()
+        try:
+            sid = self.signer(app).unsign(cookie).decode('ascii')
+        except BadSignature:
+            return ServerSession()
+        data = load_server_session(sid)
+        user = get_directory_user(data.get('user')) if data and data.get('user') else None
+        if data is None or (data.get('user') and user is None):
+            # Expired, revoked, or the user was removed: forget the cookie.
+            _bump_session_stats('revoked_on_open')
+            stale = ServerSession()
+            stale.modified = True
+            return stale
+        if user is not None:
+            data.update(role=user['role'], forms=sorted(user['forms']))
+        return ServerSession(data, sid=sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        partitioned = self.get_cookie_partitioned(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session.modified:
+            return
+        dropped = [sid for sid in (session.replaced_sid, None if session else session.sid) if sid is not None]
+        if session or dropped:
+            with db_writer() as db:
+                db.executemany("DELETE FROM sessions WHERE sid = ?", [(sid,) for sid in dropped])
+                if session:
+                    session.sid = store_server_session(db, session.sid, dict(session))
+        session.replaced_sid = None
+        if not session:
+            session.sid = None
+            response.delete_cookie(name, domain=domain, path=path, secure=secure, partitioned=partitioned,
+                                   samesite=samesite, httponly=httponly)
+        else:
+            response.set_cookie(name, self.signer(app).sign(session.sid).decode('ascii'),
+                                expires=self.get_expiration_time(app, session), httponly=httponly, domain=domain,
+                                path=path, secure=secure, partitioned=partitioned, samesite=samesite)
+        response.vary.add('Cookie')
+
+app.session_interface = ServerSessionInterface()
+
+def server_session_cookie(db, user):
+    """A Cookie header value for a new session of `user`, stored in the caller's transaction
+    (for benchmarks and scripts that call the API directly)."""
+    sid = store_server_session(db, None, {'user': user})
+    signed = ServerSessionInterface().signer(app).sign(sid).decode('ascii')
+    return f"{app.config['SESSION_COOKIE_NAME']}={signed}"
+
+def get_session_status():
+    with _auth_cache_lock:
+        status = dict(SESSION_STATS)
+        status.update(cached_sessions=len(_session_cache), cached_users=len(_user_directory),
+                      versions={scope: version for scope, version in _auth_cache_versions.items()})
+    db = get_read_db()
+    status['live_sessions'] = db.execute("SELECT COUNT(*) FROM sessions WHERE expires_at >= ?", (time.time(),)).fetchone()[0]
+    status['worker_id'] = get_worker_id()
+    return status
+
+# --- ANALYTICS ROLLUPS ---
+# Trends, review latency and backlog are served from pre-aggregated tables, so a year of
+# history is a few thousand rows rather than a scan of submissions. Every write path
+# passes (before, after) row states to apply_rollup_transitions in its own transaction;
+# a row's contribution is computed by one function (add_rollup_contribution) that is also
+# what rebuild_rollups replays, so incremental and rebuilt rollups cannot disagree.
+
+ROLLUP_GRAINS = [('hour', 3600), ('day', ONE_DAY_SECONDS)]
+ROLLUP_REVIEW_STATUSES = ('approved', 'disapproved', 'alert')
+ROLLUP_COUNTER_COLUMNS = ('submitted',) + ROLLUP_REVIEW_STATUSES + ('latency_sum',)
+LATENCY_BIN_BASE = 2 ** 0.25 # ~19% wide bins: percentiles are within ~10%
+LATENCY_PERCENTILES = (0.5, 0.9, 0.95, 0.99)
+
+def rollup_bucket(ts, size):
+    return ts - (ts + ANALYTICS_UTC_OFFSET_SECONDS) % size
+
+def latency_bin(seconds):
+    """Bin 0 is under a second; bin k covers [base**(k-1), base**k) seconds."""
+    return 0 if seconds < 1 else int(math.log(seconds, LATENCY_BIN_BASE)) + 1
+
+def latency_bin_value(bin_index):
+    return 0.5 if bin_index == 0 else LATENCY_BIN_BASE ** (bin_index - 0.5)
+
+def submission_institute(data):
+    institute = data.get('institute_id') or data.get('institute')
+    if institute is None:
+        return None
+    return str(institute).strip() or None
+
+def new_rollup_changes():
+    return {'rollups': {}, 'latency': {}, 'status': {}}
+
+def add_rollup_contribution(changes, row, sign):
+    """Adds (sign=1) or removes (sign=-1) what one submission row counts towards."""
+    form = row['form']
+    for grain, size in ROLLUP_GRAINS:
+        cell = changes['rollups'].setdefault((grain, rollup_bucket(row['submittedAt'], size), form), {})
+        cell['submitted'] = cell.get('submitted', 0) + sign
+    if row['status'] in ROLLUP_REVIEW_STATUSES and row['approvedAt']:
+        latency = max(0.0, row['approvedAt'] - row['submittedAt'])
+        for grain, size in ROLLUP_GRAINS:
+            cell = changes['rollups'].setdefault((grain, rollup_bucket(row['approvedAt'], size), form), {})
+            cell[row['status']] = cell.get(row['status'], 0) + sign
+            cell['latency_sum'] = cell.get('latency_sum', 0) + sign * latency
+        key = (rollup_bucket(row['approvedAt'], ONE_DAY_SECONDS), form, latency_bin(latency))
+        changes['latency'][key] = changes['latency'].get(key, 0) + sign
+    key = (form, row['institute'] or '', row['status'])
+    changes['status'][key] = changes['status'].get(key, 0) + sign
+
+def write_rollup_changes(db, changes):
+    db.executemany(f"""
+        INSERT INTO submission_rollups (grain, bucket_start, form, {', '.join(ROLLUP_COUNTER_COLUMNS)})
+        VALUES (?, ?, ?, {', '.join('?' for _ in ROLLUP_COUNTER_COLUMNS)})
+        ON CONFLICT(grain, bucket_start, form) DO UPDATE SET
+        {', '.join(f'{column} = {column} + excluded.{column}' for column in ROLLUP_COUNTER_COLUMNS)}
+    """, [(*key, *(cell.get(column, 0) for column in ROLLUP_COUNTER_COLUMNS))
+          for key, cell in changes['rollups'].items() if any(cell.values())])
+    db.executemany("""
+        INSERT INTO submission_latency_histogram (day_start, form, bin, count) VALUES (?, ?, ?, ?)
+        ON CONFLICT(day_start, form, bin) DO UPDATE SET count = count + excluded.count
+    """, [(*key, delta) for key, delta in changes['latency'].items() if delta])
+    db.executemany("""
+        INSERT INTO submission_status_rollup (form, institute, status, count) VALUES (?, ?, ?, ?)
+        ON CONFLICT(form, institute, status) DO UPDATE SET count = count + excluded.count
+    """, [(*key, delta) for key, delta in changes['status'].items() if delta])
+
+def apply_rollup_transitions(db, transitions):
+    """Applies [(before, after)] submission row states (None for a new row). Rows need
+    form, institute, status, submittedAt and approvedAt. Caller commits with its own write."""
+    changes = new_rollup_changes()
+    for before, after in transitions:
+        if before is not None:
+            add_rollup_contribution(changes, before, -1)
+        if after is not None:
+            add_rollup_contribution(changes, after, 1)
+    write_rollup_changes(db, changes)
+
+def populate_rollups(db, batch_size=50000):
+    """Recomputes every rollup from submissions inside the caller's transaction."""
+    for table in ('submission_rollups', 'submission_latency_histogram', 'submission_status_rollup'):
+        db.execute(f"DELETE FROM {table}")
+    changes = new_rollup_changes()
+    cursor = db.execute("SELECT form, institute, status, submittedAt, approvedAt FROM submissions")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            add_rollup_contribution(changes, row, 1)
+    write_rollup_changes(db, changes)
+    return {name: len(cells) for name, cells in changes.items()}
+
+def rebuild_rollups(db):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        counts = populate_rollups(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return counts
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the analytics rollups from the submissions table."""
+    started = time.time()
+    with app.app_context():
+        counts = rebuild_rollups(get_db())
+    click.echo(f"Rebuilt {counts['rollups']} counter, {counts['latency']} latency and "
+               f"{counts['status']} status rows in {time.time() - started:.1f}s.")
+
+def parse_analytics_range(args, max_days=None):
+    """since/until (epoch or ISO) defaulting to the last ANALYTICS_DEFAULT_DAYS days."""
+    until = parse_time_filter(args['until']) if args.get('until') else time.time()
+    since = parse_time_filter(args['since']) if args.get('since') else until - ANALYTICS_DEFAULT_DAYS * ONE_DAY_SECONDS
+    if since >= until:
+        raise ValueError('since must be before until.')
+    if max_days and until - since > max_days * ONE_DAY_SECONDS:
+        raise ValueError(f"At most {max_days} days at this grain.")
+    return since, until
+
+def period_start(day_start, grain):
+    """Start of the week (Monday) or month containing a day bucket."""
+    local = datetime.fromtimestamp(day_start + ANALYTICS_UTC_OFFSET_SECONDS, timezone.utc)
+    if grain == 'week':
+        local -= timedelta(days=local.weekday())
+    elif grain == 'month':
+        local = local.replace(day=1)
+    return local.timestamp() - ANALYTICS_UTC_OFFSET_SECONDS
+
+def bucket_label(bucket_start, grain):
+    local = datetime.fromtimestamp(bucket_start + ANALYTICS_UTC_OFFSET_SECONDS, timezone.utc)
+    return local.strftime('%Y-%m-%dT%H:00' if grain == 'hour' else '%Y-%m' if grain == 'month' else '%Y-%m-%d')
+
+def query_submission_trends(db, since, until, grain='day', form=None, by_form=True):
+    """Per-bucket counters (submitted, approved, disapproved, alert, reviewed, mean latency)."""
+    source_grain = 'hour' if grain == 'hour' else 'day'
+    form_column = "form" if by_form else "NULL"
+    sql = f"""
+        SELECT bucket_start, {form_column} AS form, {', '.join(f'SUM({column}) AS {column}' for column in ROLLUP_COUNTER_COLUMNS)}
+        FROM submission_rollups WHERE grain = ? AND bucket_start >= ? AND bucket_start < ?
+    """
+    params = [source_grain, rollup_bucket(since, 3600 if grain == 'hour' else ONE_DAY_SECONDS), until]
+    if form:
+        sql += " AND form = ?"
+        params.append(form)
+    buckets, period_starts = {}, {}
+    for row in db.execute(sql + f" GROUP BY bucket_start, {form_column}", params):
+        start = row['bucket_start']
+        if grain in ('week', 'month'):
+            if start not in period_starts:
+                period_starts[start] = period_start(start, grain)
+            start = period_starts[start]
+        cell = buckets.setdefault((start, row['form']), dict.fromkeys(ROLLUP_COUNTER_COLUMNS, 0))
+        for column in ROLLUP_COUNTER_COLUMNS:
+            cell[column] += row[column]
+    series = []
+    for (start, bucket_form), cell in sorted(buckets.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+        reviewed = sum(cell[status] for status in ROLLUP_REVIEW_STATUSES)
+        latency_sum = cell.pop('latency_sum')
+        series.append({'bucket': bucket_label(start, grain), 'bucket_start': start, 'form': bucket_form, **cell,
+                       'reviewed': reviewed, 'mean_latency_seconds': latency_sum / reviewed if reviewed else None})
+    return series
+
+def histogram_percentiles(bins, fractions=LATENCY_PERCENTILES):
+    total = sum(bins.values())
+    result = {f"p{round(fraction * 100)}_seconds": None for fraction in fractions}
+    if not total:
+        return result
+    ordered = sorted(bins.items())
+    for fraction in fractions:
+        running = 0
+        for bin_index, count in ordered:
+            running += count
+            if running >= fraction * total:
+                result[f"p{round(fraction * 100)}_seconds"] = round(latency_bin_value(bin_index), 1)
+                break
+    return result
+
+def query_review_latency(db, since, until, form=None, by_form=False):
+    """Submit-to-review latency percentiles for reviews made in [since, until)."""
+    sql = """
+        SELECT form, bin, SUM(count) AS count FROM submission_latency_histogram
+        WHERE day_start >= ? AND day_start < ?
+    """
+    params = [rollup_bucket(since, ONE_DAY_SECONDS), until]
+    if form:
+        sql += " AND form = ?"
+        params.append(form)
+    histograms = {}
+    for row in db.execute(sql + " GROUP BY form, bin", params):
+        bins = histograms.setdefault(row['form'] if by_form else None, {})
+        bins[row['bin']] = bins.get(row['bin'], 0) + row['count']
+    return [{'form': key, 'reviewed': sum(bins.values()), **histogram_percentiles(bins)}
+            for key, bins in sorted(histograms.items(), key=lambda item: item[0] or '')]
+
+def query_backlog(db, statuses=None, form=None):
+    """Current counts per (form, institute, status), plus totals by form and by institute."""
+    statuses = statuses or ANALYTICS_BACKLOG_STATUSES
+    sql = f"""
+        SELECT form, institute, status, count FROM submission_status_rollup
+        WHERE status IN ({', '.join('?' for _ in statuses)}) AND count > 0
+    """
+    params = list(statuses)
+    if form:
+        sql += " AND form = ?"
+        params.append(form)
+    rows = [dict(row) for row in db.execute(sql + " ORDER BY count DESC", params)]
+    by_form, by_institute = {}, {}
+    for row in rows:
+        by_form[row['form']] = by_form.get(row['form'], 0) + row['count']
+        by_institute[row['institute']] = by_institute.get(row['institute'], 0) + row['count']
+    return {'statuses': statuses, 'total': sum(by_form.values()), 'by_form': by_form,
+            'by_institute': by_institute, 'rows': rows}
+
+# --- FORM FIELD PROJECTION ---
+# submissions.data keeps the payload exactly as it was posted. Each field is also written to
+# submission_fields as (value_num, value_text), so filters and aggregates over form contents
+# ("hostel forms with impact = high risk", "sum of amount per institute") run in SQL instead
+# of parsing every blob in Python. Nested objects are flattened to dotted names.
+
+SUBMISSION_ENVELOPE_FIELDS = {'form_type', 'form_user', 'subject'} # already columns on submissions
+NUMERIC_TEXT_RE = re.compile(r'[-+]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?|[-+]?\.\d+')
+FIELD_FILTER_RE = re.compile(r'^\s*([^<>=!~]+?)\s*(>=|<=|!=|=|>|<|~)\s*(.*?)\s*$')
+FIELD_AGGREGATES = {'count': 'COUNT(*)', 'sum': 'SUM(v.value_num)', 'avg': 'AVG(v.value_num)',
+                    'min': 'MIN(v.value_num)', 'max': 'MAX(v.value_num)'}
+FIELD_GROUPS = {'form': 'form', 'status': 'status', 'user': 'user',
+                'day': "date(submittedAt, 'unixepoch')", 'month': "strftime('%Y-%m', submittedAt, 'unixepoch')"}
+
+def parse_numeric_text(text):
+    """'1,250.5' -> 1250.5; None for anything that is not a plain decimal number."""
+    return float(text.replace(',', '')) if NUMERIC_TEXT_RE.fullmatch(text) else None
+
+def field_value(value):
+    """Returns (value_num, value_text) for a scalar, or None for empty values."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return (1.0 if value else 0.0), ('true' if value else 'false')
+    if isinstance(value, (int, float)):
+        return (float(value) if value == value else None), str(value)
+    text = str(value).strip()[:SUBMISSION_FIELD_TEXT_MAX]
+    if not text:
+        return None
+    return parse_numeric_text(text), text
+
+def extract_submission_fields(data):
+    """Flattens a payload into {field: (value_num, value_text)}."""
+    fields = {}
+
+    def walk(value, name):
+        if len(fields) >= SUBMISSION_FIELDS_MAX_PER_SUBMISSION:
+            return
+        if isinstance(value, dict):
+            for key, item in value.items():
+                walk(item, f"{name}.{key}" if name else str(key))
+        elif isinstance(value, list) and any(isinstance(item, (dict, list)) for item in value):
+            for index, item in enumerate(value):
+                walk(item, f"{name}.{index}")
+        elif isinstance(value, list):
+            # Multi-select values (checkbox groups) are kept together; match them with '~'.
+            projected = field_value(', '.join(str(item) for item in value if item is not None))
+            if projected:
+                fields[name] = (None, projected[1])
+        else:
+            projected = field_value(value)
+            if projected:
+                fields[name] = projected
+
+    walk({key: item for key, item in data.items() if key not in SUBMISSION_ENVELOPE_FIELDS}, '')
+    return fields
+
+def project_submission_fields(db, submission_id, data):
+    """Writes submission_fields for one payload. Caller commits with its own write."""
+    return project_many_submission_fields(db, [(submission_id, data)])
+
+def project_many_submission_fields(db, submissions):
+    """Writes submission_fields for (submission_id, data) pairs in one executemany."""
+    rows = [(submission_id, field, value_num, value_text)
+            for submission_id, data in submissions
+            for field, (value_num, value_text) in extract_submission_fields(data).items()]
+    db.executemany("""
+        INSERT OR REPLACE INTO submission_fields (submission_id, field, value_num, value_text)
+        VALUES (?, ?, ?, ?)
+    """, rows)
+    return len(rows)
+
+def backfill_submission_fields(db, batch_size=SUBMISSION_FIELDS_BACKFILL_BATCH, rebuild=False, progress=None):
+    """Projects submissions that have no submission_fields rows yet (all of them with
+    rebuild=True). One short write transaction per batch, so it can run next to the app
+    and be interrupted and re-run at any point. Returns (submissions, fields) written."""
+    last_rowid, projected, written = 0, 0, 0
+    pending_only = "" if rebuild else \
+        "AND NOT EXISTS (SELECT 1 FROM submission_fields f WHERE f.submission_id = submissions.id)"
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(f"""
+                SELECT rowid, id, data FROM submissions WHERE rowid > ? {pending_only} ORDER BY rowid LIMIT ?
+            """, (last_rowid, batch_size)).fetchall()
+            for row in rows:
+                if rebuild:
+                    db.execute("DELETE FROM submission_fields WHERE submission_id = ?", (row['id'],))
+                try:
+                    data = json.loads(row['data'] or '{}')
+                except ValueError:
+                    continue
+                if isinstance(data, dict):
+                    written += project_submission_fields(db, row['id'], data)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        if not rows:
+            return projected, written
+        last_rowid = rows[-1]['rowid']
+        projected += len(rows)
+        if progress:
+            progress(projected, written)
+
+@app.cli.command('backfill-fields')
+@click.option('--batch-size', default=SUBMISSION_FIELDS_BACKFILL_BATCH, show_default=True, help='Submissions per transaction.')
+@click.option('--rebuild', is_flag=True, help='Re-project every submission, not only the missing ones.')
+def backfill_fields_command(batch_size, rebuild):
+    """Project submission payloads into submission_fields."""
+    started = time.time()
+    with app.app_context():
+        projected, written = backfill_submission_fields(
+            get_db(), batch_size, rebuild,
+            progress=lambda done, fields: click.echo(f"{done} submissions, {fields} fields ..."))
+    click.echo(f"Projected {projected} submission(s) into {written} field row(s) in {time.time() - started:.1f}s.")
+
+def parse_field_filter(expression):
+    """'impact=high risk' -> ('impact', '=', 'high risk', None); 'amount>=1000' -> (..., 1000.0).
+    Operators: = != < <= > >= and ~ (contains). Text comparisons ignore case."""
+    match = FIELD_FILTER_RE.match(expression)
+    if not match:
+        raise ValueError(f"Invalid field filter: {expression}")
+    field, op, value = match.groups()
+    number = parse_numeric_text(value)
+    if op in ('<', '<=', '>', '>=') and number is None:
+        raise ValueError(f"Field filter needs a number: {expression}")
+    return field, op, value, number
+
+def field_filter_sql(field, op, value, number):
+    """Correlated EXISTS on the (submission_id, field) key: cheap per candidate row, so the
+    outer query keeps walking the submissions index in list order and stops at the page limit."""
+    if op == '~':
+        escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        condition, param = "f.value_text LIKE ? ESCAPE '\\'", f"%{escaped}%"
+    elif number is not None:
+        condition, param = f"f.value_num {op} ?", number
+    else:
+        condition, param = f"f.value_text {op} ? COLLATE NOCASE", value
+    return (f"EXISTS (SELECT 1 FROM submission_fields f WHERE f.submission_id = submissions.id "
+            f"AND f.field = ? AND {condition})"), [field, param]
+
+def aggregate_submission_fields(db, filters, agg='count', field=None, group_by=None):
+    """Aggregates a numeric field over the filtered submissions, optionally grouped by a
+    submission column (form, status, user), a time bucket (day, month) or 'field:<name>'."""
+    if agg not in FIELD_AGGREGATES:
+        raise ValueError(f"Unknown aggregate: {agg}")
+    if agg != 'count' and not field:
+        raise ValueError(f"'{agg}' needs a field.")
+    clauses, params = build_submission_filter_sql(filters)
+    if filters.get('status'):
+        clauses.append(f"status IN ({', '.join('?' for _ in filters['status'])})")
+        params.extend(filters['status'])
+
+    joins, join_params = [], []
+    if agg != 'count':
+        joins.append("JOIN submission_fields v ON v.submission_id = submissions.id AND v.field = ? AND v.value_num IS NOT NULL")
+        join_params.append(field)
+    if not group_by:
+        group_expr = "NULL"
+    elif group_by.startswith('field:'):
+        joins.append("LEFT JOIN submission_fields g ON g.submission_id = submissions.id AND g.field = ?")
+        join_params.append(group_by[len('field:'):])
+        group_expr = "g.value_text"
+    elif group_by in FIELD_GROUPS:
+        group_expr = FIELD_GROUPS[group_by]
+    else:
+        raise ValueError(f"Unknown group_by: {group_by}")
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = db.execute(f"""
+        SELECT {group_expr} AS grp, {FIELD_AGGREGATES[agg]} AS value, COUNT(*) AS submissions
+        FROM submissions {' '.join(joins)} {where}
+        GROUP BY grp ORDER BY value DESC LIMIT ?
+    """, (*join_params, *params, SUBMISSION_AGGREGATE_MAX_GROUPS)).fetchall()
+    return [{'group': row['grp'], 'value': row['value'], 'submissions': row['submissions']}
+            for row in rows if row['submissions']]
+
+def list_submission_fields(db, form=None):
+    """Field catalogue: every projected field name with how many submissions carry it."""
+    if form:
+        rows = db.execute("""
+            SELECT f.field, COUNT(*) AS submissions, COUNT(f.value_num) AS numeric
+            FROM submissions JOIN submission_fields f ON f.submission_id = submissions.id
+            WHERE submissions.form = ? GROUP BY f.field ORDER BY f.field
+        """, (form,)).fetchall()
+    else:
+        rows = db.execute("""
+            SELECT field, COUNT(*) AS submissions, COUNT(value_num) AS numeric
+            FROM submission_fields GROUP BY field ORDER BY field
+        """).fetchall()
+    return [dict(row) for row in rows]
+
+# --- SUBMISSION LISTS (Keyset Pagination) ---
+# Pages are ordered newest first by (submittedAt, id). The cursor is the sort key of the
+# last row of the previous page, so fetching any page is one index seek regardless of
+# how deep into the history it is.
+
+SUBMISSION_LIST_COLUMNS = "id, form, user, subject, status, submittedAt, approvedAt"
+
+def encode_cursor(submitted_at, submission_id):
+    raw = json.dumps([submitted_at, submission_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        submitted_at, submission_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(submitted_at), str(submission_id)
+    except Exception:
+        raise ValueError('Invalid cursor.')
+
+def parse_time_filter(value):
+    """Accepts epoch seconds or an ISO date/datetime and returns epoch seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+
+def parse_submission_filters(args):
+    """Reads list filters from request args. Raises ValueError for malformed input."""
+    filters = {}
+    if args.get('status'):
+        filters['status'] = [status.strip() for status in args['status'].split(',') if status.strip()]
+    for key in ('form', 'user'):
+        if args.get(key):
+            filters[key] = args[key]
+    if args.get('since'):
+        filters['since'] = parse_time_filter(args['since'])
+    if args.get('until'):
+        filters['until'] = parse_time_filter(args['until'])
+    field_filters = [expression for expression in args.getlist('where') if expression.strip()]
+    if len(field_filters) > SUBMISSION_FIELD_FILTERS_MAX:
+        raise ValueError(f"At most {SUBMISSION_FIELD_FILTERS_MAX} field filters.")
+    if field_filters:
+        filters['fields'] = [parse_field_filter(expression) for expression in field_filters]
+    try:
+        limit = int(args.get('limit', SUBMISSIONS_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Invalid limit.')
+    limit = max(1, min(limit, SUBMISSIONS_MAX_PAGE_SIZE))
+    cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+    return filters, cursor, limit
+
+def build_submission_filter_sql(filters, cursor=None):
+    """WHERE clauses for every filter except status, which callers handle themselves."""
+    clauses, params = [], []
+    if filters.get('form'):
+        clauses.append("form = ?")
+        params.append(filters['form'])
+    if filters.get('user'):
+        clauses.append("user = ?")
+        params.append(filters['user'])
+    if filters.get('since') is not None:
+        clauses.append("submittedAt >= ?")
+        params.append(filters['since'])
+    if filters.get('until') is not None:
+        clauses.append("submittedAt < ?")
+        params.append(filters['until'])
+    for field_filter in filters.get('fields', ()):
+        clause, clause_params = field_filter_sql(*field_filter)
+        clauses.append(clause)
+        params.extend(clause_params)
+    if cursor:
+        clauses.append("(submittedAt, id) < (?, ?)")
+        params.extend(cursor)
+    return clauses, params
+
+def query_submissions_page(db, filters, cursor=None, limit=SUBMISSIONS_PAGE_SIZE, columns=SUBMISSION_LIST_COLUMNS):
+    """Returns (rows, next_cursor) for one page of submissions, newest first."""
+    clauses, params = build_submission_filter_sql(filters, cursor)
+    statuses = filters.get('status') or [None]
+
+    # One index seek per status, merged by SQLite. A plain `status IN (...)` with this
+    # ORDER BY makes the planner walk the whole submittedAt index instead.
+    branches, branch_params = [], []
+    for status in statuses:
+        branch_clauses = clauses + (["status = ?"] if status is not None else [])
+        where = f"WHERE {' AND '.join(branch_clauses)}" if branch_clauses else ""
+        branches.append(f"""
+            SELECT * FROM (SELECT {columns} FROM submissions {where}
+                           ORDER BY submittedAt DESC, id DESC LIMIT ?)""")
+        branch_params.extend(params + ([status] if status is not None else []) + [limit + 1])
+    sql = " UNION ALL ".join(branches) + " ORDER BY submittedAt DESC, id DESC LIMIT ?"
+    rows = db.execute(sql, (*branch_params, limit + 1)).fetchall()
+
+    page = [dict(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(page[-1]['submittedAt'], page[-1]['id']) if len(rows) > limit else None
+    return page, next_cursor
+
+def get_recent_activity(count=5):
+    db = get_read_db()
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT timestamp, event, description FROM activities ORDER BY timestamp DESC LIMIT ?", (count,))
+        activities = []
+        for row in cursor.fetchall():
+            timestamp_dt = datetime.fromtimestamp(row['timestamp'])
+            activities.append({
+                'timestamp': timestamp_dt.isoformat(), 
+                'action': row['event'],
+                'details': row['description']
+            })
+        return activities
+    except Exception as e:
+        print(f"Error fetching activities: {e}")
+        return None
+
+# --- SUBMISSION EXPORT (CSV / NDJSON / Parquet) ---
+# Exports are generators over one fetchmany cursor: each chunk of EXPORT_CHUNK_ROWS rows is
+# encoded and handed to the client before the next is read, so memory stays flat however
+# many rows match. Payload fields are flattened with the same rules as submission_fields
+# and appear as data.<field> columns; the CSV/Parquet header comes from the field catalogue.
+
+EXPORT_COLUMNS = ['id', 'form', 'user', 'subject', 'status', 'submittedAt', 'approvedAt', 'reviewedBy', 'remarks', 'institute']
+EXPORT_TIME_COLUMNS = ('submittedAt', 'approvedAt')
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+def export_field_columns(db, filters):
+    """[(field, all_numeric)] for the exported form, or for every form when unfiltered."""
+    catalogue = list_submission_fields(db, filters.get('form'))[:EXPORT_MAX_FIELD_COLUMNS]
+    return [(entry['field'], entry['numeric'] == entry['submissions']) for entry in catalogue]
+
+def export_query(filters, with_fields=False):
+    clauses, params = build_submission_filter_sql(filters)
+    if filters.get('status'):
+        clauses.append(f"status IN ({', '.join('?' for _ in filters['status'])})")
+        params.extend(filters['status'])
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    columns = ', '.join(EXPORT_COLUMNS + (['data'] if with_fields else []))
+    return f"SELECT {columns} FROM submissions {where} ORDER BY submittedAt, id", params
+
+def iter_export_chunks(cursor, stats=None):
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+        if not rows:
+            return
+        if stats is not None:
+            stats['rows'] = stats.get('rows', 0) + len(rows)
+        yield rows
+
+def export_payload_fields(row):
+    try:
+        data = json.loads(row['data'] or '{}')
+    except ValueError:
+        return {}
+    return extract_submission_fields(data) if isinstance(data, dict) else {}
+
+def export_iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec='seconds') if ts is not None else ''
+
+def export_csv(chunks, field_columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS + [f"data.{name}" for name, _ in field_columns])
+    yield buffer.getvalue().encode('utf-8')
+    time_indexes = [EXPORT_COLUMNS.index(column) for column in EXPORT_TIME_COLUMNS]
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        for row in rows:
+            values = list(row[:len(EXPORT_COLUMNS)])
+            for index in time_indexes:
+                values[index] = export_iso(values[index])
+            if field_columns:
+                fields = export_payload_fields(row)
+                values.extend(fields[name][1] if name in fields else '' for name, _ in field_columns)
+            writer.writerow(values)
+        yield buffer.getvalue().encode('utf-8')
+
+def export_ndjson(chunks, with_fields):
+    # Times stay epoch seconds, as in the JSON API. Every field of the row is included.
+    for rows in chunks:
+        lines = []
+        for row in rows:
+            record = {column: row[column] for column in EXPORT_COLUMNS}
+            if with_fields:
+                for name, (value_num, value_text) in export_payload_fields(row).items():
+                    record[f"data.{name}"] = value_num if value_num is not None else value_text
+            lines.append(json.dumps(record, ensure_ascii=False))
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+class _ExportSink:
+    """Write-only file object for ParquetWriter; drain() hands back what was written since."""
+    closed = False
+
+    def __init__(self):
+        self.parts, self.position = [], 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+def export_parquet(chunks, field_columns):
+    # Fields that are numeric in every submission become float64 columns, the rest strings.
+    timestamp = pyarrow.timestamp('ms', tz='UTC')
+    schema = pyarrow.schema(
+        [(column, timestamp if column in EXPORT_TIME_COLUMNS else pyarrow.string()) for column in EXPORT_COLUMNS] +
+        [(f"data.{name}", pyarrow.float64() if numeric else pyarrow.string()) for name, numeric in field_columns])
+    sink = _ExportSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    pending = {name: [] for name in schema.names}
+
+    def write_row_group():
+        writer.write_table(pyarrow.Table.from_pydict(pending, schema=schema))
+        for values in pending.values():
+            values.clear()
+
+    for rows in chunks:
+        for row in rows:
+            for column in EXPORT_COLUMNS:
+                value = row[column]
+                pending[column].append(round(value * 1000) if column in EXPORT_TIME_COLUMNS and value is not None else value)
+            if field_columns:
+                fields = export_payload_fields(row)
+                for name, numeric in field_columns:
+                    field = fields.get(name)
+                    pending[f"data.{name}"].append(None if field is None else field[0] if numeric else field[1])
+        if len(pending['id']) >= EXPORT_PARQUET_ROW_GROUP_ROWS:
+            write_row_group()
+            yield sink.drain()
+    if pending['id']:
+        write_row_group()
+    writer.close()
+    yield sink.drain()
+
+def export_submissions(filters, fmt='csv', with_fields=False, stats=None):
+    """Generator of encoded chunks. Holds one pooled read connection (and so one read
+    snapshot) until it is exhausted or closed, e.g. when the client disconnects."""
+    path, db = acquire_read_connection()
+    cursor = None
+    try:
+        field_columns = export_field_columns(db, filters) if with_fields and fmt != 'ndjson' else []
+        sql, params = export_query(filters, with_fields)
+        cursor = db.execute(sql, params)
+        chunks = iter_export_chunks(cursor, stats)
+        if fmt == 'csv':
+            encoded = export_csv(chunks, field_columns)
+        elif fmt == 'ndjson':
+            encoded = export_ndjson(chunks, with_fields)
+        else:
+            encoded = export_parquet(chunks, field_columns)
+        for data in encoded:
+            if data:
+                if stats is not None:
+                    stats['bytes'] = stats.get('bytes', 0) + len(data)
+                yield data
+    finally:
+        if cursor is not None:
+            cursor.close()
+        release_read_connection(path, db)
+
+def export_filename(fmt):
+    return f"submissions-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.{fmt}"
+
+@app.cli.command('export-submissions')
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--output', '-o', default='-', show_default=True, help="Output file ('-' for stdout).")
+@click.option('--fields', is_flag=True, help='Add the flattened payload fields as data.<field> columns.')
+@click.option('--status', help='Comma separated statuses.')
+@click.option('--form')
+@click.option('--user')
+@click.option('--since', help='Epoch seconds or ISO date.')
+@click.option('--until', help='Epoch seconds or ISO date.')
+@click.option('--where', multiple=True, help="Payload field filter, e.g. 'impact=high risk' (repeatable).")
+def export_submissions_command(fmt, output, fields, status, form, user, since, until, where):
+    """Stream submissions to a CSV, NDJSON or Parquet file."""
+    from werkzeug.datastructures import MultiDict
+    if fmt == 'parquet' and pyarrow is None:
+        raise click.ClickException('Parquet export needs pyarrow (pip install pyarrow).')
+    args = MultiDict([(key, value) for key, value in
+                      (('status', status), ('form', form), ('user', user), ('since', since), ('until', until)) if value])
+    for expression in where:
+        args.add('where', expression)
+    try:
+        filters, _, _ = parse_submission_filters(args)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    stats, started = {}, time.time()
+    with click.open_file(output, 'wb') as handle:
+        for data in export_submissions(filters, fmt, fields, stats):
+            handle.write(data)
+    click.echo(f"Exported {stats.get('rows', 0)} submission(s), {stats.get('bytes', 0) / 1e6:.1f} MB "
+               f"in {time.time() - started:.1f}s.", err=True)
+
+# --- FULL-TEXT SEARCH ---
+# submissions_fts (subject, remarks, payload values) and activities_fts (event, description)
+# are kept in sync by triggers, so every write path, including bulk loads, is indexed.
+# Queries are ranked by bm25 with subject > remarks > payload. A query matching more than
+# SEARCH_RANKED_MAX_MATCHES documents is answered newest first instead: FTS5 can stop after
+# one page in rowid order, whereas ranking has to score every match.
+
+SEARCH_SOURCES = {'submissions': 'submissions_fts', 'activities': 'activities_fts'}
+SNIPPET_OPEN, SNIPPET_CLOSE = '\x02', '\x03'
+
+def search_terms(text):
+    """Tokens as the index sees them: lower case, diacritics removed, split on punctuation."""
+    folded = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+    return re.findall(r'[^\W_]+', folded.lower())
+
+def build_fts_query(text, prefix=False):
+    """Plain words -> an FTS5 query that ANDs them, optionally matching the last word as a
+    prefix. Input is never passed through as FTS5 syntax."""
+    terms = search_terms(text)
+    if not terms:
+        raise ValueError('Search query has no words.')
+    parts = [f'"{term}"' for term in terms]
+    if prefix:
+        parts[-1] += ' *'
+    return ' '.join(parts), terms
+
+def count_search_matches(db, fts, query, cap):
+    """Matches up to cap + 1: walks at most that much of the doclists."""
+    return db.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM {fts} WHERE {fts} MATCH ? LIMIT ?)",
+                      (query, cap + 1)).fetchone()[0]
+
+def plan_search(db, fts, text, limit):
+    """Picks the query and order. Whole words first; if they find less than a page, the last
+    word is matched as a prefix too (search as you type). Trying whole words first matters:
+    a prefix of a common word makes FTS5 merge every matching doclist."""
+    query, terms = build_fts_query(text)
+    matches = count_search_matches(db, fts, query, SEARCH_RANKED_MAX_MATCHES)
+    prefix = matches < limit and len(terms[-1]) >= 2
+    if prefix:
+        query, _ = build_fts_query(text, prefix=True)
+        matches = count_search_matches(db, fts, query, SEARCH_RANKED_MAX_MATCHES)
+    ranked = matches <= SEARCH_RANKED_MAX_MATCHES
+    if ranked and len(terms) > 1:
+        whole_words = terms[:-1] if prefix else terms
+        ranked = all(count_search_matches(db, fts, f'"{term}"', SEARCH_RANKED_MAX_TERM_DOCS) <= SEARCH_RANKED_MAX_TERM_DOCS
+                     for term in dict.fromkeys(whole_words))
+    return query, ('rank' if ranked else 'recent'), matches
+
+def render_snippet(text):
+    """HTML-escapes an FTS snippet, then turns the match markers into <mark> tags."""
+    return html.escape(text or '').replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>')
+
+def encode_search_cursor(order, rank, rowid):
+    return base64.urlsafe_b64encode(json.dumps([order, rank, rowid]).encode('utf-8')).decode('ascii')
+
+def decode_search_cursor(cursor):
+    try:
+        order, rank, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(order), (float(rank) if rank is not None else None), int(rowid)
+    except Exception:
+        raise ValueError('Invalid cursor.')
+
+def run_search(db, source, text, select, joins='', clauses=(), params=(), cursor=None, limit=SEARCH_PAGE_SIZE):
+    """Shared paging for both indexes. Returns (rows, next_cursor, order, matches), where
+    matches is capped at SEARCH_RANKED_MAX_MATCHES + 1 and ignores the filters."""
+    fts = SEARCH_SOURCES[source]
+    query, order, matches = plan_search(db, fts, text, limit)
+    clauses, params = [f"{fts} MATCH ?", *clauses], [query, *params]
+    if cursor:
+        cursor_order, rank, rowid = decode_search_cursor(cursor)
+        order = cursor_order
+        if order == 'rank':
+            clauses.append(f"({fts}.rank, {fts}.rowid) > (?, ?)")
+            params.extend([rank, rowid])
+        else:
+            clauses.append(f"{fts}.rowid < ?")
+            params.append(rowid)
+    order_by = f"{fts}.rank, {fts}.rowid" if order == 'rank' else f"{fts}.rowid DESC"
+    # Only read rank when ordering by it: bm25 needs the document count of every term.
+    rank_column = f"{fts}.rank" if order == 'rank' else "NULL"
+    rows = db.execute(f"""
+        SELECT {select}, {rank_column} AS search_rank, {fts}.rowid AS search_rowid,
+               snippet({fts}, -1, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', {SEARCH_SNIPPET_TOKENS}) AS snippet
+        FROM {fts} {joins} WHERE {' AND '.join(clauses)} ORDER BY {order_by} LIMIT ?
+    """, (*params, limit + 1)).fetchall()
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = page[-1]
+        next_cursor = encode_search_cursor(order, last['search_rank'] if order == 'rank' else None, last['search_rowid'])
+    return page, next_cursor, order, matches
+
+def search_submissions(db, text, filters, cursor=None, limit=SEARCH_PAGE_SIZE):
+    clauses, params = build_submission_filter_sql(filters)
+    if filters.get('status'):
+        clauses.append(f"status IN ({', '.join('?' for _ in filters['status'])})")
+        params.extend(filters['status'])
+    columns = [column.strip() for column in SUBMISSION_LIST_COLUMNS.split(',')]
+    rows, next_cursor, order, matches = run_search(
+        db, 'submissions', text, ', '.join(f"submissions.{column} AS {column}" for column in columns),
+        "JOIN submissions ON submissions.rowid = submissions_fts.rowid", clauses, params, cursor, limit)
+    results = [dict({column: row[column] for column in columns}, snippet=render_snippet(row['snippet'])) for row in rows]
+    return results, next_cursor, order, matches
+
+def search_activities(db, text, cursor=None, limit=SEARCH_PAGE_SIZE):
+    rows, next_cursor, order, matches = run_search(
+        db, 'activities', text, "activities.id, activities.timestamp, activities.user, activities.event, activities.type",
+        "JOIN activities ON activities.id = activities_fts.rowid", cursor=cursor, limit=limit)
+    results = [{'id': row['id'], 'timestamp': row['timestamp'], 'user': row['user'], 'event': row['event'],
+                'type': row['type'], 'snippet': render_snippet(row['snippet'])} for row in rows]
+    return results, next_cursor, order, matches
+
+# -------------------------------------------------------------------------------------
+# 2d. LIVE EVENT STREAM (Server-Sent Events)
+# -------------------------------------------------------------------------------------
+# Write paths add rows to `events` in the same transaction as the change they describe.
+# One dispatcher thread per worker reads new rows by id and fans them out to the queues
+# of that worker's open /api/events streams, so connected dashboards cost one indexed
+# poll per worker instead of one full reload per browser. Reviewers receive every event;
+# submitters only the ones about their own submissions.
+
+EVENT_STATS = {'published': 0, 'delivered': 0, 'polls': 0, 'lagging_disconnects': 0, 'pruned': 0, 'last_error': None}
+_event_stats_lock = threading.Lock()
+_event_subscribers = {}  # id(subscriber) -> subscriber
+_event_subscribers_lock = threading.Lock()
+_event_wakeup = threading.Event()
+_event_stop = threading.Event()
+_event_thread = None
+_event_last_id = None  # highest event id this worker has fanned out
+
+def _bump_event_stats(**deltas):
+    with _event_stats_lock:
+        for key, value in deltas.items():
+            EVENT_STATS[key] = EVENT_STATS[key] + value if isinstance(value, int) else value
+
+def submission_event_payload(row):
+    return {column.strip(): row[column.strip()] for column in SUBMISSION_LIST_COLUMNS.split(',')}
+
+def submission_created_event(row):
+    return ('submission_created', submission_event_payload(row), row['user'])
+
+def status_changed_event(row, previous_status):
+    payload = submission_event_payload(row)
+    payload['previous_status'] = previous_status
+    return ('status_changed', payload, row['user'])
+
+def summary_delta_event(deltas):
+    """Counter changes for reviewer dashboards, mirroring apply_status_deltas()."""
+    return ('summary_delta', {'deltas': {status: delta for status, delta in deltas.items() if delta}}, None)
+
+def record_events(db, events):
+    """Adds (type, payload, user) events in the caller's transaction. Call
+    notify_event_dispatcher() after committing."""
+    now = time.time()
+    db.executemany("INSERT INTO events (type, user, payload, created_at) VALUES (?, ?, ?, ?)",
+                   [(event_type, user, json.dumps(payload), now) for event_type, payload, user in events])
+
+def notify_event_dispatcher():
+    """Skips the poll delay for this worker; other workers pick the events up on their next poll."""
+    _event_wakeup.set()
+
+def prune_events():
+    with db_writer() as db:
+        cursor = db.execute("DELETE FROM events WHERE created_at < ?", (time.time() - EVENT_RETENTION_SECONDS,))
+    if cursor.rowcount:
+        _bump_event_stats(pruned=cursor.rowcount)
+    return cursor.rowcount
+
+def event_visible_to(subscriber, event):
+    return subscriber['role'] == 'reviewer' or event['user'] == subscriber['user']
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {event['payload']}\n\n"
+
+def subscribe_events(user, role):
+    """Registers a stream. Returns None when this worker is at EVENT_MAX_SUBSCRIBERS."""
+    subscriber = {'user': user, 'role': role, 'queue': queue.Queue(maxsize=EVENT_QUEUE_SIZE), 'lagging': False}
+    with _event_subscribers_lock:
+        if len(_event_subscribers) >= EVENT_MAX_SUBSCRIBERS:
+            return None
+        _event_subscribers[id(subscriber)] = subscriber
+    return subscriber
+
+def unsubscribe_events(subscriber):
+    with _event_subscribers_lock:
+        _event_subscribers.pop(id(subscriber), None)
+
+def dispatch_events(rows):
+    """Queues each event for every local subscriber allowed to see it."""
+    with _event_subscribers_lock:
+        subscribers = list(_event_subscribers.values())
+    delivered = 0
+    for row in rows:
+        event = dict(row)
+        for subscriber in subscribers:
+            if subscriber['lagging'] or not event_visible_to(subscriber, event):
+                continue
+            try:
+                subscriber['queue'].put_nowait(event)
+                delivered += 1
+            except queue.Full:
+                # The stream ends once it has drained its queue; the browser reconnects with
+                # Last-Event-ID and catches up from the table instead.
+                subscriber['lagging'] = True
+                _bump_event_stats(lagging_disconnects=1)
+    _bump_event_stats(delivered=delivered)
+
+def poll_events_once(db):
+    """Fans out events committed since the previous poll. Returns how many were read."""
+    global _event_last_id
+    if _event_last_id is None:
+        _event_last_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+    rows = db.execute("""
+        SELECT id, type, user, payload FROM events WHERE id > ? ORDER BY id LIMIT 500
+    """, (_event_last_id,)).fetchall()
+    _bump_event_stats(polls=1)
+    if rows:
+        _event_last_id = rows[-1]['id']
+        dispatch_events(rows)
+        _bump_event_stats(published=len(rows))
+    return len(rows)
+
+def _event_dispatch_loop():
+    db = connect_db(read_only=True)
+    try:
+        while not _event_stop.is_set():
+            try:
+                if poll_events_once(db) == 500:
+                    continue
+            except Exception as e:
+                _bump_event_stats(last_error=str(e))
+                print(f"❌ Event dispatcher error: {e}")
+            _event_wakeup.wait(EVENT_POLL_SECONDS)
+            _event_wakeup.clear()
+    finally:
+        db.close()
+
+def start_event_dispatcher():
+    global _event_thread
+    if _event_thread is not None and _event_thread.is_alive():
+        return
+    _event_stop.clear()
+    _event_thread = threading.Thread(target=_event_dispatch_loop, name='event-dispatcher', daemon=True)
+    _event_thread.start()
+
+def stop_event_dispatcher():
+    _event_stop.set()
+    _event_wakeup.set()
+    with _event_subscribers_lock:
+        subscribers = list(_event_subscribers.values())
+    for subscriber in subscribers:
+        # Wake idle streams so they close instead of holding the worker until the next heartbeat.
+        subscriber['lagging'] = True
+        try:
+            subscriber['queue'].put_nowait(None)
+        except queue.Full:
+            pass
+    if _event_thread is not None:
+        _event_thread.join(timeout=5)
+
+def replay_events(db, subscriber, after_id):
+    """Events after `after_id` visible to the subscriber, or None if there are too many to replay."""
+    if subscriber['role'] == 'reviewer':
+        rows = db.execute("""
+            SELECT id, type, user, payload FROM events WHERE id > ? ORDER BY id LIMIT ?
+        """, (after_id, EVENT_REPLAY_LIMIT + 1)).fetchall()
+    else:
+        rows = db.execute("""
+            SELECT id, type, user, payload FROM events WHERE id > ? AND user = ? ORDER BY id LIMIT ?
+        """, (after_id, subscriber['user'], EVENT_REPLAY_LIMIT + 1)).fetchall()
+    return None if len(rows) > EVENT_REPLAY_LIMIT else [dict(row) for row in rows]
+
+def stream_events(subscriber, last_event_id=None):
+    """SSE generator for one client. The subscriber must be registered before replaying,
+    so nothing committed between the replay query and the first live event is lost."""
+    try:
+        yield f"retry: {EVENT_RETRY_MS}\n\n"
+        last_sent = 0
+        if last_event_id is not None:
+            path, db = acquire_read_connection()
+            try:
+                missed = replay_events(db, subscriber, last_event_id)
+                current_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+            finally:
+                release_read_connection(path, db)
+            if missed is None:
+                # Too far behind (or the events were pruned): tell the page to reload its data.
+                last_sent = current_id
+                yield format_sse({'id': current_id, 'type': 'resync', 'payload': json.dumps({'reason': 'replay_limit'})})
+            else:
+                last_sent = last_event_id
+                for event in missed:
+                    last_sent = event['id']
+                    yield format_sse(event)
+
+        while not _event_stop.is_set():
+            try:
+                event = subscriber['queue'].get(timeout=EVENT_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                if subscriber['lagging']:
+                    break
+                # Comment line: keeps proxies from timing out and detects closed sockets.
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                break
+            if event['id'] <= last_sent:
+                continue
+            last_sent = event['id']
+            yield format_sse(event)
+            if subscriber['lagging'] and subscriber['queue'].empty():
+                break
+    finally:
+        unsubscribe_events(subscriber)
+
+def get_event_stream_status():
+    with _event_stats_lock:
+        status = dict(EVENT_STATS)
+    with _event_subscribers_lock:
+        subscribers = list(_event_subscribers.values())
+    status['subscribers'] = len(subscribers)
+    status['max_subscribers'] = EVENT_MAX_SUBSCRIBERS
+    status['reviewer_subscribers'] = len([s for s in subscribers if s['role'] == 'reviewer'])
+    status['last_event_id'] = _event_last_id
+    status['dispatcher_running'] = _event_thread is not None and _event_thread.is_alive()
+    status['worker_id'] = get_worker_id()
+    return status
+
+# -------------------------------------------------------------------------------------
+# 3. FLASK ROUTES (Unified OTP Login)
+# -------------------------------------------------------------------------------------
+
+# --- OTP STORE ---
+# Codes are kept only as HMACs keyed with the app secret (a six-digit code is trivial to
+# brute-force from a plain hash). Issuing a code, charging the rate limits and queueing
+# the email happen in one write transaction, so /api/send_otp never waits on SMTP.
+
+OTP_EMAIL_REF = 'otp'  # email_outbox.ref of OTP mail, purged once the code has expired
+
+OTP_STATS = {'issued': 0, 'rate_limited': 0, 'verified': 0, 'rejected': 0, 'locked': 0, 'purged': 0}
+_otp_stats_lock = threading.Lock()
+
+def _bump_otp_stats(**deltas):
+    with _otp_stats_lock:
+        for key, value in deltas.items():
+            OTP_STATS[key] += value
+
+def generate_otp():
+    """Generates a random 6-digit numeric OTP."""
+    return f"{secrets.randbelow(1000000):06d}"
+
+def hash_otp(email, code):
+    return hmac.new(app.secret_key.encode(), f"{email}\0{code}".encode(), hashlib.sha256).hexdigest()
+
+def otp_client_ip():
+    if OTP_PROXY_HOPS > 0:
+        route = request.access_route
+        return route[-min(OTP_PROXY_HOPS, len(route))]
+    return request.remote_addr or 'unknown'
+
+def take_otp_tokens(db, buckets, now_ts):
+    """Spends one token from every (bucket, per_hour, burst) in the caller's transaction.
+    Spends nothing and returns the seconds until all have one if any bucket is empty."""
+    refilled, wait = [], 0
+    for bucket, per_hour, burst in buckets:
+        if per_hour <= 0:
+            continue
+        rate = per_hour / 3600
+        row = db.execute("SELECT tokens, updated_at FROM otp_rate_limits WHERE bucket = ?", (bucket,)).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + (now_ts - row[1]) * rate)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+        refilled.append((bucket, tokens - 1, now_ts))
+    if wait:
+        return wait
+    db.executemany("""
+        INSERT INTO otp_rate_limits (bucket, tokens, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(bucket) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+    """, refilled)
+    return 0
+
+def issue_otp(email, role_name, client_ip):
+    """Stores a fresh code for `email` and queues its email. Returns 0, or the seconds until
+    the email or IP bucket allows another send."""
+    now_ts = time.time()
+    code = generate_otp()
+    with db_writer() as db:
+        retry_after = take_otp_tokens(db, [
+            (f"email:{email}", OTP_EMAIL_RATE_PER_HOUR, OTP_EMAIL_RATE_BURST),
+            (f"ip:{client_ip}", OTP_IP_RATE_PER_HOUR, OTP_IP_RATE_BURST),
+        ], now_ts)
+        if retry_after:
+            return retry_after
+        db.execute("""
+            INSERT INTO otp_store (email, code_hash, expires_at, attempts, created_at) VALUES (?, ?, ?, 0, ?)
+            ON CONFLICT(email) DO UPDATE SET code_hash = excluded.code_hash, expires_at = excluded.expires_at,
+                attempts = 0, created_at = excluded.created_at
+        """, (email, hash_otp(email, code), now_ts + OTP_TTL_SECONDS, now_ts))
+        enqueue_email(db, email, f"Your {role_name} Login OTP", (
+            f"Dear User,\n\n"
+            f"Your One-Time Password (OTP) for {role_name} login is: {code}\n"
+            f"This code is valid for {OTP_TTL_SECONDS} seconds.\n\n"
+            f"Do not share this OTP with anyone."
+        ), ref=OTP_EMAIL_REF)
+    notify_email_workers()
+    _bump_otp_stats(issued=1)
+    return 0
+
+def verify_otp(email, code):
+    """Checks and consumes a code. Returns 'ok', 'missing', 'expired', 'incorrect' or
+    'locked' (too many wrong guesses; the code is discarded)."""
+    now_ts = time.time()
+    with db_writer() as db:
+        row = db.execute("SELECT code_hash, expires_at, attempts FROM otp_store WHERE email = ?", (email,)).fetchone()
+        if row is None:
+            result = 'missing'
+        elif row['expires_at'] < now_ts:
+            db.execute("DELETE FROM otp_store WHERE email = ?", (email,))
+            result = 'expired'
+        elif hmac.compare_digest(row['code_hash'], hash_otp(email, code)):
+            db.execute("DELETE FROM otp_store WHERE email = ?", (email,))
+            result = 'ok'
+        elif row['attempts'] + 1 >= OTP_MAX_ATTEMPTS:
+            db.execute("DELETE FROM otp_store WHERE email = ?", (email,))
+            result = 'locked'
+        else:
+            db.execute("UPDATE otp_store SET attempts = attempts + 1 WHERE email = ?", (email,))
+            result = 'incorrect'
+    _bump_otp_stats(**{'verified' if result == 'ok' else 'locked' if result == 'locked' else 'rejected': 1})
+    return result
+
+def _purge_in_batches(sql, *params):
+    total = 0
+    while True:
+        with db_writer() as db:
+            deleted = db.execute(sql, params + (OTP_PURGE_BATCH,)).rowcount
+        total += deleted
+        if deleted < OTP_PURGE_BATCH:
+            return total
+
+def purge_expired_otps():
+    """Sweeper job: expired codes, buckets that have refilled completely, and OTP mail whose
+    code has expired (it holds the code in plain text). Returns rows deleted."""
+    now_ts = time.time()
+    # A bucket idle this long is full again, which is what a missing row means.
+    idle_seconds = max([3600 * burst / rate for rate, burst in (
+        (OTP_EMAIL_RATE_PER_HOUR, OTP_EMAIL_RATE_BURST), (OTP_IP_RATE_PER_HOUR, OTP_IP_RATE_BURST)) if rate > 0] or [0])
+    purged = _purge_in_batches("""
+        DELETE FROM otp_store WHERE rowid IN (SELECT rowid FROM otp_store WHERE expires_at < ? LIMIT ?)
+    """, now_ts)
+    purged += _purge_in_batches("""
+        DELETE FROM otp_rate_limits WHERE bucket IN (
+            SELECT bucket FROM otp_rate_limits WHERE updated_at < ? LIMIT ?)
+    """, now_ts - idle_seconds)
+    purged += _purge_in_batches("""
+        DELETE FROM email_outbox WHERE id IN (
+            SELECT id FROM email_outbox WHERE ref = ? AND created_at < ? LIMIT ?)
+    """, OTP_EMAIL_REF, now_ts - OTP_TTL_SECONDS)
+    if purged:
+        _bump_otp_stats(purged=purged)
+    return purged
+
+def get_otp_status():
+    with _otp_stats_lock:
+        status = dict(OTP_STATS)
+    db = get_read_db()
+    now_ts = time.time()
+    status['outstanding'] = db.execute("SELECT COUNT(*) FROM otp_store WHERE expires_at >= ?", (now_ts,)).fetchone()[0]
+    status['expired_unpurged'] = db.execute("SELECT COUNT(*) FROM otp_store WHERE expires_at < ?", (now_ts,)).fetchone()[0]
+    status['rate_limit_buckets'] = db.execute("SELECT COUNT(*) FROM otp_rate_limits").fetchone()[0]
+    status['queued_mail'] = db.execute(
+        "SELECT COUNT(*) FROM email_outbox WHERE ref = ? AND status IN ('queued', 'sending')", (OTP_EMAIL_REF,)).fetchone()[0]
+    status['worker_id'] = get_worker_id()
+    return status
+
+@app.route('/api/send_otp', methods=['POST'])
+def send_otp():
+    data = request.get_json(silent=True) or {}
+    email = str(data.get('email') or '').strip()
+
+    if not email:
+        return jsonify({'success': False, 'message': 'Email is required.'}), 400
+
+    client_ip = otp_client_ip()
+    # Check if the email is a registered user (either reviewer or submitter)
+    user_record = get_directory_user(email)
+
+    try:
+        if not user_record:
+            # Probing for registered addresses still spends the IP's tokens.
+            with db_writer() as writer:
+                retry_after = take_otp_tokens(writer, [(f"ip:{client_ip}", OTP_IP_RATE_PER_HOUR, OTP_IP_RATE_BURST)], time.time())
+            if not retry_after:
+                log_activity(f"OTP Attempt Failed: {email}", "Email not registered in the system.", "AUTH_FAIL")
+                return jsonify({'success': False, 'message': 'Access denied. Email not recognized.'}), 403
+        else:
+            role_name = "HOI Dashboard Admin" if user_record['role'] == 'reviewer' else "Form Submitter"
+            retry_after = issue_otp(email, role_name, client_ip)
+    except Exception as e:
+        log_activity(f"OTP DB Error for {email}", f"Failed to store OTP: {e}", "ERROR")
+        return jsonify({'success': False, 'message': 'Server database error.'}), 500
+
+    if retry_after:
+        _bump_otp_stats(rate_limited=1)
+        log_activity(f"OTP Rate Limited: {email}", f"Too many OTP requests from {client_ip}.", "AUTH_FAIL")
+        response = jsonify({'success': False, 'message': 'Too many OTP requests. Please wait a few minutes and try again.'})
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response, 429
+
+    log_activity(f"OTP Sent to {email}", f"OTP issued and queued for delivery ({role_name}).", "AUTH")
+    return jsonify({'success': True, 'message': 'OTP sent successfully.'})
+
+@app.route('/', methods=['GET', 'POST'])
+def index():
+    error = request.args.get('error')
+    
+    if 'user' in session:
+        # Already logged in: Redirect based on existing session role
+        if session.get('role') == 'reviewer':
+            return redirect(url_for('dashboard'))
+        elif session.get('role') == 'submitter':
+            return redirect(url_for('submitter_dashboard'))
+
+    if request.method == 'POST':
+        # Unified Login form submission
+        submitted_otp = request.form.get('otp', '').strip()
+        submitted_email = request.form.get('email', '').strip() # Assuming the input is named 'email'
+        
+        if not submitted_otp or not submitted_email:
+            return render_template('login.html', error="Invalid login attempt or missing data.")
+
+        # 1. Check OTP validity (a correct code is consumed)
+        result = verify_otp(submitted_email, submitted_otp)
+        
+        if result == 'missing':
+            return render_template('login.html', error='Invalid email or OTP request missing. Please send OTP first.')
+        elif result == 'expired':
+            log_activity(f"OTP Failed for {submitted_email}", "Expired OTP.", "AUTH_FAIL")
+            return render_template('login.html', error='OTP expired. Please request a new one.')
+        elif result == 'locked':
+            log_activity(f"OTP Failed for {submitted_email}", "Too many incorrect OTPs; code discarded.", "AUTH_FAIL")
+            return render_template('login.html', error='Too many incorrect attempts. Please request a new OTP.')
+        elif result != 'ok':
+            log_activity(f"OTP Failed for {submitted_email}", "Incorrect OTP submitted.", "AUTH_FAIL")
+            return render_template('login.html', error='Incorrect OTP.')
+
+        # 2. OTP SUCCESS: Fetch user role and form access
+        user_record = get_directory_user(submitted_email)
+        
+        if not user_record:
+            log_activity(f"OTP Success but user missing: {submitted_email}", "OTP verified but user not found in 'users' table.", "AUTH_ERROR")
+            return render_template('login.html', error='Authentication failed. User role not defined.')
+
+        # 3. Setup Session (a fresh session id; role and form access are re-read from the
+        # user directory on every request, these two only serve the redirect below)
+        session.regenerate()
+        session['user'] = submitted_email 
+        session['role'] = user_record['role'] 
+        session['forms'] = sorted(user_record['forms'])
+        log_activity(f"Login Success: {submitted_email}", f"Logged in as {session['role']} using OTP.", "AUTH")
+        
+        # 4. Redirect based on role
+        if session['role'] == 'reviewer':
+            return redirect(url_for('dashboard')) # HOI Admin Dashboard
+        elif session['role'] == 'submitter':
+            return redirect(url_for('submitter_dashboard')) # Submitter Dashboard
+        else:
+            return render_template('login.html', error='Unknown user role.')
+
+    # Default GET request
+    return render_template('login.html', error=error)
+
+# -------------------------------------------------------------------------------------------------
+
+@app.route('/dashboard')
+def dashboard():
+    # Only reviewers can access the main dashboard
+    if 'user' not in session or session.get('role') != 'reviewer':
+        return redirect(url_for('index', error="HOI Admin Authentication Required"))
+    
+    return render_template('dashboard.html')
+
+@app.route('/submitter_dashboard')
+def submitter_dashboard():
+    # Only submitters can access this dashboard
+    if 'user' not in session or session.get('role') != 'submitter':
+        return redirect(url_for('index', error="Form Submitter Authentication Required"))
+
+    # Every form granted to this user (user_form_access), rendered into the page so the
+    # forms list needs no further request. An empty list shows the "no form assigned" note.
+    return render_template('submitter_dashboard.html', 
+                            user_email=session['user'],
+                            assigned_forms=session.get('forms', [])) 
+    
+
+
+@app.route('/logout')
+def logout():
+    log_activity("User Logout", f"User {session.get('user', 'Unknown')} ({session.get('role', 'Unknown')}) logged out.", "LOGOUT")
+    session.clear()
+    return redirect(url_for('index', error="You have been logged out."))
+
+# --- API ROUTES (Data and Form Submissions) ---
+@app.route('/api/summary', methods=['GET'])
+def api_summary():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    def build():
+        summary = get_submission_summary()
+        if summary is None:
+            return jsonify({'error': 'Could not fetch summary data.'}), 500
+        return summary
+    # 'approved_today' is a sliding window, so the summary also expires with its own TTL.
+    return cached_json_response(CACHE_SCOPE_SUBMISSIONS, build, ttl=SUMMARY_CACHE_TTL_SECONDS)
+
+@app.route('/api/activity', methods=['GET'])
+def api_activity():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    def build():
+        activities = get_recent_activity(count=10)
+        if activities is None:
+            return jsonify({'error': 'Could not fetch activity data.'}), 500
+        return {'activities': activities}
+    return cached_json_response(CACHE_SCOPE_ACTIVITY, build)
+
+@app.route('/api/sweeper_status', methods=['GET'])
+def api_sweeper_status():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_sweeper_status())
+
+@app.route('/api/outbox_status', methods=['GET'])
+def api_outbox_status():
+    # Optional ?ref=<submission_id> lists the delivery status of that submission's emails.
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_outbox_status(request.args.get('ref')))
+
+@app.route('/api/form_registry_status', methods=['GET'])
+def api_form_registry_status():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_form_registry_status())
+
+@app.route('/api/submission_schema_status', methods=['GET'])
+def api_submission_schema_status():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_submission_schema_status())
+
+@app.route('/api/event_stream_status', methods=['GET'])
+def api_event_stream_status():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_event_stream_status())
+
+@app.route('/api/llm_status', methods=['GET'])
+def api_llm_status():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_llm_status())
+
+@app.route('/api/otp_status', methods=['GET'])
+def api_otp_status():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_otp_status())
+
+@app.route('/api/session_status', methods=['GET'])
+def api_session_status():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_session_status())
+
+@app.route('/api/response_cache_status', methods=['GET'])
+def api_response_cache_status():
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(get_response_cache_status())
+
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    # Live dashboard updates as text/event-stream: submission_created, status_changed and
+    # (reviewers only) summary_delta. Browsers resend the last id they saw in the
+    # Last-Event-ID header when they reconnect; ?last_event_id= does the same explicitly.
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({'error': 'Invalid Last-Event-ID.'}), 400
+
+    subscriber = subscribe_events(session['user'], session.get('role'))
+    if subscriber is None:
+        return jsonify({'error': 'Too many live connections on this worker.'}), 503, {'Retry-After': '10'}
+    start_event_dispatcher()
+    return Response(stream_events(subscriber, last_event_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/submissions', methods=['GET'])
+def get_submissions():
+    # Only HOI Admin can list everyone's submissions; submitters use /api/my_submissions.
+    # Query args: status (comma separated), form, user, since, until, limit, cursor, and
+    # where=<field><op><value> (repeatable; ops = != < <= > >= ~) over payload fields.
+    if session.get('role') != 'reviewer':
+        return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        filters, cursor, limit = parse_submission_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    def build():
+        page, next_cursor = query_submissions_page(get_read_db(), filters, cursor, limit)
+        return {'submissions': page, 'next_cursor': next_cursor}
+    return cached_json_response(CACHE_SCOPE_SUBMISSIONS, build)
+
+@app.route('/api/my_submissions', methods=['GET'])
+def get_my_submissions():
+    # Same filters as /api/submissions, always scoped to the logged-in user.
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        filters, cursor, limit = parse_submission_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    filters['user'] = session['user']
+    def build():
+        page, next_cursor = query_submissions_page(get_read_db(), filters, cursor, limit)
+        return {'submissions': page, 'next_cursor': next_cursor}
+    return cached_json_response(CACHE_SCOPE_SUBMISSIONS, build)
+    
+@app.route('/api/submission/<submission_id>', methods=['GET'])
+def get_submission_details(submission_id):
+    # Both reviewers and submitters (for their own) need access to this endpoint
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    user = session['user']
+    directory_user = get_directory_user(user)
+    if directory_user is None:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    def build():
+        db = get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT * FROM submissions WHERE id = ?", (submission_id,)) 
+        submission = cursor.fetchone()
+        
+        if submission:
+            # Check authorization (Reviewer can see all, anyone else only their own)
+            if directory_user['role'] != 'reviewer' and submission['user'] != user:
+                 return jsonify({'success': False, 'message': 'Unauthorized access to submission details.'}), 403
+                 
+            submission_details = dict(submission)
+            return {'success': True, 'submission': submission_details}
+        else:
+            return jsonify({'success': False, 'message': 'Submission ID not found.'}), 404
+    return cached_json_response(CACHE_SCOPE_SUBMISSIONS, build)
+
+@app.route('/api/submission_fields', methods=['GET'])
+def api_submission_fields():
+    # Which payload fields exist (optionally for one form) and how many are numeric.
+    if session.get('role') != 'reviewer':
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'fields': list_submission_fields(get_read_db(), request.args.get('form'))})
+
+@app.route('/api/submission_fields/aggregate', methods=['GET'])
+def api_submission_fields_aggregate():
+    # Query args: agg (count|sum|avg|min|max), field, group_by (form|status|user|day|month|
+    # field:<name>) plus every /api/submissions filter, e.g.
+    # ?form=budget.html&agg=sum&field=amount&group_by=field:institute_id&where=impact=high risk
+    if session.get('role') != 'reviewer':
+        return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        filters, _, _ = parse_submission_filters(request.args)
+        agg = request.args.get('agg', 'count')
+        groups = aggregate_submission_fields(get_read_db(), filters, agg, request.args.get('field'),
+                                             request.args.get('group_by'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'agg': agg, 'field': request.args.get('field'), 'group_by': request.args.get('group_by'),
+                    'groups': groups})
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    # Query args: q, in (submissions|activities), limit, cursor, and for submissions the
+    # /api/submissions filters. Submitters only search their own submissions.
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    source = request.args.get('in', 'submissions')
+    if source not in SEARCH_SOURCES:
+        return jsonify({'error': f'Unknown search source: {source}'}), 400
+    if source == 'activities' and session.get('role') != 'reviewer':
+        return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        try:
+            limit = max(1, min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE))
+        except ValueError:
+            raise ValueError('Invalid limit.')
+        cursor = request.args.get('cursor')
+        if source == 'activities':
+            results, next_cursor, order, matches = search_activities(get_read_db(), request.args.get('q', ''), cursor, limit)
+        else:
+            args = request.args.copy()
+            args.pop('cursor', None) # a search cursor, not a list cursor
+            filters, _, _ = parse_submission_filters(args)
+            if session.get('role') != 'reviewer':
+                filters['user'] = session['user']
+            results, next_cursor, order, matches = search_submissions(get_read_db(), request.args.get('q', ''), filters, cursor, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results, 'next_cursor': next_cursor, 'order': order, 'matches': matches,
+                    'matches_capped': matches > SEARCH_RANKED_MAX_MATCHES})
+
+@app.route('/api/export/submissions', methods=['GET'])
+def api_export_submissions():
+    # Streams every matching submission (no paging). Query args: format (csv|ndjson|parquet),
+    # fields=1 for data.<field> columns, and the /api/submissions filters.
+    if session.get('role') != 'reviewer':
+        return jsonify({'error': 'Unauthorized'}), 403
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unknown format: {fmt}'}), 400
+    if fmt == 'parquet' and pyarrow is None:
+        return jsonify({'error': 'Parquet export is not available on this server.'}), 400
+    try:
+        filters, _, _ = parse_submission_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    log_activity("Export", f"{session.get('user')} exported submissions as {fmt}.", "EXPORT")
+    return Response(export_submissions(filters, fmt, request.args.get('fields') == '1'),
+                    mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{export_filename(fmt)}"',
+                             'Cache-Control': 'no-store'})
+
+# --- ANALYTICS (served from the rollup tables) ---
+@app.route('/api/analytics/trends', methods=['GET'])
+def api_analytics_trends():
+    # Query args: grain (hour|day|week|month), since, until (default last 30 days),
+    # form, by_form (default 1). Hourly ranges are capped at ANALYTICS_HOURLY_MAX_DAYS.
+    if session.get('role') != 'reviewer':
+        return jsonify({'error': 'Unauthorized'}), 403
+    grain = request.args.get('grain', 'day')
+    if grain not in ('hour', 'day', 'week', 'month'):
+        return jsonify({'error': f'Unknown grain: {grain}'}), 400
+    try:
+        since, until = parse_analytics_range(request.args, ANALYTICS_HOURLY_MAX_DAYS if grain == 'hour' else None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    series = query_submission_trends(get_read_db(), since, until, grain, request.args.get('form'),
+                                     request.args.get('by_form', '1') != '0')
+    return jsonify({'grain': grain, 'since': since, 'until': until, 'series': series})
+
+@app.route('/api/analytics/latency', methods=['GET'])
+def api_analytics_latency():
+    # Review latency (approvedAt - submittedAt) percentiles. Query args: since, until, form, by_form (default 0).
+    if session.get('role') != 'reviewer':
+        return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        since, until = parse_analytics_range(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    latency = query_review_latency(get_read_db(), since, until, request.args.get('form'),
+                                   request.args.get('by_form', '0') != '0')
+    return jsonify({'since': since, 'until': until, 'latency': latency})
+
+@app.route('/api/analytics/backlog', methods=['GET'])
+def api_analytics_backlog():
+    # Open submissions by form and institute. Query args: status (comma separated, default activity,pending), form.
+    if session.get('role') != 'reviewer':
+        return jsonify({'error': 'Unauthorized'}), 403
+    statuses = [status.strip() for status in request.args.get('status', '').split(',') if status.strip()]
+    return jsonify(query_backlog(get_read_db(), statuses, request.args.get('form')))
+
+# --- SUBMISSION IDS & IDEMPOTENCY ---
+# Submission ids are 'S' + a ULID: 48 bits of milliseconds then 80 random bits in Crockford
+# base32. They sort in creation order (new rows land at the right edge of the primary key
+# index) and cannot realistically collide. Within one millisecond a process increments the
+# random part, so its ids stay strictly increasing.
+
+CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_ulid_lock = threading.Lock()
+_ulid_last = [0, 0]  # [milliseconds, random part] of the last id issued by this process
+
+def new_ulid():
+    with _ulid_lock:
+        ms = int(time.time() * 1000)
+        if ms <= _ulid_last[0]:
+            ms, randomness = _ulid_last[0], _ulid_last[1] + 1
+            if randomness >= 1 << 80:
+                ms, randomness = ms + 1, 0
+        else:
+            randomness = int.from_bytes(secrets.token_bytes(10), 'big')
+        _ulid_last[:] = [ms, randomness]
+    value = (ms << 80) | randomness
+    return ''.join(CROCKFORD_BASE32[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+def new_submission_id():
+    return 'S' + new_ulid()
+
+def submission_idempotency_key(data, client_key):
+    """(key, request_hash, ttl) identifying this submission, or (None, request_hash, 0) when
+    it should never be deduplicated."""
+    form_user = str(data.get('form_user', ''))
+    request_hash = hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
+    if client_key:
+        key = hashlib.sha256(f"{form_user}\0{client_key}".encode('utf-8')).hexdigest()
+        return f"key:{key}", request_hash, IDEMPOTENCY_KEY_TTL_SECONDS
+    if SUBMISSION_DEDUP_WINDOW_SECONDS <= 0:
+        return None, request_hash, 0
+    return f"content:{request_hash}", request_hash, SUBMISSION_DEDUP_WINDOW_SECONDS
+
+def find_idempotent_response(db, key, now_ts):
+    """The stored row for a live key, read inside the caller's write transaction."""
+    if key is None:
+        return None
+    return db.execute("SELECT request_hash, response FROM submission_idempotency WHERE key = ? AND expires_at > ?",
+                      (key, now_ts)).fetchone()
+
+def record_idempotent_response(db, key, request_hash, submission_id, response, ttl, now_ts):
+    if key is not None:
+        db.execute("""
+            INSERT OR REPLACE INTO submission_idempotency (key, request_hash, submission_id, response, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (key, request_hash, submission_id, json.dumps(response), now_ts, now_ts + ttl))
+
+def purge_expired_idempotency_keys():
+    """Sweeper job: deletes expired keys in batches. Returns rows deleted."""
+    return _purge_in_batches("""
+        DELETE FROM submission_idempotency WHERE key IN (
+            SELECT key FROM submission_idempotency WHERE expires_at < ? LIMIT ?)
+    """, time.time())
+
+@app.route('/api/submit_form', methods=['POST'])
+def submit_form():
+    if request.content_length is not None and request.content_length > SUBMISSION_MAX_BYTES:
+        return jsonify({'success': False, 'message': f'Submission is larger than {SUBMISSION_MAX_BYTES} bytes.'}), 413
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Expected a JSON object.'}), 400
+    data, errors = apply_submission_schema(data)
+    if errors:
+        return jsonify({'success': False, 'message': f"Invalid submission: {errors[0]}", 'errors': errors}), 400
+    client_key = request.headers.get('Idempotency-Key', '').strip()
+    if len(client_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return jsonify({'success': False, 'message': f'Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters.'}), 400
+    idempotency_key, request_hash, idempotency_ttl = submission_idempotency_key(data, client_key)
+    new_id = new_submission_id()
+    current_time = time.time()
+    
     # *** IMPORTANT: Extracting data from the client-side POST request ***
     # The client-side code will send the form_type, form_user, and subject
     form_type = data.get('form_type', 'Unknown Form')
     form_user_email = data.get('form_user', 'no-reply@hoi.com') 
     form_subject = data.get('subject', f'Submission from {form_type}')
     form_data = json.dumps(data) 
+    institute = submission_institute(data)
     
+    response_body = {'success': True, 'message': 'Form submitted to Today Activity.', 'id': new_id}
     try:
-        db.execute("""
-            INSERT INTO submissions (id, form, user, subject, data, status, submittedAt)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (new_id, form_type, form_user_email, form_subject, form_data, 'activity', current_time))
-        db.commit()
+        with db_writer() as db:
+            # The write lock is held from here on, so two repeats can never both insert.
+            previous = find_idempotent_response(db, idempotency_key, current_time)
+            if previous is not None:
+                if previous['request_hash'] != request_hash:
+                    return jsonify({'success': False, 'message': 'Idempotency-Key was already used for a different submission.'}), 422
+                response = jsonify(json.loads(previous['response']))
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            db.execute("""
+                INSERT INTO submissions (id, form, user, subject, data, status, submittedAt, institute)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (new_id, form_type, form_user_email, form_subject, form_data, 'activity', current_time, institute))
+            record_idempotent_response(db, idempotency_key, request_hash, new_id, response_body, idempotency_ttl, current_time)
+            project_submission_fields(db, new_id, data)
+            apply_status_deltas(db, {'activity': 1})
+            bump_cache_version(db, CACHE_SCOPE_SUBMISSIONS)
+            apply_rollup_transitions(db, [(None, {'form': form_type, 'institute': institute, 'status': 'activity',
+                                                  'submittedAt': current_time, 'approvedAt': None})])
+            record_events(db, [
+                submission_created_event({'id': new_id, 'form': form_type, 'user': form_user_email, 'subject': form_subject,
+                                          'status': 'activity', 'submittedAt': current_time, 'approvedAt': None}),
+                summary_delta_event({'activity': 1}),
+            ])
+        invalidate_summary_cache()
+        notify_event_dispatcher()
         
         log_activity(f"Form Submit: {form_type}", f"New submission by {form_user_email}.", "FORM_SUBMIT")
         
-        return jsonify({'success': True, 'message': 'Form submitted to Today Activity.', 'id': new_id})
+        return jsonify(response_body)
         
     except Exception as e:
-        db.rollback()
         log_activity(f"Form Submit Failed: {form_type}", f"Database error: {e}", "ERROR")
         return jsonify({'success': False, 'message': f'Database error: {e}'}), 500
 
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-seq')
+
+def read_batch_submission_items():
+    """(items, error message, status) from the request body: a JSON array, {"items": [...]},
+    or NDJSON (one object per line, read from the stream as it arrives). An NDJSON line that
+    does not parse becomes a ValueError entry so it fails alone instead of failing the batch.
+    Bodies over BATCH_SUBMIT_MAX_BYTES are refused before (or while) they are read."""
+    too_large = f'A batch is limited to {BATCH_SUBMIT_MAX_BYTES} bytes.'
+    if request.content_length is not None and request.content_length > BATCH_SUBMIT_MAX_BYTES:
+        return None, too_large, 413
+    # Also bounds bodies sent without a Content-Length (chunked).
+    request.max_content_length = BATCH_SUBMIT_MAX_BYTES
+    items = []
+    try:
+        if request.mimetype in NDJSON_MIMETYPES:
+            received = 0
+            # The raw request stream reads lines a byte at a time; buffer it.
+            for line in io.BufferedReader(request.stream, 65536):
+                received += len(line)
+                if received > BATCH_SUBMIT_MAX_BYTES:
+                    return None, too_large, 413
+                line = line.strip()
+                if not line:
+                    continue
+                if len(items) >= BATCH_SUBMIT_MAX_ITEMS:
+                    return None, f'At most {BATCH_SUBMIT_MAX_ITEMS} items per batch.', 400
+                try:
+                    items.append(json.loads(line))
+                except ValueError as e:
+                    items.append(ValueError(f'Invalid JSON: {e}'))
+        else:
+            data = request.get_json(silent=True)
+            items = data.get('items') if isinstance(data, dict) else data
+            if not isinstance(items, list):
+                return None, 'Expected a JSON array, {"items": [...]}, or NDJSON.', 400
+            if len(items) > BATCH_SUBMIT_MAX_ITEMS:
+                return None, f'At most {BATCH_SUBMIT_MAX_ITEMS} items per batch.', 400
+    except RequestEntityTooLarge:
+        return None, too_large, 413
+    if not items:
+        return None, 'No items to submit.', 400
+    return items, None, 200
+
+def check_batch_submission(item, user, role):
+    """Error message for one batch entry, or None. Submitters may only file their own forms."""
+    if isinstance(item, ValueError):
+        return str(item)
+    if not isinstance(item, dict):
+        return 'Expected a JSON object.'
+    form_type = item.get('form_type')
+    if not isinstance(form_type, str) or not form_type.strip():
+        return 'Missing form_type'
+    if role != 'reviewer':
+        if item.get('form_user', user) != user:
+            return 'form_user must be the signed-in user'
+        if not can_open_form(user, form_type):
+            return f'No access to {form_type}'
+    return None
+
+@app.route('/api/submit_forms_batch', methods=['POST'])
+def submit_forms_batch():
+    """Files many submissions in one transaction.
+
+    Body: a JSON array of submit_form payloads, {"items": [...]}, or NDJSON
+    (Content-Type: application/x-ndjson). Returns one result per entry, in request order;
+    invalid entries are reported and skipped, the rest are inserted together.
+    """
+    user, role = session.get('user'), session.get('role')
+    if not user:
+        return jsonify({'error': 'Unauthorized'}), 403
+    client_key = request.headers.get('Idempotency-Key', '').strip()
+    if len(client_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return jsonify({'success': False, 'message': f'Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters.'}), 400
+    items, error, status = read_batch_submission_items()
+    if error:
+        return jsonify({'success': False, 'message': error}), status
+
+    current_time = time.time()
+    results, rows, projections, transitions, events = [], [], [], [], []
+    for index, item in enumerate(items):
+        error = check_batch_submission(item, user, role)
+        if not error:
+            item, errors = apply_submission_schema(item)
+            error = errors and f"Invalid submission: {'; '.join(errors)}"
+        if error:
+            results.append({'index': index, 'success': False, 'message': error})
+            continue
+        new_id = new_submission_id()
+        form_type = item['form_type']
+        form_user_email = item.get('form_user', user if role != 'reviewer' else 'no-reply@hoi.com')
+        form_subject = item.get('subject', f'Submission from {form_type}')
+        institute = submission_institute(item)
+        rows.append((new_id, form_type, form_user_email, form_subject, json.dumps(item), 'activity', current_time, institute))
+        projections.append((new_id, item))
+        transitions.append((None, {'form': form_type, 'institute': institute, 'status': 'activity',
+                                   'submittedAt': current_time, 'approvedAt': None}))
+        events.append(submission_created_event({'id': new_id, 'form': form_type, 'user': form_user_email, 'subject': form_subject,
+                                                'status': 'activity', 'submittedAt': current_time, 'approvedAt': None}))
+        results.append({'index': index, 'success': True, 'id': new_id})
+
+    processed = len(rows)
+    response_body = {'success': True, 'processed': processed, 'failed': len(results) - processed, 'results': results}
+    idempotency_key, request_hash, idempotency_ttl = submission_idempotency_key({'form_user': user, 'items': items}, client_key)
+    try:
+        with db_writer() as db:
+            previous = find_idempotent_response(db, idempotency_key, current_time)
+            if previous is not None:
+                if previous['request_hash'] != request_hash:
+                    return jsonify({'success': False, 'message': 'Idempotency-Key was already used for a different submission.'}), 422
+                response = jsonify(json.loads(previous['response']))
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            if rows:
+                db.executemany("""
+                    INSERT INTO submissions (id, form, user, subject, data, status, submittedAt, institute)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+                project_many_submission_fields(db, projections)
+                apply_status_deltas(db, {'activity': processed})
+                bump_cache_version(db, CACHE_SCOPE_SUBMISSIONS)
+                apply_rollup_transitions(db, transitions)
+                record_events(db, events + [summary_delta_event({'activity': processed})])
+                record_idempotent_response(db, idempotency_key, request_hash, rows[0][0], response_body, idempotency_ttl, current_time)
+    except Exception as e:
+        log_activity("Batch Submit Failed", f"Database error: {e}", "ERROR")
+        return jsonify({'success': False, 'message': f'Database error: {e}'}), 500
+
+    if processed:
+        invalidate_summary_cache()
+        notify_event_dispatcher()
+        counts = {}
+        for row in rows:
+            counts[row[1]] = counts.get(row[1], 0) + 1
+        breakdown = ', '.join(f"{count} {form}" for form, count in sorted(counts.items()))
+        log_activity(f"Batch Submit: {processed} submissions", f"Filed by {user}: {breakdown}.", "FORM_SUBMIT")
+
+    return jsonify(response_body)
+
+# --- REVIEW NOTIFICATIONS (shared by single and batch approval) ---
+REVIEW_ACTIONS = ['approved', 'disapproved', 'alert']
+MANAGEMENT_NOTIFY_STATUSES = ['approved', 'alert']
+BATCH_APPROVAL_MAX_ITEMS = int(os.getenv('BATCH_APPROVAL_MAX_ITEMS', '500'))
+
+def normalize_review_action(action):
+    return action if action in REVIEW_ACTIONS else 'pending'
+
+def build_submitter_email(submission, new_status, reviewer, remarks):
+    """Returns (subject, body) for the submitter, or None when the status needs no email."""
+    if new_status == 'approved':
+        return (f"✅ Approved: {submission['subject']}",
+                f"Dear User,\n\nYour submission for '{submission['subject']}' has been **APPROVED** by {reviewer}.\n\nHOI Remarks: {remarks}\n\nThank you.")
+    if new_status == 'disapproved':
+        return (f"❌ Action Required: {submission['subject']}",
+                f"Dear User,\n\nYour submission for '{submission['subject']}' has been **DISAPPROVED** by {reviewer}.\n\n--- HOI Remarks (Reason for Disapproval) ---\n{remarks}\n-----------------------------------\n\nPlease review the form and resubmit with necessary corrections.")
+    if new_status == 'alert':
+        return (f"⚠️ Alert Flag: {submission['subject']}",
+                f"Dear User,\n\nYour submission for '{submission['subject']}' has been **FLAGGED AS ALERT** by {reviewer} for further review.\n\nHOI Remarks: {remarks}\n\nAction will be notified soon.")
+    return None
+
+def build_management_email(submission, new_status, reviewer, remarks):
+    subject = f"🔔 HOI ALERT: {new_status.upper()} - {submission['subject']}"
+    body = (
+        f"A submission has been processed by {reviewer} with status: **{new_status.upper()}**.\n\n"
+        f"Details:\n"
+        f" - Submission ID: {submission['id']}\n"
+        f" - Form Type: {submission['form']}\n"
+        f" - Submitted By: {submission['user']}\n"
+        f" - HOI Remarks: {remarks}\n"
+    )
+    return subject, body
+
+def build_management_digest(processed, reviewer):
+    """One management email covering every notable item of a batch: [(submission, status, remarks)]."""
+    subject = f"🔔 HOI ALERT: {len(processed)} submission(s) processed by {reviewer}"
+    lines = [f"The following submissions were processed by {reviewer} in one batch:\n"]
+    for submission, new_status, remarks in processed:
+        lines.append(
+            f" - [{new_status.upper()}] {submission['id']} | {submission['form']} | "
+            f"{submission['subject']} | Submitted By: {submission['user']} | HOI Remarks: {remarks}"
+        )
+    return subject, "\n".join(lines) + "\n"
+
 @app.route('/api/process_approval', methods=['POST'])
 def process_approval():
     # Only reviewers can process approval
     if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
 
-    data = request.get_json()
-    db = get_db()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Expected a JSON object.'}), 400
     submission_id = data.get('submission_id')
     action = data.get('action')
     remarks = data.get('remarks', 'No remarks provided.')
     current_time = time.time()
 
     reviewer = session.get('user', REVIEWER_USER) 
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM submissions WHERE id = ?", (submission_id,))
-    submission = cursor.fetchone()
+    new_status = normalize_review_action(action)
+    email_queued_to_submitter = False
+    
+    try:
+        with db_writer() as db:
+            # Read inside the write transaction so the counters move from the status we replace
+            submission = db.execute("SELECT * FROM submissions WHERE id = ?", (submission_id,)).fetchone()
+            if submission:
+                submitter_email = submission['user']
+
+                # 1. Update DB Status
+                db.execute("""
+                    UPDATE submissions SET status = ?, approvedAt = ?, reviewedBy = ?, remarks = ?
+                    WHERE id = ?
+                """, (new_status, current_time, reviewer, remarks, submission_id))
+                reviewed = dict(submission, status=new_status, approvedAt=current_time)
+                apply_rollup_transitions(db, [(submission, reviewed)])
+                bump_cache_version(db, CACHE_SCOPE_SUBMISSIONS)
+                events = [status_changed_event(reviewed, submission['status'])]
+                if submission['status'] != new_status:
+                    deltas = {submission['status']: -1, new_status: 1}
+                    apply_status_deltas(db, deltas)
+                    events.append(summary_delta_event(deltas))
+                record_events(db, events)
+
+                # 2. USER NOTIFICATION (To the submitter - the person who filled the form)
+                submitter_email_content = build_submitter_email(submission, new_status, reviewer, remarks)
+
+                # Queue email to the submitter (user column); delivered by the outbox workers
+                if submitter_email and submitter_email != 'System User' and submitter_email_content:
+                    enqueue_email(db, submitter_email, *submitter_email_content, ref=submission_id)
+                    email_queued_to_submitter = True
+
+                # 3. MANAGEMENT NOTIFICATION (To HOI Admins)
+                if new_status in MANAGEMENT_NOTIFY_STATUSES:
+                    internal_subject, internal_body = build_management_email(submission, new_status, reviewer, remarks)
+                    for management_email in HOI_MANAGEMENT_EMAILS:
+                        enqueue_email(db, management_email, internal_subject, internal_body, ref=submission_id)
+
+    except Exception as e:
+        log_activity(f"Approval Failed: {submission_id}", f"Database error: {e}", "ERROR")
+        return jsonify({'success': False, 'message': f'Database error: {e}'}), 500
 
     if not submission:
         return jsonify({'success': False, 'message': 'Submission not found'}), 404
+
+    invalidate_summary_cache()
+    notify_email_workers()
+    notify_event_dispatcher()
     
-    submitter_email = submission['user']
+    log_activity(f"Approval Process: {new_status.upper()}", f"Submission {submission_id} processed by {reviewer}.", "REVIEW")
     
+    message = f'Submission {new_status} and confirmation email queued for submitter ({submitter_email}).' if email_queued_to_submitter else f'Submission {new_status}. No email notification was queued.'
+    return jsonify({'success': True, 'message': message, 'email_queued': email_queued_to_submitter})
+
+@app.route('/api/process_approvals_batch', methods=['POST'])
+def process_approvals_batch():
+    """Applies many review actions in one transaction.
+
+    Body: {"items": [{"submission_id": ..., "action": ..., "remarks": ...}, ...]}
+    or the shorthand {"submission_ids": [...], "action": ..., "remarks": ...}.
+    Returns one result per item, in request order, and a batch_id: the management digest is
+    queued under that ref (see /api/outbox_status?ref=...).
+    """
+    if session.get('role') != 'reviewer': return jsonify({'error': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Expected a JSON object.'}), 400
+    default_remarks = data.get('remarks', 'No remarks provided.')
+    if not isinstance(default_remarks, str):
+        return jsonify({'success': False, 'message': 'remarks must be text.'}), 400
+    items = data.get('items')
+    if items is None:
+        if data.get('action') not in REVIEW_ACTIONS:
+            return jsonify({'success': False, 'message': f"action must be one of {', '.join(REVIEW_ACTIONS)}."}), 400
+        items = [{'submission_id': sid, 'action': data['action'], 'remarks': default_remarks}
+                 for sid in data.get('submission_ids') or []]
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'message': 'No items to process.'}), 400
+    if len(items) > BATCH_APPROVAL_MAX_ITEMS:
+        return jsonify({'success': False, 'message': f'At most {BATCH_APPROVAL_MAX_ITEMS} items per batch.'}), 400
+
+    reviewer = session.get('user', REVIEWER_USER)
+    current_time = time.time()
+    batch_id = 'B' + new_ulid()
+    results = [None] * len(items)
+    wanted = {}
+    for index, item in enumerate(items):
+        submission_id = item.get('submission_id') if isinstance(item, dict) else None
+        if not submission_id:
+            results[index] = {'submission_id': submission_id, 'success': False, 'message': 'Missing submission_id'}
+        elif not isinstance(submission_id, str):
+            results[index] = {'submission_id': submission_id, 'success': False, 'message': 'submission_id must be text'}
+        elif item.get('action') not in REVIEW_ACTIONS:
+            # A missing or mistyped action must not quietly reset a reviewed row to pending.
+            results[index] = {'submission_id': submission_id, 'success': False,
+                              'message': f"action must be one of {', '.join(REVIEW_ACTIONS)}"}
+        elif not isinstance(item.get('remarks', ''), (str, type(None))):
+            results[index] = {'submission_id': submission_id, 'success': False, 'message': 'remarks must be text'}
+        elif submission_id in wanted:
+            results[index] = {'submission_id': submission_id, 'success': False, 'message': 'Duplicate submission_id in batch'}
+        else:
+            wanted[submission_id] = index
+
     try:
-        new_status = action if action in ['approved', 'disapproved', 'alert'] else 'pending' 
-        
-        # 1. Update DB Status
-        db.execute("""
-            UPDATE submissions SET status = ?, approvedAt = ?, reviewedBy = ?, remarks = ?
-            WHERE id = ?
-        """, (new_status, current_time, reviewer, remarks, submission_id))
-        
-        # 2. USER NOTIFICATION (To the submitter - the person who filled the form)
-        email_sent_to_submitter = False
-        email_subject = ""
-        
-        if new_status == 'approved':
-            email_subject = f"✅ Approved: {submission['subject']}"
-            email_body = f"Dear User,\n\nYour submission for '{submission['subject']}' has been **APPROVED** by {reviewer}.\n\nHOI Remarks: {remarks}\n\nThank you."
-        elif new_status == 'disapproved':
-            email_subject = f"❌ Action Required: {submission['subject']}"
-            email_body = f"Dear User,\n\nYour submission for '{submission['subject']}' has been **DISAPPROVED** by {reviewer}.\n\n--- HOI Remarks (Reason for Disapproval) ---\n{remarks}\n-----------------------------------\n\nPlease review the form and resubmit with necessary corrections."
-        elif new_status == 'alert':
-            email_subject = f"⚠️ Alert Flag: {submission['subject']}"
-            email_body = f"Dear User,\n\nYour submission for '{submission['subject']}' has been **FLAGGED AS ALERT** by {reviewer} for further review.\n\nHOI Remarks: {remarks}\n\nAction will be notified soon."
-        
-        # Send email to the submitter (user column)
-        if submitter_email and submitter_email != 'System User':
-            email_sent_to_submitter = send_notification_email(
-                recipient=submitter_email, 
-                subject=email_subject, 
-                body=email_body
-            )
+        with db_writer() as db:
+            existing = {}
+            ids = list(wanted)
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = db.execute(f"SELECT {SUBMISSION_LIST_COLUMNS}, institute FROM submissions WHERE id IN ({', '.join('?' for _ in chunk)})", chunk)
+                existing.update((row['id'], row) for row in rows)
 
-        # 3. MANAGEMENT NOTIFICATION (To HOI Admins)
-        if new_status in ['approved', 'alert']:
-            internal_subject = f"🔔 HOI ALERT: {new_status.upper()} - {submission['subject']}"
-            internal_body = (
-                f"A submission has been processed by {reviewer} with status: **{new_status.upper()}**.\n\n"
-                f"Details:\n"
-                f" - Submission ID: {submission_id}\n"
-                f" - Form Type: {submission['form']}\n"
-                f" - Submitted By: {submission['user']}\n"
-                f" - HOI Remarks: {remarks}\n"
-            )
-            for management_email in HOI_MANAGEMENT_EMAILS:
-                send_notification_email(recipient=management_email, subject=internal_subject, body=internal_body)
-        
-        db.commit()
-        
-        log_activity(f"Approval Process: {new_status.upper()}", f"Submission {submission_id} processed by {reviewer}.", "REVIEW")
-        
-        message = f'Submission {new_status} and confirmation email sent to submitter ({submitter_email}).' if email_sent_to_submitter else f'Submission {new_status}. Email notification failed.'
-        return jsonify({'success': True, 'message': message, 'email_sent': email_sent_to_submitter})
+            updates, deltas, emails, digest, events, transitions = [], {}, [], [], [], []
+            for submission_id, index in wanted.items():
+                submission = existing.get(submission_id)
+                if submission is None:
+                    results[index] = {'submission_id': submission_id, 'success': False, 'message': 'Submission not found'}
+                    continue
+                item = items[index]
+                new_status = item['action']  # checked against REVIEW_ACTIONS above
+                remarks = item.get('remarks') or default_remarks
+                updates.append((new_status, current_time, reviewer, remarks, submission_id))
+                reviewed = dict(submission, status=new_status, approvedAt=current_time)
+                transitions.append((submission, reviewed))
+                events.append(status_changed_event(reviewed, submission['status']))
+                if submission['status'] != new_status:
+                    deltas[submission['status']] = deltas.get(submission['status'], 0) - 1
+                    deltas[new_status] = deltas.get(new_status, 0) + 1
+
+                email_queued = False
+                submitter_email_content = build_submitter_email(submission, new_status, reviewer, remarks)
+                if submission['user'] and submission['user'] != 'System User' and submitter_email_content:
+                    emails.append((submission['user'], *submitter_email_content, submission_id))
+                    email_queued = True
+                if new_status in MANAGEMENT_NOTIFY_STATUSES:
+                    digest.append((submission, new_status, remarks))
+                results[index] = {'submission_id': submission_id, 'success': True, 'status': new_status, 'email_queued': email_queued}
 
+            if updates:
+                db.executemany("""
+                    UPDATE submissions SET status = ?, approvedAt = ?, reviewedBy = ?, remarks = ?
+                    WHERE id = ?
+                """, updates)
+                apply_status_deltas(db, deltas)
+                apply_rollup_transitions(db, transitions)
+                bump_cache_version(db, CACHE_SCOPE_SUBMISSIONS)
+                if any(deltas.values()):
+                    events.append(summary_delta_event(deltas))
+                record_events(db, events)
+            if digest:
+                digest_subject, digest_body = build_management_digest(digest, reviewer)
+                emails.extend((management_email, digest_subject, digest_body, batch_id) for management_email in HOI_MANAGEMENT_EMAILS)
+            if emails:
+                enqueue_emails(db, emails)
     except Exception as e:
-        db.rollback()
-        log_activity(f"Approval Failed: {submission_id}", f"Database error: {e}", "ERROR")
+        log_activity("Batch Approval Failed", f"Database error: {e}", "ERROR")
         return jsonify({'success': False, 'message': f'Database error: {e}'}), 500
 
+    invalidate_summary_cache()
+    notify_email_workers()
+    notify_event_dispatcher()
+    processed = [result for result in results if result['success']]
+    if processed:
+        counts = {}
+        for result in processed:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        breakdown = ', '.join(f"{count} {status}" for status, count in sorted(counts.items()))
+        log_activity(f"Batch Approval: {len(processed)} submissions", f"Processed by {reviewer}: {breakdown}.", "REVIEW")
+
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'processed': len(processed),
+        'failed': len(results) - len(processed),
+        'results': results,
+    })
+
+# --- FORM REGISTRY (pre-rendered form pages) ---
+# Form templates only change with a deploy, so they are read once: templates without Jinja
+# syntax are rendered at startup and kept as identity/gzip/brotli bodies with an ETag, and
+# a page load is a dictionary lookup (or a 304). Templates that use Jinja (e.g. the
+# submitter's email) stay compiled and are rendered per request. Debug mode re-reads
+# changed files on each request.
+
+FORM_REGISTRY_STATS = {'served': 0, 'not_modified': 0, 'rendered': 0, 'reloads': 0}
+_form_registry = {}
+_form_registry_lock = threading.Lock()
+_form_registry_loaded = False
+
+def forms_directory():
+    return os.path.join(app.root_path, app.template_folder, 'forms')
+
+def list_form_templates():
+    return sorted(name for name in os.listdir(forms_directory()) if name.endswith('.html'))
+
+def compress_form_body(body, dynamic=False):
+    """Returns {'identity': ..., 'gzip': ..., 'br': ...}; per-request bodies use faster settings."""
+    bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=6 if dynamic else 9)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body, quality=5 if dynamic else 11)
+    return bodies
+
+def build_form_entry(form_name):
+    path = os.path.join(forms_directory(), form_name)
+    stat = os.stat(path)
+    with open(path, encoding='utf-8') as handle:
+        source = handle.read()
+    dynamic = any(marker in source for marker in ('{{', '{%', '{#'))
+    entry = {
+        'name': form_name,
+        'mtime': stat.st_mtime,
+        'last_modified': datetime.fromtimestamp(int(stat.st_mtime), timezone.utc),
+        'etag': hashlib.sha256(source.encode('utf-8')).hexdigest()[:20],
+        'dynamic': dynamic,
+        'bodies': None,
+    }
+    with app.app_context():
+        template = app.jinja_env.get_template(f'forms/{form_name}')
+        if not dynamic:
+            entry['bodies'] = compress_form_body(template.render().encode('utf-8'))
+    entry['schema'] = compile_form_schema(source)
+    return entry
+
+def load_form_registry():
+    """Discovers templates/forms/*.html and builds every entry. Returns the number of forms."""
+    global _form_registry_loaded
+    entries = {}
+    for form_name in list_form_templates():
+        try:
+            entries[form_name] = build_form_entry(form_name)
+        except Exception as e:
+            print(f"❌ Could not load form template {form_name}: {e}")
+    with _form_registry_lock:
+        _form_registry.clear()
+        _form_registry.update(entries)
+        _form_registry_loaded = True
+    return len(entries)
+
+def get_form_entry(form_name):
+    if not _form_registry_loaded:
+        load_form_registry()
+    entry = _form_registry.get(form_name)
+    if not app.debug:
+        return entry
+    # Debug only: pick up edited, added and deleted templates without a restart.
+    path = os.path.join(forms_directory(), form_name)
+    if not os.path.isfile(path):
+        with _form_registry_lock:
+            _form_registry.pop(form_name, None)
+        return None
+    if entry is None or os.stat(path).st_mtime != entry['mtime']:
+        entry = build_form_entry(form_name)
+        with _form_registry_lock:
+            _form_registry[form_name] = entry
+            FORM_REGISTRY_STATS['reloads'] += 1
+    return entry
+
+def form_response(entry):
+    """Serves a registry entry with ETag/Last-Modified validation and the best encoding."""
+    etag = entry['etag']
+    available = ['identity', 'gzip'] + (['br'] if brotli is not None else [])
+    if entry['dynamic']:
+        # The page embeds the session user, so each user has their own version.
+        etag += '-' + hashlib.sha256(session.get('user', '').encode('utf-8')).hexdigest()[:8]
+    encoding = request.accept_encodings.best_match([name for name in ('br', 'gzip') if name in available]) or 'identity'
+    if encoding != 'identity':
+        etag += '-' + encoding
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = (request.if_modified_since is not None and
+                        request.if_modified_since >= entry['last_modified'])
+    if not_modified:
+        response = app.response_class(status=304)
+        FORM_REGISTRY_STATS['not_modified'] += 1
+    else:
+        if entry['dynamic']:
+            bodies = compress_form_body(render_template(f"forms/{entry['name']}").encode('utf-8'), dynamic=True)
+            FORM_REGISTRY_STATS['rendered'] += 1
+        else:
+            bodies = entry['bodies']
+        response = app.response_class(bodies[encoding], mimetype='text/html')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        FORM_REGISTRY_STATS['served'] += 1
+
+    response.set_etag(etag)
+    response.last_modified = entry['last_modified']
+    # Access depends on the session, so shared caches must not store it; browsers revalidate.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Accept-Encoding, Cookie'
+    return response
+
+def get_form_registry_status():
+    with _form_registry_lock:
+        entries = list(_form_registry.values())
+    return {
+        'stats': dict(FORM_REGISTRY_STATS),
+        'forms': len(entries),
+        'dynamic_forms': sorted(entry['name'] for entry in entries if entry['dynamic']),
+        'brotli': brotli is not None,
+        'hot_reload': app.debug,
+    }
+
 @app.route('/forms/<form_name>')
 def serve_form(form_name):
     try:
@@ -615,30 +4074,36 @@ def serve_form(form_name):
 
         # --- 2. 🌟 CRITICAL SECURITY CHECK (Submitter Authorization) 🌟 ---
         if session.get('role') == 'submitter':
-            # submitter-க்கு ஒதுக்கப்பட்ட படிவத்தின் பெயர்
-            assigned_form = session.get('form_access') 
+            # submitter-க்கு ஒதுக்கப்பட்ட படிவங்கள் (cached set from the user directory; the
+            # decision and the message below both come from this one entry)
+            directory_user = get_directory_user(session.get('user'))
+            assigned_forms = directory_user['forms'] if directory_user else frozenset()
             
-            # உள்நுழைந்த submitter, அவருக்கு ஒதுக்கப்பட்ட படிவத்தைத் தவிர வேறு ஒன்றைத் திறக்க முயற்சித்தால்
-            if form_name != assigned_form:
+            # உள்நுழைந்த submitter, அவருக்கு ஒதுக்கப்பட்ட படிவங்களைத் தவிர வேறு ஒன்றைத் திறக்க முயற்சித்தால்
+            if form_name not in assigned_forms:
                  log_activity(f"Form Access Denied: {form_name}", 
                               f"Submitter {session.get('user')} attempted to access unauthorized form.", 
                               "SECURITY_BREACH")
+                 allowed = ', '.join(f"<code>{html.escape(form)}</code>" for form in sorted(assigned_forms)) or 'no'
                  return f"""
                      <div style="font-family: sans-serif; padding: 20px; text-align: center;">
                          <h1 style="color: #FF0000;">🔒 Access Denied!</h1>
-                         <p>You are only authorized to view the <code>{assigned_form}</code> form.</p>
+                         <p>You are only authorized to view the {allowed} form(s).</p>
                      </div>
                  """, 403
         
         # HOI Admin (reviewer) எந்த படிவத்தையும் பார்க்க அனுமதிக்கப்படுவார்.
         # Submitter அவருக்கு ஒதுக்கப்பட்ட படிவத்தை மட்டுமே பார்க்க முடியும்.
 
-        return render_template(f'forms/{form_name}')
+        entry = get_form_entry(form_name)
+        if entry is None:
+            raise TemplateNotFound(f'forms/{form_name}')
+        return form_response(entry)
     
     except Exception as e:
         # File Not Found, Template Error, etc.
         error_message = f"Error details: {e}"
-        if "TemplateNotFound" in str(e):
+        if isinstance(e, TemplateNotFound):
             error_message = f"Please ensure you have created the file: <code>templates/forms/{form_name}</code>"
         
         return f"""
@@ -648,6 +4113,855 @@ def serve_form(form_name):
             </div>
         """, 404
 
+# --- SUBMISSION SCHEMAS (compiled from the form templates) ---
+# The form pages post their fields keyed by element id (checkbox and radio groups may also
+# be keyed by name). Each template is parsed once, with its registry entry, into
+# {key: field spec}; a submission is then checked with dictionary lookups. A required field
+# is only enforced when some field of its <form> or tab panel was submitted, since the pages
+# send only the visible panel and the intervention form is posted on its own. Forms without a template or
+# without fields are only held to the size limit.
+
+SUBMISSION_SCHEMA_SKIP_TYPES = {'button', 'submit', 'reset', 'image'}
+SUBMISSION_SCHEMA_EXTRA_FIELDS = {'form_type', 'form_user', 'subject', 'submission_description', 'institute', 'institute_id'}
+SUBMISSION_SCHEMA_MAX_ERRORS = 20
+SUBMISSION_TEXT_FORMATS = {
+    'email': re.compile(r'^[^@\s]+@[^@\s]+$'),
+    'date': re.compile(r'^\d{4}-\d{2}-\d{2}$'),
+    'time': re.compile(r'^\d{2}:\d{2}(:\d{2})?$'),
+}
+SCHEMA_STATS = {}  # form -> {'validated', 'rejected', 'oversized', 'samples': deque of ms}
+_schema_stats_lock = threading.Lock()
+HTML_VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+class FormFieldParser(HTMLParser):
+    """Collects a page's inputs, selects and textareas, each with the group it belongs to: its
+    innermost tab panel, else its <form>, else the page (group 0)."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []  # (tag, group) of open elements
+        self.groups = 0
+        self.fields = []
+        self.select = None
+        self.option = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value if value is not None else '' for name, value in attrs}
+        group = self.stack[-1][1] if self.stack else 0
+        classes = attrs.get('class', '').split()
+        if tag == 'form' or any(name == 'panel' or name.endswith('-panel') for name in classes):
+            self.groups += 1
+            group = self.groups
+        if tag not in HTML_VOID_TAGS:
+            self.stack.append((tag, group))
+        if tag in ('input', 'textarea', 'select'):
+            field = {'tag': tag, 'type': attrs.get('type', 'text').lower() if tag == 'input' else tag, 'group': group,
+                     'id': attrs.get('id'), 'name': attrs.get('name'), 'value': attrs.get('value'), 'required': 'required' in attrs,
+                     'min': attrs.get('min'), 'max': attrs.get('max'), 'maxlength': attrs.get('maxlength'), 'options': None}
+            if field['type'] not in SUBMISSION_SCHEMA_SKIP_TYPES:
+                self.fields.append(field)
+            if tag == 'select':
+                field['options'] = []
+                self.select = field
+        elif tag == 'option' and self.select is not None:
+            self.option = [attrs.get('value')]
+
+    def handle_data(self, data):
+        if self.option is not None:
+            self.option.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'option' or (tag == 'select' and self.option is not None):
+            if self.option is not None:
+                value = self.option[0]
+                self.select['options'].append(value if value is not None else ''.join(self.option[1:]).strip())
+                self.option = None
+        if tag == 'select':
+            self.select = None
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                del self.stack[index:]
+                break
+
+def _schema_number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+def compile_form_schema(source):
+    """{'fields': {key: spec}, 'required': [(key, group)]} for a template's source, or None
+    when it defines no fields. A key holding fields of different kinds accepts any value."""
+    parser = FormFieldParser()
+    parser.feed(source)
+    parser.close()
+    fields, required = {}, []
+
+    def add(key, kind, field, options=None):
+        spec = fields.get(key)
+        if spec is None:
+            maxlength = _schema_number(field['maxlength'])
+            fields[key] = {'kind': kind, 'group': field['group'], 'options': set(options) if options is not None else None,
+                           'format': field['type'] if field['type'] in SUBMISSION_TEXT_FORMATS else None,
+                           'min': _schema_number(field['min']), 'max': _schema_number(field['max']),
+                           'maxlength': int(maxlength) if maxlength else SUBMISSION_TEXT_MAX_LENGTH}
+        elif spec['kind'] != kind:
+            spec['kind'] = 'any'
+        elif spec['options'] is not None:
+            if options is None:
+                spec['options'] = None
+            else:
+                spec['options'].update(options)
+
+    for field in parser.fields:
+        kind = {'number': 'number', 'range': 'number', 'checkbox': 'multi', 'radio': 'choice', 'select': 'choice'}.get(field['type'], 'text')
+        if kind == 'multi':
+            options = [field['value'] or 'on']
+        elif field['type'] == 'radio':
+            options = [field['value'] or 'on']
+        elif kind == 'choice':
+            options = field['options'] or None
+        else:
+            options = None
+        if field['id']:
+            add(field['id'], kind, field, options)
+            if field['required'] and field['type'] not in ('checkbox', 'radio'):
+                required.append((field['id'], field['group']))
+        if field['name'] and field['name'] != field['id'] and kind in ('multi', 'choice'):
+            add(field['name'], kind, field, options)
+    if not fields:
+        return None
+    for spec in fields.values():
+        if spec['options'] is not None:
+            spec['options'] = frozenset(spec['options'])
+    return {'fields': fields, 'required': required}
+
+def check_schema_value(spec, value):
+    """(normalized value, error or None) for one field."""
+    kind = spec['kind']
+    if value is None or kind == 'any':
+        return value, None
+    if kind == 'number':
+        if isinstance(value, bool):
+            return value, 'must be a number'
+        if isinstance(value, str):
+            value = value.strip()
+            if not value:
+                return value, None
+            number = _schema_number(value.replace(',', ''))
+            if number is None:
+                return value, 'must be a number'
+            value = int(number) if number.is_integer() else number
+        elif not isinstance(value, (int, float)) or not math.isfinite(value):
+            return value, 'must be a number'
+        if spec['min'] is not None and value < spec['min']:
+            return value, f"must be at least {spec['min']:g}"
+        if spec['max'] is not None and value > spec['max']:
+            return value, f"must be at most {spec['max']:g}"
+        return value, None
+    if kind == 'multi':
+        if isinstance(value, bool):
+            return value, None
+        if isinstance(value, str):
+            value = value.strip()
+            parts = [value] if not value or value in spec['options'] else [part.strip() for part in value.split(',')]
+        elif isinstance(value, list):
+            parts = value
+        else:
+            return value, 'must be a checkbox value or a list of them'
+        unknown = [part for part in parts if part and part not in spec['options']]
+        return value, f"has unknown option {str(unknown[0])[:50]!r}" if unknown else None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str):
+        return value, 'must be text'
+    value = value.strip()
+    if len(value) > spec['maxlength']:
+        return value, f"is longer than {spec['maxlength']} characters"
+    if not value:
+        return value, None
+    if kind == 'choice' and spec['options'] is not None and value not in spec['options']:
+        return value, f"has unknown option {value[:50]!r}"
+    if spec['format'] and not SUBMISSION_TEXT_FORMATS[spec['format']].match(value):
+        return value, f"is not a valid {spec['format']}"
+    return value, None
+
+def validate_submission_payload(data):
+    """(payload, errors, oversized) for one submission. The payload comes back with numbers
+    parsed and text trimmed when it has a compiled schema; errors is a list of messages."""
+    form_type = data.get('form_type', 'Unknown Form')
+    started = time.perf_counter()
+    errors, oversized = [], False
+    for key in ('form_type', 'form_user', 'subject'):
+        if key in data and not isinstance(data[key], str):
+            errors.append(f"{key} must be text")
+    if len(json.dumps(data, separators=(',', ':'), default=str)) > SUBMISSION_MAX_BYTES:
+        errors.append(f"Submission is larger than {SUBMISSION_MAX_BYTES} bytes")
+        oversized = True
+    entry = get_form_entry(form_type) if isinstance(form_type, str) and '/' not in form_type and '..' not in form_type else None
+    schema = entry and entry.get('schema')
+    if schema and not errors:
+        fields, normalized, present = schema['fields'], {}, set()
+        for key, value in data.items():
+            spec = fields.get(key)
+            if spec is None:
+                if key not in SUBMISSION_SCHEMA_EXTRA_FIELDS:
+                    errors.append(f"Unknown field {str(key)[:50]!r}")
+                normalized[key] = value
+                continue
+            normalized[key], error = check_schema_value(spec, value)
+            if error:
+                errors.append(f"{key} {error}")
+            if value not in (None, '', False, []):
+                present.add(spec['group'])
+        for key, group in schema['required']:
+            if group in present and normalized.get(key) in (None, ''):
+                errors.append(f"{key} is required")
+        if not errors:
+            data = normalized
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    with _schema_stats_lock:
+        stats = SCHEMA_STATS.get(form_type if entry else '(no template)')
+        if stats is None:
+            stats = SCHEMA_STATS[form_type if entry else '(no template)'] = {
+                'validated': 0, 'rejected': 0, 'oversized': 0, 'samples': deque(maxlen=SUBMISSION_SCHEMA_LATENCY_SAMPLES)}
+        stats['validated'] += 1
+        stats['rejected'] += bool(errors)
+        stats['oversized'] += oversized
+        stats['samples'].append(elapsed_ms)
+    return data, errors[:SUBMISSION_SCHEMA_MAX_ERRORS], oversized
+
+def apply_submission_schema(data):
+    """(payload to store, errors to refuse it with). SUBMISSION_SCHEMA_MODE decides whether
+    schema errors refuse the payload; the size limit always does."""
+    if SUBMISSION_SCHEMA_MODE == 'off':
+        return data, []
+    normalized, errors, oversized = validate_submission_payload(data)
+    if errors and SUBMISSION_SCHEMA_MODE != 'enforce' and not oversized:
+        print(f"⚠️ Schema check ({data.get('form_type')}): {'; '.join(errors[:3])}")
+        return data, []
+    return normalized, errors
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else None
+
+def get_submission_schema_status():
+    with _form_registry_lock:
+        entries = list(_form_registry.values())
+    with _schema_stats_lock:
+        stats = {form: dict(values, samples=list(values['samples'])) for form, values in SCHEMA_STATS.items()}
+    forms = {}
+    for form, values in sorted(stats.items()):
+        samples = values.pop('samples')
+        values.update(p50_ms=percentile(samples, 0.5), p95_ms=percentile(samples, 0.95),
+                      max_ms=max(samples) if samples else None)
+        forms[form] = values
+    return {
+        'mode': SUBMISSION_SCHEMA_MODE,
+        'max_bytes': SUBMISSION_MAX_BYTES,
+        'compiled_forms': {entry['name']: len(entry['schema']['fields']) for entry in entries if entry.get('schema')},
+        'forms': forms,
+    }
+
+# --- CHATBOT INTENT ROUTER ---
+# A message is scanned once by a compiled pattern (a regex trie over every keyword and form
+# alias), which fills slots: statuses, forms, a period and a person. Messages with data
+# slots are answered from the rollup tables or an indexed count on submissions, plain
+# "summary"/"recent logs" questions from the summary engine and the activity log. Answers
+# are cached per (intent, slots, data version) for CHATBOT_ANSWER_TTL_SECONDS. Only a
+# message with no recognised keyword goes to the LLM; a form name on its own does not
+# count, so general questions that mention a form ("how do I fill the safety form") do too.
+
+CHATBOT_PERIODS = ('today', 'yesterday', 'this week', 'last week', 'this month', 'last month')
+CHATBOT_VOCABULARY = [
+    ('intent', 'summary', ('stats', 'statistics', 'summary', 'overview', 'dashboard', 'usage', 'status', 'forms',
+                           'submissions', 'submitted', 'count', 'how many', 'number of', 'total')),
+    ('intent', 'activity_log', ('recent', 'log', 'logs', 'activity', 'history')),
+    ('list', True, ('recent', 'latest', 'newest', 'last few', 'show', 'list', 'which')),
+    ('status', 'pending', ('pending', 'overdue', 'waiting', 'backlog')),
+    ('status', 'alert', ('alert', 'alerts', 'flagged')),
+    ('status', 'approved', ('approved', 'approval', 'approvals')),
+    ('status', 'disapproved', ('disapproved', 'disapproval', 'disapprovals', 'rejected', 'rejection', 'rejections')),
+    ('status', 'activity', ('today activity', "today's activity", 'new submissions')),
+] + [('period', period, (period,)) for period in CHATBOT_PERIODS]
+# Form name words too generic to stand for a form on their own.
+CHATBOT_FORM_STOPWORDS = {'new'}
+
+CHATBOT_LAST_DAYS_RE = re.compile(r"\b(?:last|past)\s+(\d{1,3})\s+days?\b", re.IGNORECASE)
+CHATBOT_BY_RE = re.compile(
+    r"\bby\s+(.+?)[\s.]*(?=\s(?:today|yesterday|this|last|past|in|for|on|during)\b|[?!,;]|$)", re.IGNORECASE)
+CHATBOT_FROM_RE = re.compile(r"\bfrom\s+([\w.+-]+@[\w-]+(?:\.[\w-]+)+)", re.IGNORECASE)
+
+_chatbot_matcher = None
+_chatbot_answer_cache = OrderedDict()
+_chatbot_answer_cache_lock = threading.Lock()
+
+def keyword_trie_pattern(keywords):
+    """One alternation for many keywords, factored by common prefixes (a regex trie), so a
+    message is matched in a single pass and the longest keyword at a position wins."""
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def emit(node):
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        group = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{group})?' if '' in node else group
+
+    return emit(trie)
+
+def form_label(form):
+    return os.path.splitext(form)[0].replace('_', ' ').title()
+
+def chatbot_matcher():
+    """(compiled pattern, {keyword: [(slot, value)]}), built once from the vocabulary and forms."""
+    global _chatbot_matcher
+    if _chatbot_matcher is None:
+        vocabulary = {}
+        for slot, value, keywords in CHATBOT_VOCABULARY:
+            for keyword in keywords:
+                vocabulary.setdefault(keyword, []).append((slot, value))
+        for form in list_form_templates():
+            words = os.path.splitext(form)[0].lower().replace('_', ' ').split()
+            aliases = {' '.join(words)} | {word for word in words if len(word) >= 4 and word not in CHATBOT_FORM_STOPWORDS}
+            for alias in aliases:
+                for keyword in (alias, alias + 's'):
+                    vocabulary.setdefault(keyword, []).append(('form', form))
+        pattern = re.compile(r"(?<!\w)(" + keyword_trie_pattern(vocabulary) + r")(?!\w)", re.IGNORECASE)
+        _chatbot_matcher = (pattern, vocabulary)
+    return _chatbot_matcher
+
+def parse_chatbot_message(message):
+    """Routes a message to {'name': intent, 'slots': {...}}, or None when it is for the LLM."""
+    text = ' '.join(message.split())
+    pattern, vocabulary = chatbot_matcher()
+    intents, statuses, forms = set(), set(), set()
+    slots = {'period': None, 'reviewer': None, 'submitter': None, 'list': False}
+
+    # A name after "by" may contain keywords ("by hostel warden"); they are not slots.
+    by_match = CHATBOT_BY_RE.search(text)
+    from_match = CHATBOT_FROM_RE.search(text)
+    person_spans = [match.span(1) for match in (by_match, from_match) if match]
+    days_match = CHATBOT_LAST_DAYS_RE.search(text)
+    if days_match and 0 < int(days_match.group(1)) <= 366:
+        slots['period'] = f"last {int(days_match.group(1))} days"
+
+    for match in pattern.finditer(text):
+        if any(start <= match.start() < end for start, end in person_spans):
+            continue
+        for slot, value in vocabulary[match.group(1).lower()]:
+            if slot == 'intent':
+                intents.add(value)
+            elif slot == 'list':
+                slots['list'] = True
+            elif slot == 'status':
+                statuses.add(value)
+            elif slot == 'form':
+                forms.add(value)
+            elif slot == 'period' and slots['period'] is None:
+                slots['period'] = value
+
+    # A form name alone ("tips for the placement drive") is not a data question; it only
+    # narrows one that also carries a status, period, person or count/list word.
+    if not (statuses or slots['period'] or person_spans or 'summary' in intents or slots['list']):
+        forms = set()
+    if not (intents or statuses or forms or slots['period']):
+        return None
+    if from_match:
+        slots['submitter'] = from_match.group(1)
+    if by_match:
+        # "approvals by X" names a reviewer; "submissions by X" a submitter.
+        if statuses and statuses <= set(ROLLUP_REVIEW_STATUSES):
+            slots['reviewer'] = by_match.group(1)
+        elif not slots['submitter']:
+            slots['submitter'] = by_match.group(1)
+    slots['statuses'], slots['forms'] = sorted(statuses), sorted(forms)
+
+    # "latest submissions" lists rows; "recent logs" stays with the activity log.
+    listing = slots['list'] and 'activity_log' not in intents
+    if statuses or forms or slots['period'] or slots['reviewer'] or slots['submitter'] or listing:
+        name = 'count'
+    elif 'activity_log' in intents:
+        name = 'activity_log'
+    else:
+        name = 'summary'
+    return {'name': name, 'slots': slots}
+
+def resolve_chatbot_period(label, now_ts=None):
+    """(since, until) of a period label, on analytics-local day boundaries."""
+    today = rollup_bucket(now_ts or time.time(), ONE_DAY_SECONDS)
+    tomorrow = today + ONE_DAY_SECONDS
+    if label == 'today':
+        return today, tomorrow
+    if label == 'yesterday':
+        return today - ONE_DAY_SECONDS, today
+    if label in ('this week', 'last week'):
+        week = period_start(today, 'week')
+        return (week, tomorrow) if label == 'this week' else (week - 7 * ONE_DAY_SECONDS, week)
+    if label in ('this month', 'last month'):
+        month = period_start(today, 'month')
+        return (month, tomorrow) if label == 'this month' else (period_start(month - ONE_DAY_SECONDS, 'month'), month)
+    days = int(CHATBOT_LAST_DAYS_RE.match(label).group(1))
+    return today - (days - 1) * ONE_DAY_SECONDS, tomorrow
+
+def chatbot_time_column(slots):
+    """Review statuses (and reviewers) are placed in time by the review, everything else by submission."""
+    statuses = set(slots['statuses'])
+    reviewed = statuses <= set(ROLLUP_REVIEW_STATUSES) if statuses else slots['reviewer'] is not None
+    return 'approvedAt' if reviewed else 'submittedAt'
+
+def chatbot_filter_sql(slots):
+    """WHERE clauses for every slot except status, which callers handle themselves."""
+    time_column = chatbot_time_column(slots)
+    clauses, params = [], []
+    if slots['period']:
+        since, until = resolve_chatbot_period(slots['period'])
+        clauses.append(f"{time_column} >= ? AND {time_column} < ?")
+        params.extend([since, until])
+    if slots['forms']:
+        clauses.append(f"form IN ({', '.join('?' for _ in slots['forms'])})")
+        params.extend(slots['forms'])
+    if slots['reviewer']:
+        clauses.append("reviewedBy = ? COLLATE NOCASE")
+        params.append(slots['reviewer'])
+    if slots['submitter']:
+        clauses.append("user = ?")
+        params.append(slots['submitter'])
+    return time_column, clauses, params
+
+def count_chatbot_submissions(db, slots):
+    """[(form, status or 'submitted', count)] from the cheapest source that can answer: the
+    status rollup (no period), the daily rollups (a period with review statuses or none) or an
+    indexed count on submissions (a person, or pending/activity within a period)."""
+    statuses = slots['statuses']
+    person = slots['reviewer'] or slots['submitter']
+    form_sql = f" AND form IN ({', '.join('?' for _ in slots['forms'])})" if slots['forms'] else ""
+    if not slots['period'] and not person:
+        status_sql = f" AND status IN ({', '.join('?' for _ in statuses)})" if statuses else ""
+        rows = db.execute(f"""
+            SELECT form, status, SUM(count) FROM submission_status_rollup
+            WHERE 1 = 1{status_sql}{form_sql} GROUP BY form, status
+        """, [*statuses, *slots['forms']])
+        return [tuple(row) for row in rows if row[2]]
+    if not person and set(statuses) <= set(ROLLUP_REVIEW_STATUSES):
+        counters = statuses or ['submitted']
+        since, until = resolve_chatbot_period(slots['period'])
+        rows = db.execute(f"""
+            SELECT form, {', '.join(f'SUM({counter})' for counter in counters)} FROM submission_rollups
+            WHERE grain = 'day' AND bucket_start >= ? AND bucket_start < ?{form_sql} GROUP BY form
+        """, [since, until, *slots['forms']])
+        return [(row[0], counter, row[index + 1]) for row in rows for index, counter in enumerate(counters) if row[index + 1]]
+    _, clauses, params = chatbot_filter_sql(slots)
+    if statuses:
+        clauses.append(f"status IN ({', '.join('?' for _ in statuses)})")
+        params.extend(statuses)
+    rows = db.execute(f"SELECT form, status, COUNT(*) FROM submissions WHERE {' AND '.join(clauses)} GROUP BY form, status", params)
+    return [tuple(row) for row in rows]
+
+def latest_chatbot_submissions(db, slots, limit=CHATBOT_LIST_ITEMS):
+    """Newest matching submissions, with one index walk per status (as query_submissions_page does)."""
+    time_column, clauses, params = chatbot_filter_sql(slots)
+    branches, branch_params = [], []
+    for status in slots['statuses'] or [None]:
+        branch_clauses = clauses + (["status = ?"] if status is not None else [])
+        where = f"WHERE {' AND '.join(branch_clauses)}" if branch_clauses else ""
+        branches.append(f"""
+            SELECT * FROM (SELECT id, form, subject, status, {time_column} AS at FROM submissions {where}
+                           ORDER BY {time_column} DESC LIMIT ?)""")
+        branch_params.extend(params + ([status] if status is not None else []) + [limit])
+    sql = " UNION ALL ".join(branches) + " ORDER BY at DESC LIMIT ?"
+    return db.execute(sql, (*branch_params, limit)).fetchall()
+
+def format_chatbot_count(slots, rows, latest):
+    total = sum(count for _, _, count in rows)
+    labels = slots['statuses'] or sorted({label for _, label, _ in rows if label == 'submitted'})
+    scope = []
+    if slots['forms']:
+        scope.append(', '.join(form_label(form) for form in slots['forms']))
+    if slots['reviewer']:
+        scope.append(f"reviewed by {slots['reviewer']}")
+    if slots['submitter']:
+        scope.append(f"from {slots['submitter']}")
+    if slots['period']:
+        scope.append(slots['period'])
+    title = ' / '.join(label.title() for label in labels) or 'Submissions'
+    lines = [f"**📊 {title}{' — ' + ', '.join(scope) if scope else ''}:** {total:,}"]
+
+    by_status, by_form = {}, {}
+    for form, label, count in rows:
+        by_status[label] = by_status.get(label, 0) + count
+        by_form[form] = by_form.get(form, 0) + count
+    if len(by_status) > 1:
+        lines.append("")
+        lines.extend(f"- **{label.title()}:** {count:,}" for label, count in sorted(by_status.items(), key=lambda item: -item[1]))
+    if len(by_form) > 1:
+        top = sorted(by_form.items(), key=lambda item: -item[1])
+        lines.append("")
+        lines.append("By form:" if len(top) <= CHATBOT_BREAKDOWN_ROWS else f"Top {CHATBOT_BREAKDOWN_ROWS} forms:")
+        lines.extend(f"- {form_label(form)}: {count:,}" for form, count in top[:CHATBOT_BREAKDOWN_ROWS])
+    if latest:
+        lines.append("")
+        lines.append("**Latest:**")
+        for i, row in enumerate(latest):
+            when = datetime.fromtimestamp(row['at']).strftime('%Y-%m-%d %H:%M')
+            lines.append(f"{i+1}. [{row['id']}] {row['subject']} — {form_label(row['form'])}, {row['status']}, {when}")
+    return "\n".join(lines)
+
+def build_chatbot_answer(intent):
+    """The reply text for a routed intent, or None if the data could not be read."""
+    if intent['name'] == 'summary':
+        summary = get_submission_summary()
+        if not summary:
+            return None
+        return (
+            f"**📊 Dashboard Summary (Live Data):**\n\n"
+            f"- **Total Submissions:** {summary['total_submissions']}\n"
+            f"- **Pending Approvals:** {summary['pending_approvals']} (Overdue)\n"
+            f"- **Active Alerts:** {summary['active_alerts']}\n"
+            f"- **Approved Today:** {summary['approved_today']}\n\n"
+            f"Ask for **'recent logs'** for system activity."
+        )
+    if intent['name'] == 'activity_log':
+        activities = get_recent_activity(count=5)
+        if activities is None:
+            return None
+        if not activities:
+            return "No recent activity logs found."
+        reply_lines = ["**🕒 Recent System Activity (Last 5 Events):**"]
+        for i, act in enumerate(activities):
+            time_str = datetime.fromisoformat(act['timestamp']).strftime('%H:%M:%S')
+            reply_lines.append(f"{i+1}. **[{time_str}] {act['action']}**: {act['details']}")
+        return "\n".join(reply_lines)
+
+    slots = intent['slots']
+    try:
+        db = get_read_db()
+        rows = count_chatbot_submissions(db, slots)
+        latest = latest_chatbot_submissions(db, slots) if slots['list'] else []
+    except sqlite3.Error as e:
+        print(f"Error answering chatbot query {intent}: {e}")
+        return None
+    return format_chatbot_count(slots, rows, latest)
+
+def answer_chatbot_intent(intent):
+    scope = CACHE_SCOPE_ACTIVITY if intent['name'] == 'activity_log' else CACHE_SCOPE_SUBMISSIONS
+    key = (json.dumps(intent, sort_keys=True), get_cache_version(scope))
+    now_ts = time.time()
+    with _chatbot_answer_cache_lock:
+        cached = _chatbot_answer_cache.get(key)
+        if cached is not None and cached[1] > now_ts:
+            _chatbot_answer_cache.move_to_end(key)
+            return cached[0]
+    reply = build_chatbot_answer(intent)
+    if reply is not None:
+        with _chatbot_answer_cache_lock:
+            _chatbot_answer_cache[key] = (reply, now_ts + CHATBOT_ANSWER_TTL_SECONDS)
+            while len(_chatbot_answer_cache) > CHATBOT_ANSWER_CACHE_MAX:
+                _chatbot_answer_cache.popitem(last=False)
+    return reply
+
+# --- LLM FALLBACK ---
+# Questions the intent router does not recognise go to a chat model through a small
+# interface (any object with `name` and `generate(prompt) -> str`), so the Gemini client can
+# be swapped for FakeChatModel locally. In front of the model:
+#   - replies are cached in chat_history keyed by a hash of model + instructions + the
+#     normalized question, so rephrasings that differ only in case/spacing/punctuation hit;
+#   - identical questions arriving while one is in flight wait for it (single flight);
+#   - each user spends a token per model call from a bucket kept in llm_rate_limits, so the
+#     limit holds across workers;
+#   - calls run on a capped executor, never on the request thread, and stream their text
+#     chunks back to it (/api/chatbot_stream relays them to the chat widget as SSE).
+
+LLM_INSTRUCTIONS = (
+    "You are an Executive HOI Dashboard Assistant. Your role is to provide ONLY business-related, factual, and concise answers "
+    "based on the provided context (if any) or general business knowledge. DO NOT provide complex programming advice. "
+)
+LLM_STATS = {'model_calls': 0, 'cache_hits': 0, 'coalesced': 0, 'rate_limited': 0, 'busy': 0, 'timeouts': 0, 'errors': 0}
+
+class GeminiChatModel:
+    def __init__(self, client, model):
+        self.client = client
+        self.name = model
+
+    def generate(self, prompt):
+        return self.client.models.generate_content(model=self.name, contents=prompt).text
+
+    def stream(self, prompt):
+        for chunk in self.client.models.generate_content_stream(model=self.name, contents=prompt):
+            yield chunk.text or ''
+
+class FakeChatModel:
+    """Answers every prompt locally after `delay` seconds (development and load tests)."""
+    name = 'fake'
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def generate(self, prompt):
+        time.sleep(self.delay)
+        return self.reply_to(prompt)
+
+    def stream(self, prompt):
+        words = self.reply_to(prompt).split(' ')
+        for i, word in enumerate(words):
+            time.sleep(self.delay / len(words))
+            yield word if i == 0 else ' ' + word
+
+    def reply_to(self, prompt):
+        return f"(fake model) You asked: {prompt.rsplit('User Query: ', 1)[-1]}"
+
+def create_llm_model():
+    if LLM_BACKEND == 'fake':
+        return FakeChatModel(LLM_FAKE_DELAY_SECONDS)
+    if LLM_BACKEND == 'gemini' and client is not None:
+        return GeminiChatModel(client, LLM_MODEL)
+    return None
+
+llm_model = create_llm_model()
+
+def set_llm_model(model):
+    """Replaces the chat model (None disables the fallback)."""
+    global llm_model
+    llm_model = model
+
+class LLMRateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class LLMBusy(Exception):
+    pass
+
+class _LLMFlight:
+    """One model call in progress. `chunks` (streamed calls only) receives the text as it
+    arrives, then None."""
+    def __init__(self, stream):
+        self.future = None
+        self.chunks = queue.Queue() if stream else None
+
+class LLMReply:
+    """A reply being produced: iterating it yields text chunks (a cached or coalesced reply
+    comes as one chunk) and frees the request's pending slot at the end; release() does the
+    same for a reply that is never iterated."""
+    def __init__(self, source, reply=None, flight=None):
+        self.source = source
+        self.reply = reply
+        self.flight = flight
+        self._pending = flight is not None
+
+    def __iter__(self):
+        try:
+            if self.flight is None:
+                yield self.reply
+                return
+            deadline = time.monotonic() + LLM_TIMEOUT_SECONDS
+            try:
+                if self.source == 'model' and self.flight.chunks is not None:
+                    while True:
+                        chunk = self.flight.chunks.get(timeout=max(0.0, deadline - time.monotonic()))
+                        if chunk is None:
+                            break
+                        yield chunk
+                    self.reply = self.flight.future.result(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    self.reply = self.flight.future.result(timeout=max(0.0, deadline - time.monotonic()))
+                    yield self.reply
+            except (queue.Empty, concurrent.futures.TimeoutError):
+                LLM_STATS['timeouts'] += 1
+                raise TimeoutError("The assistant took too long to answer.")
+        finally:
+            self.release()
+
+    def release(self):
+        if self._pending:
+            self._pending = False
+            _llm_pending.release()
+
+_llm_flights = {}
+_llm_flights_lock = threading.Lock()
+_llm_pending = threading.BoundedSemaphore(LLM_MAX_PENDING)
+_llm_executor = None
+_llm_executor_lock = threading.Lock()
+
+def llm_executor():
+    global _llm_executor
+    with _llm_executor_lock:
+        if _llm_executor is None:
+            _llm_executor = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix='llm')
+        return _llm_executor
+
+def stop_llm_executor():
+    global _llm_executor
+    with _llm_executor_lock:
+        executor, _llm_executor = _llm_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def normalize_prompt(message):
+    text = ' '.join(unicodedata.normalize('NFKC', message).casefold().split())
+    return text.rstrip(' ?!.')
+
+def llm_prompt_key(model_name, message):
+    return hashlib.sha256(f"{model_name}\n{LLM_INSTRUCTIONS}\n{normalize_prompt(message)}".encode('utf-8')).hexdigest()[:32]
+
+def llm_cache_get(key):
+    now_ts = time.time()
+    row = get_read_db().execute(
+        "SELECT assistant_reply, timestamp, last_used_at FROM chat_history WHERE prompt_key = ?", (key,)).fetchone()
+    if row is None or row['timestamp'] < now_ts - LLM_CACHE_TTL_SECONDS:
+        return None
+    # Recency only orders eviction, so it is written at most once a minute per entry.
+    if row['last_used_at'] < now_ts - 60:
+        with db_writer() as db:
+            db.execute("UPDATE chat_history SET last_used_at = ? WHERE prompt_key = ?", (now_ts, key))
+    return row['assistant_reply']
+
+def llm_cache_put(key, message, reply, model_name, user):
+    now_ts = time.time()
+    with db_writer() as db:
+        db.execute("""
+            INSERT INTO chat_history (timestamp, user_message, assistant_reply, session_id, prompt_key, model, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(prompt_key) DO UPDATE SET
+                timestamp = excluded.timestamp, user_message = excluded.user_message,
+                assistant_reply = excluded.assistant_reply, session_id = excluded.session_id,
+                model = excluded.model, last_used_at = excluded.last_used_at
+        """, (now_ts, message, reply, user, key, model_name, now_ts))
+        db.execute("DELETE FROM chat_history WHERE prompt_key IS NOT NULL AND timestamp < ?", (now_ts - LLM_CACHE_TTL_SECONDS,))
+        db.execute("""
+            DELETE FROM chat_history WHERE id IN (
+                SELECT id FROM chat_history WHERE prompt_key IS NOT NULL
+                ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (LLM_CACHE_MAX_ENTRIES,))
+
+def take_llm_token(user):
+    """Spends one of the user's model calls. Returns 0, or the seconds until one is available."""
+    if LLM_RATE_LIMIT_PER_MINUTE <= 0:
+        return 0
+    now_ts = time.time()
+    rate = LLM_RATE_LIMIT_PER_MINUTE / 60
+    with db_writer() as db:
+        row = db.execute("SELECT tokens, updated_at FROM llm_rate_limits WHERE user = ?", (user,)).fetchone()
+        tokens = LLM_RATE_LIMIT_BURST if row is None else min(LLM_RATE_LIMIT_BURST, row[0] + (now_ts - row[1]) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        db.execute("""
+            INSERT INTO llm_rate_limits (user, tokens, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+        """, (user, tokens - 1, now_ts))
+    return 0
+
+def _run_llm_call(key, flight, model, message, user):
+    """Executor job: one model call. It caches the reply itself, so a reply whose request
+    timed out or disconnected is still there for the next ask."""
+    prompt = LLM_INSTRUCTIONS + f"User Query: {message}"
+    try:
+        if flight.chunks is not None and hasattr(model, 'stream'):
+            parts = []
+            for chunk in model.stream(prompt):
+                if chunk:
+                    parts.append(chunk)
+                    flight.chunks.put(chunk)
+            reply = ''.join(parts)
+        else:
+            reply = model.generate(prompt)
+            if flight.chunks is not None:
+                flight.chunks.put(reply)
+        llm_cache_put(key, message, reply, model.name, user)
+        return reply
+    except BaseException:
+        LLM_STATS['errors'] += 1
+        raise
+    finally:
+        with _llm_flights_lock:
+            if _llm_flights.get(key) is flight:
+                del _llm_flights[key]
+        if flight.chunks is not None:
+            flight.chunks.put(None)
+
+def begin_llm_reply(message, user, stream=False):
+    """Returns an LLMReply from the cache, joined to an identical call in flight, or from a
+    new model call. Raises LLMBusy when this worker already has LLM_MAX_PENDING chat requests
+    waiting, and LLMRateLimited when `user` is out of model calls.
+    """
+    model = llm_model
+    key = llm_prompt_key(model.name, message)
+    reply = llm_cache_get(key)
+    if reply is not None:
+        LLM_STATS['cache_hits'] += 1
+        return LLMReply('cache', reply=reply)
+
+    if not _llm_pending.acquire(blocking=False):
+        LLM_STATS['busy'] += 1
+        raise LLMBusy()
+    try:
+        with _llm_flights_lock:
+            flight = _llm_flights.get(key)
+        if flight is None:
+            retry_after = take_llm_token(user)
+            if retry_after:
+                LLM_STATS['rate_limited'] += 1
+                raise LLMRateLimited(retry_after)
+            with _llm_flights_lock:
+                flight = _llm_flights.get(key)
+                if flight is None:
+                    flight = _llm_flights[key] = _LLMFlight(stream)
+                    flight.future = llm_executor().submit(_run_llm_call, key, flight, model, message, user)
+                    LLM_STATS['model_calls'] += 1
+                    return LLMReply('model', flight=flight)
+        LLM_STATS['coalesced'] += 1
+        return LLMReply('coalesced', flight=flight)
+    except BaseException:
+        _llm_pending.release()
+        raise
+
+def generate_llm_reply(message, user):
+    """Returns (reply, source) with source 'cache', 'coalesced' or 'model'. Raises
+    LLMBusy, LLMRateLimited, TimeoutError, or whatever the model raised."""
+    reply = begin_llm_reply(message, user)
+    return ''.join(reply), reply.source
+
+def llm_error_reply(e):
+    """(payload, status, headers) telling the chat widget why a reply failed."""
+    if isinstance(e, LLMRateLimited):
+        retry_after = math.ceil(e.retry_after)
+        return ({"status": "ok", "reply": f"You're asking the assistant questions faster than it can answer. Please try again in {retry_after} seconds."},
+                429, {'Retry-After': str(retry_after)})
+    if isinstance(e, LLMBusy):
+        return {"status": "ok", "reply": "The assistant is busy answering other questions. Please try again in a few seconds."}, 503, {'Retry-After': '5'}
+    if isinstance(e, TimeoutError):
+        return {"status": "ok", "reply": "The assistant is taking too long to answer. Please ask again in a minute."}, 504, {}
+    if isinstance(e, ResourceExhaustedError):
+        return {"status": "ok", "reply": "Sorry, the AI service has temporarily run out of quota. Please try again later."}, 200, {}
+    if isinstance(e, APIError):
+        return {"status": "ok", "reply": "There was an API error communicating with the AI service. Check the API key and service status."}, 200, {}
+    return {"status": "error", "reply": f"An unexpected error occurred in the chatbot service: {e}"}, 500, {}
+
+def format_chat_sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def get_llm_status():
+    row = get_read_db().execute("SELECT COUNT(*), MIN(timestamp) FROM chat_history WHERE prompt_key IS NOT NULL").fetchone()
+    with _llm_flights_lock:
+        in_flight = len(_llm_flights)
+    return {
+        'model': llm_model.name if llm_model is not None else None,
+        'max_concurrency': LLM_MAX_CONCURRENCY,
+        'max_pending': LLM_MAX_PENDING,
+        'cached_replies': row[0],
+        'oldest_cached_at': row[1],
+        'in_flight': in_flight,
+        'stats': dict(LLM_STATS),
+    }
+
 # --- CHATBOT ROUTE (Access restricted to reviewers only) ---
 @app.route('/api/chatbot_reply', methods=['POST'])
 def chatbot_reply():
@@ -655,63 +4969,71 @@ def chatbot_reply():
         return jsonify({"status": "ok", "reply": "Chatbot is for Reviewer access only."}), 403
     
     data = request.get_json() or {}
-    user_message = data.get('message', '').lower()
+    message = data.get('message', '')
 
     # --- 1. DASHBOARD-SPECIFIC QUERIES (Database Lookup) ---
-    dashboard_keywords = ["stats", "count", "summary", "forms", "pending", "activity", "recent", "log", "alert", "usage", "status", "today activity", "today"] 
-    is_dashboard_query = any(keyword in user_message for keyword in dashboard_keywords)
-
-    if is_dashboard_query:
-        if any(k in user_message for k in ["stats", "count", "summary", "forms", "pending", "alert", "status", "today activity", "today"]):
-            summary = get_submission_summary()
-            if summary:
-                reply = (
-                    f"**📊 Dashboard Summary (Live Data):**\n\n"
-                    f"- **Total Submissions:** {summary['total_submissions']}\n"
-                    f"- **Pending Approvals:** {summary['pending_approvals']} (Overdue)\n"
-                    f"- **Active Alerts:** {summary['active_alerts']}\n"
-                    f"- **Approved Today:** {summary['approved_today']}\n\n"
-                    f"Ask for **'recent logs'** for system activity."
-                )
-            else:
-                reply = "Sorry, I couldn't retrieve the submission statistics from the database right now."
-            return jsonify({"status": "ok", "reply": reply})
-
-        if any(k in user_message for k in ["recent", "log", "activity"]):
-            activities = get_recent_activity(count=5)
-            if activities:
-                reply_lines = ["**🕒 Recent System Activity (Last 5 Events):**"]
-                for i, act in enumerate(activities):
-                    time_str = datetime.fromisoformat(act['timestamp']).strftime('%H:%M:%S')
-                    reply_lines.append(f"{i+1}. **[{time_str}] {act['action']}**: {act['details']}")
-                reply = "\n".join(reply_lines)
-            else:
-                reply = "No recent activity logs found."
-            return jsonify({"status": "ok", "reply": reply})
+    intent = parse_chatbot_message(message)
+    if intent is not None:
+        reply = answer_chatbot_intent(intent)
+        if reply is None:
+            reply = "Sorry, I couldn't retrieve that from the database right now."
+        return jsonify({"status": "ok", "reply": reply, "intent": intent['name']})
 
     # --- 2. GENERAL LLM HANDLING (If no specific data query) ---
-    if not client:
+    user_message = message.lower()
+    if llm_model is None:
         return jsonify({"status": "ok", "reply": "LLM Chatbot is disabled (API key missing or client initialization failed)."}), 200
 
     try:
-        prompt = (
-            "You are an Executive HOI Dashboard Assistant. Your role is to provide ONLY business-related, factual, and concise answers "
-            "based on the provided context (if any) or general business knowledge. DO NOT provide complex programming advice. "
-            f"User Query: {user_message}"
-        )
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=prompt
-        )
-        llm_reply = response.text
-        return jsonify({"status": "ok", "reply": llm_reply})
+        llm_reply, source = generate_llm_reply(user_message, session.get('user', REVIEWER_USER))
+        return jsonify({"status": "ok", "reply": llm_reply, "source": source})
+    except Exception as e:
+        payload, status, headers = llm_error_reply(e)
+        return jsonify(payload), status, headers
+
+@app.route('/api/chatbot_stream', methods=['POST'])
+def chatbot_stream():
+    # Same questions as /api/chatbot_reply, answered as text/event-stream: `chunk` events carry
+    # LLM text as it is generated ({"text": ...}), then a `done` event carries the whole reply
+    # ({"status", "reply", "source" or "intent"}), or an `error` event ({"status", "reply"}).
+    # Refusals before the stream starts (not a reviewer, rate limited, busy) are plain JSON.
+    if session.get('role') != 'reviewer': 
+        return jsonify({"status": "ok", "reply": "Chatbot is for Reviewer access only."}), 403
+
+    data = request.get_json() or {}
+    message = data.get('message', '')
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    intent = parse_chatbot_message(message)
+    if intent is not None:
+        reply = answer_chatbot_intent(intent)
+        if reply is None:
+            reply = "Sorry, I couldn't retrieve that from the database right now."
+        done = format_chat_sse('done', {"status": "ok", "reply": reply, "intent": intent['name']})
+        return Response([done], mimetype='text/event-stream', headers=headers)
 
-    except ResourceExhaustedError:
-        return jsonify({"status": "ok", "reply": "Sorry, the AI service has temporarily run out of quota. Please try again later."}), 200
-    except APIError:
-        return jsonify({"status": "ok", "reply": "There was an API error communicating with the AI service. Check the API key and service status."}), 200
+    if llm_model is None:
+        return jsonify({"status": "ok", "reply": "LLM Chatbot is disabled (API key missing or client initialization failed)."}), 200
+    try:
+        llm_reply = begin_llm_reply(message.lower(), session.get('user', REVIEWER_USER), stream=True)
     except Exception as e:
-        return jsonify({"status": "error", "reply": f"An unexpected error occurred in the chatbot service: {e}"}), 500
+        payload, status, error_headers = llm_error_reply(e)
+        return jsonify(payload), status, error_headers
+
+    def generate():
+        parts = []
+        try:
+            for chunk in llm_reply:
+                parts.append(chunk)
+                yield format_chat_sse('chunk', {"text": chunk})
+            yield format_chat_sse('done', {"status": "ok", "reply": ''.join(parts), "source": llm_reply.source})
+        except Exception as e:
+            yield format_chat_sse('error', llm_error_reply(e)[0])
+
+    response = Response(generate(), mimetype='text/event-stream', headers=headers)
+    # A client that disconnects before the first chunk never runs the generator.
+    response.call_on_close(llm_reply.release)
+    return response
 
 
 # -------------------------------------------------------------------------------------
@@ -726,4 +5048,7 @@ if __name__ == '__main__':
     init_db()
 
     os.makedirs('templates/forms', exist_ok=True) 
+    # Only start background threads in the reloader's child process, not in the watcher.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     app.run(debug=True)
\ No newline at end of file
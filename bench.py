@@ -0,0 +1,779 @@
+"""Synthetic data and benchmarks for the executive dashboard (developer CLI commands).
+
+Kept out of app.py so gunicorn workers never load it. The commands register on the app's
+CLI when this module is the Flask app, e.g.:
+
+    flask --app bench bench-load --size 10k
+    flask --app bench bench-queries --rows 100000
+"""
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+import click
+
+import app as dashboard
+from app import (
+    app, pyarrow, EVENT_STATS, EXPORT_FORMATS, FakeChatModel, LLM_TIMEOUT_SECONDS, ONE_DAY_SECONDS, OTP_EMAIL_REF,
+    REVIEWER_USER, REVIEW_ACTIONS, SUBMISSIONS_PAGE_SIZE, SUBMISSION_LIST_COLUMNS, _read_pool, _writer,
+    acquire_read_connection, apply_status_deltas, backfill_submission_fields, close_db_connections, connect_db,
+    db_writer, export_csv, export_field_columns, export_query, export_submissions, flush_activity_log, get_db,
+    list_form_templates, log_activity, percentile, query_submissions_page, rebuild_rollups, rebuild_submission_stats,
+    record_events, release_read_connection, run_migrations, server_session_cookie, set_llm_model,
+    start_event_dispatcher, stop_event_dispatcher, stop_llm_executor, submission_created_event, summary_delta_event,
+)
+
+SYNTHETIC_STATUS_WEIGHTS = [('approved', 70), ('disapproved', 24), ('pending', 3), ('alert', 1), ('activity', 2)]
+
+def generate_synthetic_data(db, submissions=10000, activities=None, users=27, days=365, batch_size=20000, seed=42):
+    """Bulk-inserts realistic-looking rows for benchmarks. Timestamps are spread over `days`."""
+    rng = random.Random(seed)
+    forms = list_form_templates()
+    statuses = [status for status, weight in SYNTHETIC_STATUS_WEIGHTS for _ in range(weight)]
+    now = time.time()
+    activities = submissions if activities is None else activities
+
+    db.executemany("INSERT OR IGNORE INTO users (username, role) VALUES (?, 'submitter')",
+                   [(f"bench{i}@test.com",) for i in range(users)])
+    db.executemany("INSERT OR IGNORE INTO user_form_access (username, form) VALUES (?, ?)",
+                   [(f"bench{i}@test.com", forms[i % len(forms)]) for i in range(users)])
+
+    def submission_rows(count):
+        for i in range(count):
+            user_index = rng.randrange(users)
+            form = forms[user_index % len(forms)]
+            status = rng.choice(statuses)
+            if status == 'activity':
+                submitted_at = now - rng.uniform(0, ONE_DAY_SECONDS)
+            else:
+                submitted_at = now - rng.uniform(0, days * ONE_DAY_SECONDS)
+            approved_at = submitted_at + rng.uniform(600, 3 * ONE_DAY_SECONDS) if status in ('approved', 'disapproved', 'alert') else None
+            data = {'form_type': form, 'form_user': f"bench{user_index}@test.com", 'subject': f"{form} report {i}",
+                    'impact': rng.choice(['low', 'medium', 'high risk']), 'amount': rng.randint(0, 500000)}
+            yield (f"B{i:09d}", form, f"bench{user_index}@test.com", f"{form} report {i}", json.dumps(data),
+                   status, submitted_at, approved_at, REVIEWER_USER if approved_at else None, None)
+
+    def activity_rows(count):
+        for i in range(count):
+            yield (now - rng.uniform(0, days * ONE_DAY_SECONDS), f"bench{rng.randrange(users)}@test.com",
+                   'Form Submit: synthetic', f"Synthetic activity {i}.", 'FORM_SUBMIT')
+
+    for rows, sql in (
+        (submission_rows(submissions), """
+            INSERT OR IGNORE INTO submissions (id, form, user, subject, data, status, submittedAt, approvedAt, reviewedBy, remarks)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""),
+        (activity_rows(activities), """
+            INSERT INTO activities (timestamp, user, event, description, type) VALUES (?, ?, ?, ?, ?)"""),
+    ):
+        while True:
+            batch = [row for _, row in zip(range(batch_size), rows)]
+            if not batch:
+                break
+            db.executemany(sql, batch)
+            db.commit()
+    rebuild_submission_stats(db)
+
+def time_query(db, sql, params=(), repeat=50):
+    """Returns the median wall time in milliseconds of running `sql` and fetching all rows."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        db.execute(sql, params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def dashboard_benchmark_queries():
+    now = time.time()
+    return [
+        ('summary: status counters', "SELECT status, count FROM submission_stats", ()),
+        ('summary: approved today', "SELECT COUNT(*) FROM submissions WHERE status = 'approved' AND approvedAt > ?", (now - ONE_DAY_SECONDS,)),
+        ('sweeper: overdue activity', "SELECT id FROM submissions WHERE status = 'activity' AND submittedAt < ?", (now - ONE_DAY_SECONDS,)),
+        ('submissions: newest 50', f"SELECT {SUBMISSION_LIST_COLUMNS} FROM submissions ORDER BY submittedAt DESC, id DESC LIMIT 51", ()),
+        ('submissions: page after cursor', f"SELECT {SUBMISSION_LIST_COLUMNS} FROM submissions WHERE (submittedAt, id) < (?, ?) ORDER BY submittedAt DESC, id DESC LIMIT 51", (now - 200 * ONE_DAY_SECONDS, 'B')),
+        ('submissions: pending, newest 50', f"SELECT {SUBMISSION_LIST_COLUMNS} FROM submissions WHERE status = 'pending' ORDER BY submittedAt DESC, id DESC LIMIT 51", ()),
+        ('submissions: one form, newest 50', f"SELECT {SUBMISSION_LIST_COLUMNS} FROM submissions WHERE form = ? ORDER BY submittedAt DESC, id DESC LIMIT 51", ('safety.html',)),
+        ('submissions: one user, newest 50', f"SELECT {SUBMISSION_LIST_COLUMNS} FROM submissions WHERE user = ? ORDER BY submittedAt DESC, id DESC LIMIT 51", ('bench1@test.com',)),
+        ('fields: high risk form, newest 50', f"""SELECT {SUBMISSION_LIST_COLUMNS} FROM submissions WHERE form = ? AND EXISTS (
+            SELECT 1 FROM submission_fields f WHERE f.submission_id = submissions.id AND f.field = 'impact'
+            AND f.value_text = 'high risk' COLLATE NOCASE) ORDER BY submittedAt DESC, id DESC LIMIT 51""", ('safety.html',)),
+        ('activity: newest 10', "SELECT timestamp, event, description FROM activities ORDER BY timestamp DESC LIMIT 10", ()),
+    ]
+
+@app.cli.command('bench-queries')
+@click.option('--rows', default=1000000, show_default=True, help='Synthetic submissions to generate.')
+@click.option('--db-path', default='bench_dashboard.db', show_default=True, help='Scratch database (reused if it already has the rows).')
+@click.option('--threshold-ms', default=1.0, show_default=True, help='Median latency budget per query.')
+@click.option('--skip-migrations', is_flag=True, help='Benchmark without the indexes, for comparison.')
+def bench_queries_command(rows, db_path, threshold_ms, skip_migrations):
+    """Time the dashboard queries against a synthetic database."""
+    db = connect_db(db_path)
+    if skip_migrations:
+        run_migrations(db, target=1)
+    else:
+        run_migrations(db)
+    existing = db.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+    if existing < rows:
+        click.echo(f"Generating {rows - existing} synthetic submissions in {db_path} ...")
+        started = time.time()
+        generate_synthetic_data(db, submissions=rows)
+        click.echo(f"Generated in {time.time() - started:.1f}s.")
+        if not skip_migrations:
+            rebuild_rollups(db)
+    if not skip_migrations:
+        backfill_submission_fields(db, batch_size=20000)
+    db.execute("ANALYZE")
+
+    failures = 0
+    click.echo(f"{'query':<36} {'median ms':>10}  plan")
+    for label, sql, params in dashboard_benchmark_queries():
+        median_ms = time_query(db, sql, params)
+        plan = '; '.join(row['detail'] for row in db.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        flag = 'ok' if median_ms <= threshold_ms else 'SLOW'
+        failures += flag == 'SLOW'
+        click.echo(f"{label:<36} {median_ms:>10.3f}  [{flag}] {plan}")
+    db.close()
+    if failures:
+        raise SystemExit(1)
+
+@app.cli.command('bench-activity-log')
+@click.option('--events', default=20000, show_default=True, help='Events to log per mode.')
+@click.option('--db-path', default='bench_activity.db', show_default=True, help='Scratch database.')
+def bench_activity_log_command(events, db_path):
+    """Compare log_activity throughput in sync and buffered mode."""
+    original = (dashboard.DATABASE, dashboard.ACTIVITY_LOG_MODE)
+    dashboard.DATABASE = db_path
+    try:
+        with app.app_context():
+            run_migrations(get_db())
+        for mode in ('sync', 'buffered'):
+            dashboard.ACTIVITY_LOG_MODE = mode
+            with app.app_context():
+                started = time.perf_counter()
+                for i in range(events):
+                    log_activity('Benchmark Event', f'Synthetic event {i}.', 'BENCH')
+                flush_activity_log()
+                elapsed = time.perf_counter() - started
+            click.echo(f"{mode:<9} {events} events in {elapsed:.2f}s = {events / elapsed:,.0f} events/s")
+    finally:
+        flush_activity_log()
+        close_db_connections()
+        dashboard.DATABASE, dashboard.ACTIVITY_LOG_MODE = original
+
+def read_rss_kb(field='VmRSS'):
+    """Resident memory of this process in KB (Linux only; None elsewhere). field='RssAnon'
+    leaves out file-backed pages such as SQLite's memory-mapped database."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def bench_reviewer_cookies(db_path, users):
+    """Registers `users` as reviewers in the database at db_path and returns {user: Cookie
+    header value} with a fresh session for each."""
+    db = connect_db(db_path)
+    db.executemany("""
+        INSERT INTO users (username, role) VALUES (?, 'reviewer')
+        ON CONFLICT(username) DO UPDATE SET role = 'reviewer'
+    """, [(user,) for user in users])
+    cookies = {user: server_session_cookie(db, user) for user in users}
+    db.commit()
+    db.close()
+    return cookies
+
+@app.cli.command('bench-events')
+@click.option('--connections', default=300, show_default=True, help='Idle /api/events streams to hold open.')
+@click.option('--events', default=20, show_default=True, help='Submissions to post while the streams are open.')
+@click.option('--idle-seconds', default=5.0, show_default=True, help='How long to measure the cost of idle streams.')
+@click.option('--url', default=None, help='Target a running server (e.g. gunicorn) with the same FLASK_SECRET_KEY instead of an in-process one; '
+                                          'pass its database as --db-path.')
+@click.option('--db-path', default='bench_events.db', show_default=True, help='Scratch database for the in-process server (or the database of --url).')
+def bench_events_command(connections, events, idle_seconds, url, db_path):
+    """Hold many idle event streams open and time how fast a submission reaches all of them."""
+    import selectors
+    from urllib.parse import urlparse
+    from urllib.request import Request, urlopen
+    from werkzeug.serving import make_server
+
+    original_database = dashboard.DATABASE
+    server = None
+    if url is None:
+        dashboard.DATABASE = db_path
+        # The in-process server starts a thread per connection, so the thread budget does not apply.
+        dashboard.EVENT_MAX_SUBSCRIBERS = max(dashboard.EVENT_MAX_SUBSCRIBERS, connections)
+        with app.app_context():
+            run_migrations(get_db())
+        start_event_dispatcher()
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+    target = urlparse(url)
+    cookie = bench_reviewer_cookies(db_path, ['bench-reviewer@test.com'])['bench-reviewer@test.com']
+    stream_request = (f"GET /api/events HTTP/1.1\r\nHost: {target.netloc}\r\nAccept: text/event-stream\r\n"
+                      f"Cookie: {cookie}\r\n\r\n").encode('ascii')
+
+    selector = selectors.DefaultSelector()
+    buffers = {}
+
+    def read_until(marker, timeout):
+        """Reads every stream until each has received `marker`. Returns {socket: arrival time}."""
+        arrived = {}
+        deadline = time.perf_counter() + timeout
+        while len(arrived) < len(buffers) and time.perf_counter() < deadline:
+            for key, _ in selector.select(timeout=0.1):
+                sock = key.fileobj
+                chunk = sock.recv(65536)
+                if not chunk:
+                    selector.unregister(sock)
+                    buffers.pop(sock)
+                    continue
+                buffers[sock] += chunk
+                if sock not in arrived and marker in buffers[sock]:
+                    arrived[sock] = time.perf_counter()
+        return arrived
+
+    rss_before, threads_before = read_rss_kb(), threading.active_count()
+    started = time.perf_counter()
+    try:
+        for _ in range(connections):
+            sock = socket.create_connection((target.hostname, target.port or 80))
+            sock.sendall(stream_request)
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+            buffers[sock] = b''
+        read_until(b'retry:', timeout=30)
+        open_streams = len([buf for buf in buffers.values() if buf.startswith(b'HTTP/1.1 200') and b'retry:' in buf])
+        click.echo(f"streams open      {open_streams}/{connections} in {time.perf_counter() - started:.2f}s")
+        if server is not None:
+            rss_after = read_rss_kb()
+            if rss_before and rss_after:
+                click.echo(f"process RSS       +{(rss_after - rss_before) / 1024:.1f} MB "
+                           f"({(rss_after - rss_before) / max(open_streams, 1):.0f} KB per stream, client sockets included)")
+            click.echo(f"threads           +{threading.active_count() - threads_before}")
+
+            polls_before, cpu_before = EVENT_STATS['polls'], time.process_time()
+            time.sleep(idle_seconds)
+            click.echo(f"idle cost         {time.process_time() - cpu_before:.3f}s CPU over {idle_seconds:.0f}s, "
+                       f"{EVENT_STATS['polls'] - polls_before} dispatcher polls")
+
+        latencies = []
+        for i in range(events):
+            for sock in buffers:
+                buffers[sock] = b''
+            body = json.dumps({'form_type': 'bench.html', 'form_user': 'bench0@test.com', 'subject': f'Event bench {i}'}).encode('utf-8')
+            posted = time.perf_counter()
+            urlopen(Request(f"{url}/api/submit_form", data=body, headers={'Content-Type': 'application/json'})).read()
+            arrived = read_until(b'event: submission_created', timeout=10)
+            latencies.extend((at - posted) * 1000 for at in arrived.values())
+            missing = len(buffers) - len(arrived)
+            if missing:
+                click.echo(f"event {i}: {missing} stream(s) did not receive it within 10s")
+        if latencies:
+            click.echo(f"fan-out latency   p50 {percentile(latencies, 0.5):.1f} ms, p95 {percentile(latencies, 0.95):.1f} ms, "
+                       f"max {max(latencies):.1f} ms ({events} events x {len(buffers)} streams, POST included)")
+    finally:
+        for sock in list(buffers):
+            sock.close()
+        if server is not None:
+            server.shutdown()
+            stop_event_dispatcher()
+            flush_activity_log()
+            close_db_connections()
+        dashboard.DATABASE = original_database
+
+@app.cli.command('bench-chat')
+@click.option('--chats', default=32, show_default=True, help='Chat clients asking distinct (uncached) questions at the same time.')
+@click.option('--readers', default=4, show_default=True, help='Dashboard clients submitting forms and reloading the summary and list.')
+@click.option('--seconds', default=10.0, show_default=True, help='Length of each phase.')
+@click.option('--delay', default=3.0, show_default=True, help='Fake model latency for the in-process server.')
+@click.option('--url', default=None, help='Target a running server (e.g. gunicorn) started with LLM_BACKEND=fake, '
+                                          'LLM_RATE_LIMIT_PER_MINUTE=0 and the same FLASK_SECRET_KEY; pass its database as --db-path.')
+@click.option('--db-path', default='bench_chat.db', show_default=True, help='Scratch database for the in-process server (or the database of --url).')
+def bench_chat_command(chats, readers, seconds, delay, url, db_path):
+    """Measure dashboard throughput alone, then while slow LLM replies are streaming."""
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    from werkzeug.serving import make_server
+
+    original = (dashboard.DATABASE, dashboard.LLM_RATE_LIMIT_PER_MINUTE, dashboard.llm_model)
+    server = None
+    if url is None:
+        dashboard.DATABASE, dashboard.LLM_RATE_LIMIT_PER_MINUTE = db_path, 0
+        set_llm_model(FakeChatModel(delay))
+        with app.app_context():
+            run_migrations(get_db())
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+        click.echo("in-process server (one thread per request); use --url against gunicorn to see thread starvation")
+    cookies = bench_reviewer_cookies(db_path, ['bench-reviewer@test.com'] + [f'bench-chat-{i}@test.com' for i in range(chats)])
+
+    def call(path, payload=None, user='bench-reviewer@test.com'):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request_ = Request(url + path, data=body, headers={'Content-Type': 'application/json', 'Cookie': cookies[user]})
+        try:
+            with urlopen(request_, timeout=LLM_TIMEOUT_SECONDS + 30) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+    def dashboard_client(deadline, latencies):
+        while time.time() < deadline:
+            for path, payload in (('/api/submit_form', {'form_type': 'bench.html', 'form_user': 'bench0@test.com', 'subject': 'Chat bench'}),
+                                  ('/api/summary', None), ('/api/submissions?limit=20', None)):
+                started = time.perf_counter()
+                call(path, payload)
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    def chat_client(index, deadline, outcomes):
+        asked = 0
+        while time.time() < deadline:
+            asked += 1
+            started = time.perf_counter()
+            status = call('/api/chatbot_stream', {'message': f"bench question {index}-{asked}-{uuid.uuid4().hex[:8]}"}, f'bench-chat-{index}@test.com')
+            outcomes.append((status, time.perf_counter() - started))
+            if status != 200:
+                time.sleep(1)
+
+    def run_phase(with_chats):
+        deadline = time.time() + seconds
+        latencies, outcomes = [], []
+        threads = [threading.Thread(target=dashboard_client, args=(deadline, latencies)) for _ in range(readers)]
+        if with_chats:
+            threads += [threading.Thread(target=chat_client, args=(i, deadline, outcomes)) for i in range(chats)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        click.echo(f"  dashboard        {len(latencies) / seconds:7.1f} req/s, p50 {percentile(latencies, 0.5):.1f} ms, "
+                   f"p95 {percentile(latencies, 0.95):.1f} ms, max {max(latencies):.1f} ms")
+        if with_chats:
+            statuses = {}
+            for status, _ in outcomes:
+                statuses[status] = statuses.get(status, 0) + 1
+            answered = [elapsed for status, elapsed in outcomes if status == 200]
+            click.echo(f"  chat             {len(outcomes)} questions, statuses {dict(sorted(statuses.items()))}"
+                       + (f", answered in {sum(answered) / len(answered):.2f}s on average" if answered else ""))
+
+    try:
+        click.echo(f"dashboard only ({readers} clients, {seconds:.0f}s)")
+        run_phase(False)
+        click.echo(f"dashboard + {chats} chat clients")
+        run_phase(True)
+    finally:
+        if server is not None:
+            server.shutdown()
+            stop_llm_executor()
+            flush_activity_log()
+            close_db_connections()
+        dashboard.DATABASE, dashboard.LLM_RATE_LIMIT_PER_MINUTE = original[:2]
+        set_llm_model(original[2])
+
+LOAD_BENCH_SIZES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+# Relative weight of each client action. An OTP login is two requests (send_otp + login).
+LOAD_BENCH_MIX = [('summary', 4), ('submissions', 4), ('submit_form', 2), ('process_approval', 1), ('otp_login', 1)]
+LOAD_BENCH_REVIEWER = 'bench-reviewer@test.com'
+
+def prepare_load_bench_db(db_path, rows):
+    """Migrated scratch database with `rows` users, submissions and activities (reused if big enough)."""
+    db = connect_db(db_path)
+    run_migrations(db)
+    existing = db.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+    if existing < rows:
+        click.echo(f"Generating {rows - existing} synthetic users/submissions/activities in {db_path} ...")
+        started = time.time()
+        generate_synthetic_data(db, submissions=rows, users=rows)
+        rebuild_rollups(db)
+        backfill_submission_fields(db, batch_size=20000)
+        db.execute("ANALYZE")
+        db.commit()
+        click.echo(f"Generated in {time.time() - started:.1f}s.")
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.close()
+
+def start_load_bench_server(db_path, workers, threads):
+    """Starts gunicorn on a free local port with mail suppressed, a fake LLM and no OTP limits.
+    Returns (process, url)."""
+    import subprocess
+    import sys
+
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    env = dict(os.environ, DATABASE_PATH=os.path.abspath(db_path), FLASK_SECRET_KEY=app.secret_key,
+               MAIL_SUPPRESS_SEND='1', LLM_BACKEND='fake', GUNICORN_THREADS=str(threads),
+               OTP_EMAIL_RATE_PER_HOUR='0', OTP_IP_RATE_PER_HOUR='0')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+         '--log-level', 'warning'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise click.ClickException(f"gunicorn exited with status {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise click.ClickException("gunicorn did not start within 60s")
+
+def _load_bench_client(index, url, db_path, reviewer_cookie, deadline, warmup_until, samples, seed):
+    """One virtual user: picks actions from LOAD_BENCH_MIX over a keep-alive connection and
+    appends (endpoint, ms, ok) for every request made after the warmup."""
+    import http.client
+    from urllib.parse import urlsplit
+
+    target = urlsplit(url)
+    rng = random.Random(seed)
+    submitter = f"bench{index}@test.com"
+    actions = [name for name, weight in LOAD_BENCH_MIX for _ in range(weight)]
+    outbox = sqlite3.connect(db_path, timeout=30)
+    connection = None
+    to_review = []
+
+    def call(endpoint, method, path, body=None, cookie=None, form=False, expect=(200,)):
+        nonlocal connection
+        headers = {'Cookie': cookie} if cookie else {}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded' if form else 'application/json'
+            body = urlencode(body) if form else json.dumps(body)
+        started = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection(target.hostname, target.port, timeout=60)
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            payload = response.read()
+            ok = response.status in expect
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection, payload, ok = None, b'', False
+        if time.time() >= warmup_until:
+            samples.append((endpoint, (time.perf_counter() - started) * 1000, ok))
+        return payload if ok else None
+
+    try:
+        while time.time() < deadline:
+            action = rng.choice(actions)
+            if action == 'summary':
+                call('GET /api/summary', 'GET', '/api/summary', cookie=reviewer_cookie)
+            elif action == 'submissions':
+                call('GET /api/submissions', 'GET', f"/api/submissions?limit={SUBMISSIONS_PAGE_SIZE}", cookie=reviewer_cookie)
+            elif action == 'submit_form' or (action == 'process_approval' and not to_review):
+                payload = call('POST /api/submit_form', 'POST', '/api/submit_form', {
+                    'form_type': 'bench.html', 'form_user': submitter, 'subject': f"Load bench {index}",
+                    'impact': rng.choice(['low', 'medium', 'high risk']), 'amount': rng.randint(0, 500000)})
+                if payload:
+                    to_review.append(json.loads(payload)['id'])
+            elif action == 'process_approval':
+                call('POST /api/process_approval', 'POST', '/api/process_approval', {
+                    'submission_id': to_review.pop(), 'action': rng.choice(REVIEW_ACTIONS), 'remarks': 'Load bench'},
+                    cookie=reviewer_cookie)
+            elif action == 'otp_login':
+                if call('POST /api/send_otp', 'POST', '/api/send_otp', {'email': submitter}) is None:
+                    continue
+                # Read the code back from the queued mail, as the submitter would from their inbox.
+                row = outbox.execute("SELECT body FROM email_outbox WHERE recipient = ? AND ref = ? ORDER BY id DESC LIMIT 1",
+                                     (submitter, OTP_EMAIL_REF)).fetchone()
+                code = re.search(r'is: (\d{6})', row[0]).group(1) if row else ''
+                call('POST / (OTP login)', 'POST', '/', {'email': submitter, 'otp': code}, form=True, expect=(302,))
+    finally:
+        if connection is not None:
+            connection.close()
+        outbox.close()
+
+def summarize_load_samples(samples, seconds):
+    """Per-endpoint requests, req/s, p50/p95/p99 ms and errors."""
+    report = {}
+    for endpoint in sorted({endpoint for endpoint, _, _ in samples}):
+        latencies = [ms for name, ms, _ in samples if name == endpoint]
+        report[endpoint] = {
+            'requests': len(latencies),
+            'rps': round(len(latencies) / seconds, 1),
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'errors': len([1 for name, _, ok in samples if name == endpoint and not ok]),
+        }
+    return report
+
+def compare_load_reports(report, baseline, tolerance, min_delta_ms):
+    """Returns the regressions of `report` against `baseline`, as readable strings. p95 counts
+    as slower only past both the relative tolerance and min_delta_ms, so noise on
+    sub-millisecond endpoints does not fail a run."""
+    regressions = []
+    for endpoint, base in baseline['endpoints'].items():
+        current = report['endpoints'].get(endpoint)
+        if current is None:
+            regressions.append(f"{endpoint}: no requests completed")
+            continue
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance) and current['p95_ms'] - base['p95_ms'] > min_delta_ms:
+            regressions.append(f"{endpoint}: p95 {base['p95_ms']} -> {current['p95_ms']} ms")
+        if current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{endpoint}: {base['rps']:.1f} -> {current['rps']:.1f} req/s")
+        if current['errors'] > base['errors']:
+            regressions.append(f"{endpoint}: {current['errors']} errors (baseline {base['errors']})")
+    return regressions
+
+@app.cli.command('bench-load')
+@click.option('--size', type=click.Choice(list(LOAD_BENCH_SIZES)), default='10k', show_default=True,
+              help='Synthetic users, submissions and activities in the scratch database.')
+@click.option('--clients', default=16, show_default=True, help='Concurrent virtual users.')
+@click.option('--seconds', default=30.0, show_default=True, help='Measured duration.')
+@click.option('--warmup', default=5.0, show_default=True, help='Unmeasured seconds before that.')
+@click.option('--workers', default=2, show_default=True, help='Gunicorn workers for the local server.')
+@click.option('--threads', default=32, show_default=True, help='Threads per gunicorn worker.')
+@click.option('--seed', default=1, show_default=True, help='Seeds the action mix of every client.')
+@click.option('--url', default=None, help='Target a running server instead of starting gunicorn. It needs the same FLASK_SECRET_KEY, '
+                                          'OTP rate limits off and --db-path pointing at its database (sessions are created '
+                                          'there and OTP codes are read from the outbox).')
+@click.option('--db-path', default=None, help='Scratch database [default: bench_load_<size>.db].')
+@click.option('--report', 'report_path', default=None, help='Write the results as JSON, e.g. to use as a baseline.')
+@click.option('--baseline', 'baseline_path', default=None, help='Fail if any endpoint regressed against this JSON report.')
+@click.option('--tolerance', default=0.2, show_default=True, help='Allowed p95 increase / req/s decrease against the baseline.')
+@click.option('--min-delta-ms', default=2.0, show_default=True, help='p95 increases smaller than this never count as regressions.')
+def bench_load_command(size, clients, seconds, warmup, workers, threads, seed, url, db_path, report_path, baseline_path,
+                       tolerance, min_delta_ms):
+    """Drive OTP login, submissions, approvals, the summary and the list against gunicorn and
+    report latency percentiles and throughput per endpoint."""
+    rows = LOAD_BENCH_SIZES[size]
+    db_path = db_path or f"bench_load_{size}.db"
+    process = None
+    if url is None:
+        prepare_load_bench_db(db_path, max(rows, clients))
+        process, url = start_load_bench_server(db_path, workers, threads)
+        click.echo(f"gunicorn: {workers} worker(s) x {threads} threads at {url}")
+    try:
+        reviewer_cookie = bench_reviewer_cookies(db_path, [LOAD_BENCH_REVIEWER])[LOAD_BENCH_REVIEWER]
+        samples = []
+        started = time.time()
+        warmup_until, deadline = started + warmup, started + warmup + seconds
+        client_threads = [threading.Thread(target=_load_bench_client, args=(index, url, db_path, reviewer_cookie, deadline, warmup_until,
+                                                                          samples, seed * 1000 + index))
+                          for index in range(clients)]
+        click.echo(f"{clients} clients, {warmup:.0f}s warmup + {seconds:.0f}s measured, {size} rows")
+        for thread in client_threads:
+            thread.start()
+        for thread in client_threads:
+            thread.join()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    report = {
+        'config': {'size': size, 'clients': clients, 'seconds': seconds, 'workers': workers, 'threads': threads, 'seed': seed},
+        'endpoints': summarize_load_samples(samples, seconds),
+    }
+    total = sum(endpoint['requests'] for endpoint in report['endpoints'].values())
+    click.echo(f"{'endpoint':<28} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for endpoint, stats in report['endpoints'].items():
+        click.echo(f"{endpoint:<28} {stats['requests']:>9} {stats['rps']:>8.1f} {stats['p50_ms']:>8.1f} "
+                   f"{stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats['errors']:>7}")
+    click.echo(f"{'total':<28} {total:>9} {total / seconds:>8.1f}")
+    if report_path:
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        click.echo(f"Report written to {report_path}")
+    if baseline_path:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('config') != report['config']:
+            click.echo(f"Warning: baseline was run with {baseline.get('config')}")
+        regressions = compare_load_reports(report, baseline, tolerance, min_delta_ms)
+        for regression in regressions:
+            click.echo(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+        click.echo(f"No regressions against {baseline_path} (tolerance {tolerance:.0%}, min delta {min_delta_ms} ms).")
+
+def _bench_read_dashboard(db):
+    """What a dashboard load reads: the summary counters and two list pages."""
+    db.execute("SELECT status, count FROM submission_stats").fetchall()
+    db.execute("SELECT COUNT(*) FROM submissions WHERE status = 'approved' AND approvedAt > ?",
+               (time.time() - ONE_DAY_SECONDS,)).fetchone()
+    query_submissions_page(db, {'status': ['activity']})
+    query_submissions_page(db, {})
+
+def _bench_write_submission(db, label):
+    """What submit_form writes, without the HTTP layer."""
+    now = time.time()
+    row = {'id': f"C{label}", 'form': 'bench.html', 'user': 'bench0@test.com', 'subject': f"Concurrency bench {label}",
+           'status': 'activity', 'submittedAt': now, 'approvedAt': None}
+    db.execute("""
+        INSERT INTO submissions (id, form, user, subject, data, status, submittedAt)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (row['id'], row['form'], row['user'], row['subject'], json.dumps(row), 'activity', now))
+    apply_status_deltas(db, {'activity': 1})
+    record_events(db, [submission_created_event(row), summary_delta_event({'activity': 1})])
+
+def _concurrency_bench_process(role, mode, path, seconds, threads, results):
+    """One simulated worker process running `threads` request threads of one role."""
+    dashboard.DATABASE = path
+    # Connections must never cross a fork; start this process with empty pools.
+    _read_pool.clear()
+    _writer.update(path=None, db=None)
+    latencies, errors = [], []
+    deadline = time.time() + seconds
+
+    def run(thread_index):
+        count = 0
+        while time.time() < deadline:
+            count += 1
+            started = time.perf_counter()
+            try:
+                if mode == 'legacy':
+                    # The old get_db(): a default connection opened for every request.
+                    db = sqlite3.connect(path)
+                    db.row_factory = sqlite3.Row
+                    try:
+                        if role == 'read':
+                            _bench_read_dashboard(db)
+                        else:
+                            _bench_write_submission(db, f"{os.getpid()}-{thread_index}-{count}")
+                            db.commit()
+                    finally:
+                        db.close()
+                elif role == 'read':
+                    entry = acquire_read_connection()
+                    try:
+                        _bench_read_dashboard(entry[1])
+                    finally:
+                        release_read_connection(*entry)
+                else:
+                    with db_writer() as db:
+                        _bench_write_submission(db, f"{os.getpid()}-{thread_index}-{count}")
+                latencies.append((time.perf_counter() - started) * 1000)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+
+    request_threads = [threading.Thread(target=run, args=(index,)) for index in range(threads)]
+    for thread in request_threads:
+        thread.start()
+    for thread in request_threads:
+        thread.join()
+    results.put((role, latencies, errors))
+
+@app.cli.command('bench-concurrency')
+@click.option('--rows', default=100000, show_default=True, help='Synthetic submissions in the scratch database.')
+@click.option('--readers', default=2, show_default=True, help='Processes serving dashboard reads.')
+@click.option('--writers', default=2, show_default=True, help='Processes serving submissions.')
+@click.option('--threads', default=4, show_default=True, help='Request threads per process.')
+@click.option('--seconds', default=5.0, show_default=True, help='Duration of each run.')
+@click.option('--db-path', default='bench_concurrency.db', show_default=True, help='Scratch database (reused if it already has the rows).')
+def bench_concurrency_command(rows, readers, writers, threads, seconds, db_path):
+    """Dashboard reads during a submission burst: old per-request connections vs WAL + pool + writer."""
+    import multiprocessing
+    import shutil
+
+    db = connect_db(db_path)
+    run_migrations(db)
+    existing = db.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+    if existing < rows:
+        click.echo(f"Generating {rows - existing} synthetic submissions in {db_path} ...")
+        generate_synthetic_data(db, submissions=rows)
+    db.execute("ANALYZE")
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.close()
+
+    context = multiprocessing.get_context('fork')
+    click.echo(f"{readers} reader + {writers} writer processes x {threads} threads, {seconds:.0f}s per mode")
+    click.echo(f"{'mode':<8} {'reads/s':>8} {'read p50':>9} {'read p95':>9} {'read max':>9} {'writes/s':>9} {'write p95':>10} {'errors':>7}")
+    for mode in ('legacy', 'tuned'):
+        path = f"{db_path}.{mode}"
+        shutil.copyfile(db_path, path)
+        scratch = sqlite3.connect(path)
+        scratch.execute(f"PRAGMA journal_mode = {'DELETE' if mode == 'legacy' else 'WAL'}")
+        scratch.close()
+
+        results = context.Queue()
+        processes = [context.Process(target=_concurrency_bench_process, args=(role, mode, path, seconds, threads, results))
+                     for role in ['read'] * readers + ['write'] * writers]
+        for process in processes:
+            process.start()
+        collected = {'read': ([], []), 'write': ([], [])}
+        for _ in processes:
+            role, latencies, errors = results.get()
+            collected[role][0].extend(latencies)
+            collected[role][1].extend(errors)
+        for process in processes:
+            process.join()
+
+        (read_ms, read_errors), (write_ms, write_errors) = collected['read'], collected['write']
+        fmt = lambda value: f"{value:.1f}" if value is not None else '-'
+        click.echo(f"{mode:<8} {len(read_ms) / seconds:>8.0f} {fmt(percentile(read_ms, 0.5)):>9} {fmt(percentile(read_ms, 0.95)):>9} "
+                   f"{fmt(max(read_ms) if read_ms else None):>9} {len(write_ms) / seconds:>9.0f} "
+                   f"{fmt(percentile(write_ms, 0.95)):>10} {len(read_errors) + len(write_errors):>7}")
+        for error in sorted(set(read_errors + write_errors))[:3]:
+            click.echo(f"         {error}")
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+def _export_bench_process(path, fmt, with_fields, buffered, results):
+    """Runs one export in a fresh process so its memory can be measured on its own."""
+    dashboard.DATABASE = path
+    baseline_kb = peak_kb = read_rss_kb('RssAnon') or 0
+    stats, started = {}, time.perf_counter()
+    if buffered:
+        # What a one-shot export looks like: every row fetched, then the whole file built.
+        sql, params = export_query({}, with_fields)
+        db = connect_db(path, read_only=True)
+        field_columns = export_field_columns(db, {}) if with_fields else []
+        rows = db.execute(sql, params).fetchall()
+        db.close()
+        body = b''.join(export_csv([rows], field_columns))
+        stats = {'rows': len(rows), 'bytes': len(body)}
+        peak_kb = max(peak_kb, read_rss_kb('RssAnon') or 0)
+    else:
+        for _ in export_submissions({}, fmt, with_fields, stats):
+            peak_kb = max(peak_kb, read_rss_kb('RssAnon') or 0)
+    results.put((stats.get('rows', 0), stats.get('bytes', 0), time.perf_counter() - started, peak_kb - baseline_kb))
+
+@app.cli.command('bench-export')
+@click.option('--rows', default=2000000, show_default=True, help='Synthetic submissions to export.')
+@click.option('--db-path', default='bench_dashboard.db', show_default=True, help='Scratch database (reused if it already has the rows).')
+@click.option('--fields', is_flag=True, help='Include the flattened payload fields.')
+def bench_export_command(rows, db_path, fields):
+    """Export throughput and memory per format, against a fetch-everything CSV export."""
+    import multiprocessing
+
+    db = connect_db(db_path)
+    run_migrations(db)
+    existing = db.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+    if existing < rows:
+        click.echo(f"Generating {rows - existing} synthetic submissions in {db_path} ...")
+        generate_synthetic_data(db, submissions=rows)
+        rebuild_rollups(db)
+    if fields:
+        backfill_submission_fields(db, batch_size=20000)
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.close()
+
+    context = multiprocessing.get_context('fork')
+    runs = [(fmt, False) for fmt in EXPORT_FORMATS if fmt != 'parquet' or pyarrow is not None] + [('csv', True)]
+    click.echo(f"{'format':<16} {'rows':>9} {'MB':>8} {'seconds':>8} {'rows/s':>9} {'heap growth MB':>15}")
+    for fmt, buffered in runs:
+        results = context.Queue()
+        process = context.Process(target=_export_bench_process, args=(db_path, fmt, fields, buffered, results))
+        process.start()
+        exported, size, elapsed, growth_kb = results.get()
+        process.join()
+        label = f"{fmt} (fetchall)" if buffered else fmt
+        click.echo(f"{label:<16} {exported:>9} {size / 1e6:>8.1f} {elapsed:>8.1f} {exported / elapsed:>9,.0f} {growth_kb / 1024:>15.1f}")
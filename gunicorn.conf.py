@@ -0,0 +1,20 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app` (see Procfile).
+import os
+
+# /api/events keeps a response open per dashboard, so each connection holds a thread.
+# gthread workers serve those from a thread pool instead of blocking a whole sync worker.
+# app.py caps open streams per worker below GUNICORN_THREADS (EVENT_MAX_SUBSCRIBERS), so
+# some threads always stay free for submissions, approvals and logins; add workers rather
+# than threads for more dashboards (see `flask --app bench bench-events`).
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '128'))
+
+def post_worker_init(worker):
+    # Each worker starts its own background threads; leases in the DB decide which
+    # worker actually does the work.
+    from app import start_background_services
+    start_background_services()
+
+def worker_exit(server, worker):
+    from app import stop_background_services
+    stop_background_services()
@@ -1,7 +1,8 @@
 # app.py
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify, abort
-import os, json
-from datetime import datetime
+import os, json, threading, atexit, time, hashlib, unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import sqlite3
 from flask_bcrypt import Bcrypt
 import smtplib
@@ -55,6 +56,93 @@ if genai is not None:
 else:
     client = None
 
+# General questions go to a chat model: any object with `name` and `generate(prompt) -> str`.
+# Replies are cached per normalized prompt (LLM_CACHE_TTL_SECONDS, LRU beyond
+# LLM_CACHE_MAX_ENTRIES), identical questions in flight wait for one answer, and each user
+# may make LLM_RATE_LIMIT_PER_MINUTE model calls (bursts of LLM_RATE_LIMIT_BURST).
+LLM_CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "500"))
+LLM_RATE_LIMIT_PER_MINUTE = float(os.environ.get("LLM_RATE_LIMIT_PER_MINUTE", "6"))
+LLM_RATE_LIMIT_BURST = float(os.environ.get("LLM_RATE_LIMIT_BURST", "3"))
+
+class GeminiChatModel:
+    def __init__(self, client, model='gemini-2.5-flash'):
+        self.client = client
+        self.name = model
+
+    def generate(self, prompt):
+        return self.client.models.generate_content(model=self.name, contents=prompt).text
+
+class FakeChatModel:
+    name = 'fake'
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def generate(self, prompt):
+        time.sleep(self.delay)
+        return f"(fake model) You asked: {prompt}"
+
+if os.environ.get("LLM_BACKEND") == 'fake':
+    llm_model = FakeChatModel(float(os.environ.get("LLM_FAKE_DELAY_SECONDS", "1.0")))
+else:
+    llm_model = GeminiChatModel(client) if client is not None else None
+
+class LLMRateLimited(Exception):
+    pass
+
+_llm_cache = OrderedDict()
+_llm_flights = {}
+_llm_buckets = {}
+_llm_lock = threading.Lock()
+
+def take_llm_token(user):
+    if LLM_RATE_LIMIT_PER_MINUTE <= 0:
+        return True
+    now = time.time()
+    with _llm_lock:
+        tokens, updated = _llm_buckets.get(user, (LLM_RATE_LIMIT_BURST, now))
+        tokens = min(LLM_RATE_LIMIT_BURST, tokens + (now - updated) * LLM_RATE_LIMIT_PER_MINUTE / 60)
+        if tokens < 1:
+            return False
+        _llm_buckets[user] = (tokens - 1, now)
+        return True
+
+def generate_llm_reply(message, user):
+    normalized = ' '.join(unicodedata.normalize('NFKC', message).casefold().split()).rstrip(' ?!.')
+    key = hashlib.sha256(f"{llm_model.name}\n{normalized}".encode('utf-8')).hexdigest()
+    while True:
+        with _llm_lock:
+            cached = _llm_cache.get(key)
+            if cached is not None and cached[1] > time.time():
+                _llm_cache.move_to_end(key)
+                return cached[0]
+            flight = _llm_flights.get(key)
+            if flight is None:
+                flight = _llm_flights[key] = {'done': threading.Event(), 'error': None}
+                break
+        flight['done'].wait(120)
+        if flight['error'] is not None and not isinstance(flight['error'], LLMRateLimited):
+            raise flight['error']
+        # Otherwise the reply is in the cache now, or the leader's user was rate limited.
+
+    try:
+        if not take_llm_token(user):
+            raise LLMRateLimited()
+        reply = llm_model.generate(message)
+        with _llm_lock:
+            _llm_cache[key] = (reply, time.time() + LLM_CACHE_TTL_SECONDS)
+            while len(_llm_cache) > LLM_CACHE_MAX_ENTRIES:
+                _llm_cache.popitem(last=False)
+        return reply
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with _llm_lock:
+            del _llm_flights[key]
+        flight['done'].set()
+
 # -----------------------
 # Database & Utilities
 # -----------------------
@@ -73,25 +161,51 @@ def get_db(db_name_override=None):
 def serialize_row(row):
     return dict(row)
 
-def log_activity(title, description, action_type):
+# Activity rows are buffered and written in one transaction once ACTIVITY_LOG_BATCH_SIZE
+# rows are waiting or the oldest one is ACTIVITY_LOG_FLUSH_SECONDS old, instead of
+# opening a new connection and committing for every event. The first row of a batch starts
+# a timer, so an idle worker still writes it within ACTIVITY_LOG_FLUSH_SECONDS; leftovers
+# flush at exit.
+ACTIVITY_LOG_BATCH_SIZE = int(os.environ.get("ACTIVITY_LOG_BATCH_SIZE", "50"))
+ACTIVITY_LOG_FLUSH_SECONDS = float(os.environ.get("ACTIVITY_LOG_FLUSH_SECONDS", "2"))
+_activity_buffer = []
+_activity_buffer_lock = threading.Lock()
+
+def flush_activity_log():
+    with _activity_buffer_lock:
+        rows = _activity_buffer[:]
+        del _activity_buffer[:]
+    if not rows:
+        return
     conn = get_db()
     if conn:
         try:
-            cur = conn.cursor()
-            cur.execute("""
+            conn.executemany("""
                 INSERT INTO activity_log (timestamp, user, action, details, type)
                 VALUES (?, ?, ?, ?, ?)
-            """, (datetime.now().isoformat(), session.get('user', 'System'), title, description, action_type))
+            """, rows)
             conn.commit()
         except sqlite3.Error as err:
             print(f"Logging Error: {err}")
         finally:
-            try:
-                cur.close()
-            except Exception:
-                pass
             conn.close()
 
+atexit.register(flush_activity_log)
+
+def log_activity(title, description, action_type):
+    now = datetime.now()
+    with _activity_buffer_lock:
+        _activity_buffer.append((now.isoformat(), session.get('user', 'System'), title, description, action_type))
+        started_batch = len(_activity_buffer) == 1
+        oldest = datetime.fromisoformat(_activity_buffer[0][0])
+        due = len(_activity_buffer) >= ACTIVITY_LOG_BATCH_SIZE or (now - oldest).total_seconds() >= ACTIVITY_LOG_FLUSH_SECONDS
+    if due:
+        flush_activity_log()
+    elif started_batch:
+        timer = threading.Timer(ACTIVITY_LOG_FLUSH_SECONDS, flush_activity_log)
+        timer.daemon = True
+        timer.start()
+
 def send_email_notification(subject, body, recipients):
     """Sends an email notification. Returns True/False."""
     if not recipients:
@@ -198,22 +312,24 @@ def get_submission_summary():
         return None
     try:
         cur = conn.cursor()
-        cur.execute("SELECT COUNT(id) as total FROM forms_data")
-        total = cur.fetchone()['total'] or 0
-        cur.execute("SELECT COUNT(id) as pending FROM forms_data WHERE status = 'pending'")
-        pending = cur.fetchone()['pending'] or 0
-        cur.execute("SELECT COUNT(id) as alerts FROM forms_data WHERE is_alert = 1 AND status = 'pending'")
-        alerts = cur.fetchone()['alerts'] or 0
-
+        # One pass over forms_data instead of four COUNT queries. approved_at is an ISO
+        # string, so "today" is a plain range comparison rather than a LIKE pattern.
         today = datetime.now().strftime('%Y-%m-%d')
-        cur.execute("SELECT COUNT(id) as approved_today FROM forms_data WHERE status = 'approved' AND approved_at LIKE ?", (today + '%',))
-        approved_today = cur.fetchone()['approved_today'] or 0
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        cur.execute("""
+            SELECT COUNT(*) AS total,
+                   SUM(status = 'pending') AS pending,
+                   SUM(is_alert = 1 AND status = 'pending') AS alerts,
+                   SUM(status = 'approved' AND approved_at >= ? AND approved_at < ?) AS approved_today
+            FROM forms_data
+        """, (today, tomorrow))
+        row = cur.fetchone()
 
         return {
-            'total_submissions': total,
-            'pending_approvals': pending,
-            'active_alerts': alerts,
-            'approved_today': approved_today
+            'total_submissions': row['total'] or 0,
+            'pending_approvals': row['pending'] or 0,
+            'active_alerts': row['alerts'] or 0,
+            'approved_today': row['approved_today'] or 0
         }
     except sqlite3.Error as err:
         print(f"Summary Error: {err}")
@@ -282,14 +398,28 @@ def logout():
     log_activity(f"User Logout: {username}", "Logged out of the dashboard.", "LOGOUT")
     return redirect(url_for('index'))
 
+FORMS_DIR = os.path.join(app.root_path, app.template_folder or 'templates', 'forms')
+_form_names = None
+
+def known_form_names():
+    # Listed once at startup instead of stat()ing the file on every request;
+    # re-listed in debug so newly added forms show up without a restart.
+    global _form_names
+    if _form_names is None or app.debug:
+        try:
+            _form_names = frozenset(f for f in os.listdir(FORMS_DIR) if f.endswith('.html'))
+        except OSError:
+            _form_names = frozenset()
+    return _form_names
+
 @app.route("/api/load_form_template/<form_name>")
 def api_load_form_template(form_name):
     # ensure filename is safe and ends with .html
     if '..' in form_name or form_name.startswith('/') or not form_name.endswith('.html'):
         return "Invalid form name", 404
 
-    template_path = os.path.join(app.template_folder or 'templates', 'forms', form_name)
-    if not os.path.isfile(template_path):
+    template_path = os.path.join(FORMS_DIR, form_name)
+    if form_name not in known_form_names():
         print(f"Template not found: {template_path}")
         return f"Error loading form template: Failed to load form template: 404 NOT FOUND. Check templates/forms/{form_name}", 404
 
@@ -562,19 +692,17 @@ def chatbot_reply():
         return jsonify({"status": "ok", "reply": reply})
 
     # General LLM handling
-    if client is None:
+    if llm_model is None:
         reply = "⚠️ **LLM Service Initialization Failed** ⚠️. Please ensure your `GEMINI_API_KEY` is set correctly."
         return jsonify({"status": "error", "reply": reply})
 
     try:
         original_message = data.get('message', '')
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=original_message
-        )
-        llm_reply = response.text
+        llm_reply = generate_llm_reply(original_message, session.get('user') or request.remote_addr)
         final_reply = f"**🌐 HOI Assistant (General Knowledge):**\n\n{llm_reply}"
         return jsonify({"status": "ok", "reply": final_reply})
+    except LLMRateLimited:
+        return jsonify({"status": "error", "reply": "Too many questions in a short time. Please wait a few seconds and try again."}), 429
     except APIError:
         return jsonify({"status": "error", "reply": "External LLM service failed to respond. Check API Key or connectivity."})
     except Exception as e:
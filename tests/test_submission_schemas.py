@@ -0,0 +1,217 @@
+"""Compiled form schemas against the payloads the form pages post to /api/submit_form."""
+import os
+from html.parser import HTMLParser
+
+import pytest
+
+import app as dashboard
+
+SAMPLE_TEXT = {'date': '2026-01-15', 'email': 'hod@example.com', 'time': '09:30', 'hidden': None}
+
+
+class PageFormData(HTMLParser):
+    """What a page's getAllFormData() sends with every field filled in: each input, select and
+    textarea with an id inside the form, minus those in a hidden .panel."""
+
+    def __init__(self, form_id=None, visible_panel=None):
+        super().__init__(convert_charrefs=True)
+        self.form_id, self.visible_panel = form_id, visible_panel
+        self.stack = []  # (tag, hidden) of open elements
+        self.in_form = self.form_done = False
+        self.data = {}
+        self.select = None  # [id, first non-empty option value]
+        self.option = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value if value is not None else '' for name, value in attrs}
+        hidden = bool(self.stack) and self.stack[-1][1]
+        if tag == 'form' and not self.form_done and (self.form_id is None or attrs.get('id') == self.form_id):
+            self.in_form = True
+        if 'panel' in attrs.get('class', '').split():
+            if self.visible_panel is None:
+                hidden = 'display:none' in attrs.get('style', '').replace(' ', '')
+            else:
+                hidden = attrs.get('id') != self.visible_panel
+        if tag not in dashboard.HTML_VOID_TAGS:
+            self.stack.append((tag, hidden))
+        if not self.in_form or hidden:
+            return
+        if tag == 'option' and self.select is not None:
+            self.option = [attrs.get('value')]
+        if tag not in ('input', 'select', 'textarea') or not attrs.get('id'):
+            return
+        kind = attrs.get('type', 'text').lower() if tag == 'input' else tag
+        if kind in dashboard.SUBMISSION_SCHEMA_SKIP_TYPES:
+            return
+        if kind == 'checkbox':
+            value = attrs.get('value') or 'on'
+        elif kind in ('number', 'range'):
+            value = float(attrs['min']) if attrs.get('min') else 3.0
+        elif kind == 'radio':
+            value = attrs.get('value') or 'on'
+        elif kind == 'hidden':
+            value = attrs.get('value', '').strip()
+        elif kind == 'select':
+            self.select = [attrs['id'], None]
+            value = ''
+        else:
+            value = SAMPLE_TEXT.get(kind, 'Sample text')
+        self.data[attrs['id']] = value
+
+    def handle_data(self, data):
+        if self.option is not None:
+            self.option.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'option' and self.option is not None:
+            value = self.option[0] if self.option[0] is not None else ''.join(self.option[1:]).strip()
+            if value and self.select[1] is None:
+                self.select[1] = value
+                self.data[self.select[0]] = value
+            self.option = None
+        if tag == 'select':
+            self.select = None
+        if tag == 'form' and self.in_form:
+            self.in_form, self.form_done = False, True
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                del self.stack[index:]
+                break
+
+
+def template_source(form):
+    with open(os.path.join(dashboard.forms_directory(), form), encoding='utf-8') as handle:
+        return handle.read()
+
+
+def page_payload(form, form_id=None, visible_panel=None):
+    parser = PageFormData(form_id, visible_panel)
+    parser.feed(template_source(form))
+    parser.close()
+    return {'form_type': form, 'form_user': 'submitter@example.com', 'subject': f'{form} report',
+            **parser.data, 'submission_description': 'Report'}
+
+
+def spec(kind, **overrides):
+    return {'kind': kind, 'group': 1, 'options': None, 'format': None, 'min': None, 'max': None,
+            'maxlength': dashboard.SUBMISSION_TEXT_MAX_LENGTH, **overrides}
+
+
+# accounts.html and accreditation.html reuse the academics script, which looks up
+# 'academicsForm'; their payloads are built from each page's own form instead.
+PAGES = [
+    ('academics.html', 'academicsForm', None),
+    ('academics.html', 'academicsForm', 'panel-Weekly'),
+    ('academics.html', 'academicsForm', 'panel-Semester'),
+    ('accounts.html', None, None),
+    ('accreditation.html', 'accreditationsForm', None),
+]
+
+
+@pytest.mark.parametrize('form', ['academics.html', 'accounts.html', 'accreditation.html'])
+def test_templates_compile(form):
+    schema = dashboard.compile_form_schema(template_source(form))
+    assert schema is not None
+    assert schema['fields']
+    assert all(key in schema['fields'] for key, _ in schema['required'])
+    assert dashboard.get_form_entry(form)['schema'] == schema
+
+
+def test_academics_number_fields_keep_their_min():
+    fields = dashboard.compile_form_schema(template_source('academics.html'))['fields']
+    assert fields['daily_main_scheduled']['kind'] == 'number'
+    assert fields['daily_main_scheduled']['min'] == 0
+
+
+@pytest.mark.parametrize('form, form_id, visible_panel', PAGES)
+def test_page_payload_validates(form, form_id, visible_panel):
+    payload = page_payload(form, form_id, visible_panel)
+    assert len(payload) > 4
+    normalized, errors, oversized = dashboard.validate_submission_payload(payload)
+    assert errors == []
+    assert not oversized
+    assert normalized['form_user'] == payload['form_user']
+
+
+@pytest.mark.parametrize('form, form_id, visible_panel', PAGES)
+def test_page_payload_rejects_unknown_field(form, form_id, visible_panel):
+    payload = page_payload(form, form_id, visible_panel)
+    payload['not_a_field'] = 'x'
+    _, errors, _ = dashboard.validate_submission_payload(payload)
+    assert errors == ["Unknown field 'not_a_field'"]
+
+
+def test_page_payload_rejects_bad_number():
+    payload = page_payload('academics.html', 'academicsForm')
+    payload['daily_main_scheduled'] = 'twelve'
+    _, errors, _ = dashboard.validate_submission_payload(payload)
+    assert errors == ['daily_main_scheduled must be a number']
+
+
+def test_page_payload_normalizes_number_strings():
+    payload = page_payload('academics.html', 'academicsForm')
+    payload['daily_main_scheduled'] = ' 1,234 '
+    normalized, errors, _ = dashboard.validate_submission_payload(payload)
+    assert errors == []
+    assert normalized['daily_main_scheduled'] == 1234
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1,234', 1234),
+    ('1,234.5', 1234.5),
+    (' 42 ', 42),
+    ('7.0', 7),
+    (12, 12),
+    (2.5, 2.5),
+])
+def test_number_values_are_parsed(value, expected):
+    normalized, error = dashboard.check_schema_value(spec('number'), value)
+    assert error is None
+    assert normalized == expected
+
+
+@pytest.mark.parametrize('value', ['abc', '1,2x', 'nan', 'inf', True, [1], float('inf')])
+def test_number_values_rejected(value):
+    _, error = dashboard.check_schema_value(spec('number'), value)
+    assert error == 'must be a number'
+
+
+def test_empty_number_is_allowed():
+    assert dashboard.check_schema_value(spec('number'), '  ') == ('', None)
+
+
+@pytest.mark.parametrize('value, error', [
+    (-1, 'must be at least 0'),
+    ('-0.5', 'must be at least 0'),
+    (101, 'must be at most 100'),
+    ('1,000', 'must be at most 100'),
+    (0, None),
+    ('100', None),
+])
+def test_number_range(value, error):
+    assert dashboard.check_schema_value(spec('number', min=0.0, max=100.0), value)[1] == error
+
+
+@pytest.mark.parametrize('value, error', [
+    (True, None),
+    (False, None),
+    ('NAAC', None),
+    ('NAAC, NBA', None),
+    (['NAAC', 'ISO'], None),
+    ('Other', "has unknown option 'Other'"),
+    (['NAAC', 'Other'], "has unknown option 'Other'"),
+    (3, 'must be a checkbox value or a list of them'),
+])
+def test_checkbox_values(value, error):
+    checkbox = spec('multi', options=frozenset({'NAAC', 'NBA', 'ISO'}))
+    assert dashboard.check_schema_value(checkbox, value)[1] == error
+
+
+def test_choice_and_text_values():
+    choice = spec('choice', options=frozenset({'Completed', 'Partially'}))
+    assert dashboard.check_schema_value(choice, ' Completed ') == ('Completed', None)
+    assert dashboard.check_schema_value(choice, 'Done')[1] == "has unknown option 'Done'"
+    assert dashboard.check_schema_value(spec('text', maxlength=5), 'abcdef')[1] == 'is longer than 5 characters'
+    assert dashboard.check_schema_value(spec('text', format='date'), '15/01/2026')[1] == 'is not a valid date'
+    assert dashboard.check_schema_value(spec('text'), {'a': 1})[1] == 'must be text'
+    assert dashboard.check_schema_value(spec('any'), {'a': 1}) == ({'a': 1}, None)